@@ -0,0 +1,148 @@
+"""
+Compare float32 and mixed precision (autocast) Moment-DETR on an eval split.
+
+For each precision, reports the inference throughput of `compute_mr_results`, the throughput of a training step
+(forward, losses and backward, without the optimizer update, so the weights stay the same) and the metrics of
+the predictions. Run it with the same arguments as moment_detr/scripts/inference.sh, e.g.,
+
+PYTHONPATH=$PYTHONPATH:. python moment_detr/benchmark_amp.py \
+--resume CHECKPOINT_PATH --eval_split_name val --eval_path data/highlight_val_release.jsonl --amp_dtype bfloat16
+
+Without --amp_dtype, float16 is used on GPU and bfloat16 on CPU.
+"""
+import time
+import pprint
+
+import numpy as np
+import torch
+from torch.utils.data import DataLoader
+
+from moment_detr.config import TestOptions
+from moment_detr.inference import build_eval_dataset, setup_model, compute_mr_results
+from moment_detr.start_end_dataset import build_collate_fn, prepare_batch_inputs, record_copy_event
+from standalone_eval.eval import eval_submission
+from utils.model_utils import resolve_amp_dtype, amp_autocast
+
+import logging
+logger = logging.getLogger(__name__)
+logging.basicConfig(format="%(asctime)s.%(msecs)03d:%(levelname)s:%(name)s - %(message)s",
+                    datefmt="%Y-%m-%d %H:%M:%S",
+                    level=logging.INFO)
+
+
+def synchronize(device):
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+
+
+def benchmark_inference(model, eval_loader, opt):
+    """ Returns:
+        submission: list(dict), the predictions of all queries
+        n_queries_per_sec: float
+    """
+    synchronize(opt.device)
+    timer_start = time.time()
+    submission, _ = compute_mr_results(model, eval_loader, opt)
+    synchronize(opt.device)
+    return submission, len(submission) / (time.time() - timer_start)
+
+
+def benchmark_train_step(model, criterion, eval_loader, opt, n_batches=20):
+    """ Returns:
+        n_queries_per_sec: float, of forward + losses + backward, the gradients are discarded
+        loss_overall: float, the mean weighted loss
+    """
+    amp_dtype = resolve_amp_dtype(opt.amp_dtype, opt.device)
+    scaler = torch.amp.GradScaler(opt.device.type, enabled=amp_dtype == torch.float16)
+    model.train()
+    criterion.train()
+    n_queries, elapsed, losses_list = 0, 0., []
+    for batch_idx, batch in enumerate(eval_loader):
+        if batch_idx == n_batches:
+            break
+        model_inputs, targets = prepare_batch_inputs(batch[1], opt.device, non_blocking=opt.pin_memory)
+        record_copy_event(eval_loader)  # its pinned buffers are reused only after these copies
+        torch.manual_seed(batch_idx)  # the same dropout masks for all precisions
+        synchronize(opt.device)
+        timer_start = time.time()
+        with amp_autocast(opt.device, amp_dtype):
+            outputs = model(**model_inputs)
+        loss_dict = criterion(outputs, targets)
+        weight_dict = criterion.weight_dict
+        losses = sum(loss_dict[k] * weight_dict[k] for k in loss_dict.keys() if k in weight_dict)
+        scaler.scale(losses).backward()
+        synchronize(opt.device)
+        elapsed += time.time() - timer_start
+        model.zero_grad(set_to_none=True)
+        n_queries += len(batch[0])
+        losses_list.append(float(losses))
+    model.eval()
+    criterion.eval()
+    return n_queries / max(elapsed, 1e-8), float(np.mean(losses_list))
+
+
+def compare_submissions(submission, ref_submission):
+    """fraction of queries with the same top-1 window, and max abs difference of the saliency scores"""
+    same_top1 = np.mean([e["pred_relevant_windows"][0][:2] == r["pred_relevant_windows"][0][:2]
+                         for e, r in zip(submission, ref_submission)])
+    max_saliency_diff = max(float(np.abs(np.array(e["pred_saliency_scores"]) -
+                                         np.array(r["pred_saliency_scores"])).max())
+                            for e, r in zip(submission, ref_submission))
+    return dict(same_top1_window=float(same_top1), max_saliency_diff=max_saliency_diff)
+
+
+def format_comparison_table(results):
+    """ one row per metric, one column per setting, and the difference of the 2nd setting to the 1st one
+    Args:
+        results: dict, setting name -> dict(metric name -> float), with two settings
+    """
+    names = list(results.keys())
+    rows = [["", *names, "diff"]]
+    for k in results[names[0]]:
+        rows.append([k, *[results[n][k] for n in names], round(results[names[1]][k] - results[names[0]][k], 4)])
+    col_widths = [max(len(str(row[i])) for row in rows) for i in range(len(rows[0]))]
+    return "\n".join("  ".join(str(e).rjust(w) for e, w in zip(row, col_widths)) for row in rows)
+
+
+def start_benchmark():
+    opt = TestOptions().parse()
+    amp_dtype_name = opt.amp_dtype or ("float16" if opt.device.type == "cuda" else "bfloat16")
+    eval_dataset = build_eval_dataset(opt)
+    model, criterion, _, _ = setup_model(opt)
+    collate_fn, loader_pin_memory = build_collate_fn(opt.pin_memory, opt.num_workers)
+    eval_loader = DataLoader(
+        eval_dataset,
+        collate_fn=collate_fn,
+        batch_size=opt.eval_bsz,
+        num_workers=opt.num_workers,
+        shuffle=False,
+        pin_memory=loader_pin_memory
+    )
+
+    # warm up, e.g., cudnn algorithm selection and feature loading
+    opt.amp_dtype = None
+    compute_mr_results(model, eval_loader, opt)
+
+    results = {}
+    submissions = {}
+    for name, amp_dtype in [("float32", None), (amp_dtype_name, amp_dtype_name)]:
+        opt.amp_dtype = amp_dtype
+        logger.info(f"Benchmark {name}")
+        submission, infer_throughput = benchmark_inference(model, eval_loader, opt)
+        train_throughput, loss_overall = benchmark_train_step(model, criterion, eval_loader, opt)
+        metrics = eval_submission(submission, eval_dataset.data, verbose=False, match_number=False)
+        submissions[name] = submission
+        results[name] = dict(inference_queries_per_sec=round(infer_throughput, 2),
+                             train_step_queries_per_sec=round(train_throughput, 2),
+                             loss_overall=round(loss_overall, 4),
+                             **metrics["brief"])
+
+    logger.info(f"float32 vs. {amp_dtype_name} on {opt.eval_split_name} ({len(eval_dataset)} queries, "
+                f"device {opt.device}):\n{format_comparison_table(results)}")
+    logger.info("Prediction agreement {}".format(
+        pprint.pformat(compare_submissions(submissions[amp_dtype_name], submissions["float32"]), indent=4)))
+    return results
+
+
+if __name__ == '__main__':
+    start_benchmark()
@@ -0,0 +1,142 @@
+"""
+Compare the attention backends of the DETR transformer, see `--attn_backend` in moment_detr/config.py.
+
+Both backends share the same weights (random, with the default model sizes in moment_detr/config.py),
+and run on the same random padded batch. For each backend, reports the throughput and the peak memory
+of the inference forward and of a training step (forward and backward), and the max abs difference of
+the outputs to those of nn.MultiheadAttention. Run it as
+
+PYTHONPATH=$PYTHONPATH:. python moment_detr/benchmark_attention.py --bsz 32 --device cpu
+"""
+import os
+import time
+import argparse
+import tempfile
+
+import torch
+from torch.profiler import profile, ProfilerActivity
+
+from moment_detr.transformer import Transformer
+from moment_detr.benchmark_amp import synchronize, format_comparison_table
+from utils.basic_utils import load_json
+
+import logging
+logger = logging.getLogger(__name__)
+logging.basicConfig(format="%(asctime)s.%(msecs)03d:%(levelname)s:%(name)s - %(message)s",
+                    datefmt="%Y-%m-%d %H:%M:%S",
+                    level=logging.INFO)
+
+
+def measure_peak_memory(fn, device):
+    """peak memory in MB allocated while running `fn`, on top of the memory allocated before"""
+    if device.type == "cuda":
+        synchronize(device)
+        base = torch.cuda.memory_allocated(device)
+        torch.cuda.reset_peak_memory_stats(device)
+        fn()
+        synchronize(device)
+        return (torch.cuda.max_memory_allocated(device) - base) / 1024 ** 2
+    # the CPU allocator has no peak stats, use the running total of the profiler memory events
+    with profile(activities=[ProfilerActivity.CPU], profile_memory=True) as prof:
+        fn()
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        trace_path = os.path.join(tmp_dir, "trace.json")
+        prof.export_chrome_trace(trace_path)
+        events = load_json(trace_path)["traceEvents"]
+    events = sorted([e for e in events if e.get("name") == "[memory]"], key=lambda e: e["ts"])
+    if len(events) == 0:
+        return 0.
+    # the running total may start from the allocations of an earlier profiler session
+    base = events[0]["args"]["Total Allocated"] - events[0]["args"]["Bytes"]
+    return (max(e["args"]["Total Allocated"] for e in events) - base) / 1024 ** 2
+
+
+def measure_throughput(fn, device, bsz, n_iters=20, n_warmup=3):
+    """#examples per second"""
+    for _ in range(n_warmup):
+        fn()
+    synchronize(device)
+    timer_start = time.time()
+    for _ in range(n_iters):
+        fn()
+    synchronize(device)
+    return bsz * n_iters / (time.time() - timer_start)
+
+
+def get_random_inputs(bsz, max_l, num_queries, d_model, device, seed=0):
+    """ Returns:
+        src, pos: (bsz, max_l, d_model), mask: (bsz, max_l), True at padded positions, query_embed: (#queries, d)
+    """
+    g = torch.Generator().manual_seed(seed)
+    src = torch.randn(bsz, max_l, d_model, generator=g)
+    pos = torch.randn(bsz, max_l, d_model, generator=g)
+    query_embed = torch.randn(num_queries, d_model, generator=g)
+    lengths = torch.randint(max_l // 2, max_l + 1, (bsz,), generator=g)
+    mask = torch.arange(max_l)[None] >= lengths[:, None]
+    return [e.to(device) for e in (src, mask, query_embed, pos)]
+
+
+def benchmark_backend(transformer, inputs, opt):
+    def infer():
+        with torch.no_grad():
+            transformer(*inputs)
+
+    def train_step():
+        transformer.zero_grad(set_to_none=True)
+        hs, memory = transformer(*inputs)
+        (hs.sum() + memory.sum()).backward()
+
+    transformer.eval()
+    results = dict(inference_examples_per_sec=measure_throughput(infer, opt.device, opt.bsz, opt.n_iters),
+                   inference_peak_mb=measure_peak_memory(infer, opt.device))
+    transformer.train()
+    results.update(train_step_examples_per_sec=measure_throughput(train_step, opt.device, opt.bsz, opt.n_iters),
+                   train_step_peak_mb=measure_peak_memory(train_step, opt.device))
+    transformer.zero_grad(set_to_none=True)
+    transformer.eval()
+    return {k: round(v, 2) for k, v in results.items()}
+
+
+def start_benchmark():
+    parser = argparse.ArgumentParser(description="Benchmark the attention backends of the DETR transformer")
+    parser.add_argument("--bsz", type=int, default=32)
+    parser.add_argument("--max_v_l", type=int, default=75)
+    parser.add_argument("--max_q_l", type=int, default=32)
+    parser.add_argument("--hidden_dim", type=int, default=256)
+    parser.add_argument("--nheads", type=int, default=8)
+    parser.add_argument("--enc_layers", type=int, default=2)
+    parser.add_argument("--dec_layers", type=int, default=2)
+    parser.add_argument("--dim_feedforward", type=int, default=1024)
+    parser.add_argument("--num_queries", type=int, default=10)
+    parser.add_argument("--n_iters", type=int, default=20)
+    parser.add_argument("--device", type=str, default="cpu")
+    opt = parser.parse_args()
+    opt.device = torch.device(opt.device)
+
+    transformers = {}
+    for attn_backend in ["mha", "sdpa"]:
+        transformers[attn_backend] = Transformer(
+            d_model=opt.hidden_dim, nhead=opt.nheads, num_encoder_layers=opt.enc_layers,
+            num_decoder_layers=opt.dec_layers, dim_feedforward=opt.dim_feedforward,
+            return_intermediate_dec=True, attn_backend=attn_backend).to(opt.device)
+    transformers["sdpa"].load_state_dict(transformers["mha"].state_dict())
+    # the video and the query tokens are concatenated before the encoder
+    inputs = get_random_inputs(opt.bsz, opt.max_v_l + opt.max_q_l, opt.num_queries, opt.hidden_dim, opt.device)
+
+    results = {}
+    outputs = {}
+    for attn_backend, transformer in transformers.items():
+        logger.info(f"Benchmark {attn_backend}")
+        results[attn_backend] = benchmark_backend(transformer, inputs, opt)
+        with torch.no_grad():
+            outputs[attn_backend] = transformer(*inputs)
+
+    max_diff = max(float((e - r).abs().max()) for e, r in zip(outputs["sdpa"], outputs["mha"]))
+    logger.info(f"mha vs. sdpa, batch size {opt.bsz}, length {opt.max_v_l + opt.max_q_l}, device {opt.device}, "
+                f"{torch.get_num_threads()} threads:\n{format_comparison_table(results)}")
+    logger.info(f"max abs diff of the outputs: {max_diff}")
+    return results
+
+
+if __name__ == '__main__':
+    start_benchmark()
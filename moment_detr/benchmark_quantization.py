@@ -0,0 +1,84 @@
+"""
+Accuracy regression of dynamic int8 quantization, see `utils.model_utils.quantize_linear_int8`.
+
+Runs the float32 and the int8 Moment-DETR model on CPU over an eval split, and reports the metrics of
+`eval_submission` next to the throughput and the size of the weights. Run it with the same arguments as
+moment_detr/scripts/inference.sh, e.g.,
+
+PYTHONPATH=$PYTHONPATH:. python moment_detr/benchmark_quantization.py \
+--resume CHECKPOINT_PATH --eval_split_name val --eval_path data/highlight_val_release.jsonl
+"""
+import io
+import pprint
+
+import torch
+from torch.utils.data import DataLoader
+
+from moment_detr.config import TestOptions
+from moment_detr.inference import build_eval_dataset, setup_model, compute_mr_results
+from moment_detr.start_end_dataset import build_collate_fn
+from moment_detr.benchmark_amp import benchmark_inference, compare_submissions, format_comparison_table
+from standalone_eval.eval import eval_submission
+from utils.model_utils import quantize_linear_int8, count_int8_weights
+
+import logging
+logger = logging.getLogger(__name__)
+logging.basicConfig(format="%(asctime)s.%(msecs)03d:%(levelname)s:%(name)s - %(message)s",
+                    datefmt="%Y-%m-%d %H:%M:%S",
+                    level=logging.INFO)
+
+
+def get_state_dict_size(model):
+    """size of the serialized weights in MB"""
+    buffer = io.BytesIO()
+    torch.save(model.state_dict(), buffer)
+    return buffer.getbuffer().nbytes / 1024 ** 2
+
+
+def start_benchmark():
+    opt = TestOptions().parse()
+    if opt.device.type != "cpu":
+        logger.info("Quantized models run on CPU, use device cpu for both models")
+        opt.device = torch.device("cpu")
+    opt.amp_dtype = None
+    eval_dataset = build_eval_dataset(opt)
+    model, _, _, _ = setup_model(opt)
+    models = {"float32": model.eval(), "int8": quantize_linear_int8(model)}
+    collate_fn, loader_pin_memory = build_collate_fn(opt.pin_memory, opt.num_workers)
+    eval_loader = DataLoader(
+        eval_dataset,
+        collate_fn=collate_fn,
+        batch_size=opt.eval_bsz,
+        num_workers=opt.num_workers,
+        shuffle=False,
+        pin_memory=loader_pin_memory
+    )
+
+    compute_mr_results(model, eval_loader, opt)  # warm up, e.g., feature loading
+
+    results = {}
+    submissions = {}
+    for name, cur_model in models.items():
+        logger.info(f"Benchmark {name}")
+        submission, throughput = benchmark_inference(cur_model, eval_loader, opt)
+        n_int8, n_float = count_int8_weights(cur_model)
+        metrics = eval_submission(submission, eval_dataset.data, verbose=False, match_number=False)
+        submissions[name] = submission
+        results[name] = dict(inference_queries_per_sec=round(throughput, 2),
+                             ms_per_query=round(1000 / throughput, 2),
+                             weights_mb=round(get_state_dict_size(cur_model), 2),
+                             int8_weights_pct=round(100 * n_int8 / (n_int8 + n_float), 1),
+                             **metrics["brief"])
+
+    logger.info(f"float32 vs. int8 on {opt.eval_split_name} ({len(eval_dataset)} queries, "
+                f"batch size {opt.eval_bsz}, {torch.get_num_threads()} threads):\n{format_comparison_table(results)}")
+    logger.info("Only the nn.Linear layers (feed-forward, input projections, prediction heads) are int8, the "
+                "attention projections stay in float32 (in_proj and out_proj with --attn_backend mha, in_proj "
+                "with sdpa), int8_weights_pct is the quantized share of the weights")
+    logger.info("Prediction agreement {}".format(
+        pprint.pformat(compare_submissions(submissions["int8"], submissions["float32"]), indent=4)))
+    return results
+
+
+if __name__ == '__main__':
+    start_benchmark()
@@ -0,0 +1,86 @@
+"""
+Length-bucketed batch sampling.
+
+`start_end_collate` pads each batch to its longest video and query, so batches mixing short and long
+examples spend most of their attention FLOPs on padding. `LengthBucketBatchSampler` forms batches from
+examples of similar (ctx_l, query_len):
+    training: the shuffled examples are split into buckets of `bucket_size` batches, each bucket is
+        sorted by length and cut into batches, then the order of all batches is shuffled again.
+        The buckets are re-drawn every epoch, so batches still differ across epochs.
+    eval: all examples are sorted by length and cut into batches.
+"""
+import numpy as np
+import torch
+from torch.utils.data import Sampler
+
+
+class LengthBucketBatchSampler(Sampler):
+    """
+    Args:
+        lengths: np.ndarray, (N, ) or (N, K), the sort keys of each example, e.g., (ctx_l, query_len),
+            the first column is the primary key.
+        batch_size: int
+        bucket_size: int, #batches in each bucket, only used when shuffle is True.
+        shuffle: bool, False for eval, where the examples are sorted globally.
+        drop_last: bool, drop the batches that are smaller than batch_size.
+    """
+
+    def __init__(self, lengths, batch_size, bucket_size=100, shuffle=True, drop_last=False):
+        lengths = np.asarray(lengths)
+        self.lengths = lengths.reshape(len(lengths), -1)
+        self.batch_size = batch_size
+        self.bucket_size = bucket_size
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+
+    def _sort_by_length(self, indices):
+        # np.lexsort uses the last key as the primary key, it is stable
+        return indices[np.lexsort(self.lengths[indices].T[::-1])]
+
+    def _split_batches(self, indices):
+        batches = [indices[i:i + self.batch_size] for i in range(0, len(indices), self.batch_size)]
+        if self.drop_last and len(batches) > 0 and len(batches[-1]) < self.batch_size:
+            batches = batches[:-1]
+        return batches
+
+    def get_batches(self):
+        if not self.shuffle:
+            return self._split_batches(self._sort_by_length(np.arange(len(self.lengths))))
+
+        # use torch RNG as RandomSampler does, so that `set_seed` controls the sampling
+        indices = torch.randperm(len(self.lengths)).numpy()
+        n_per_bucket = self.batch_size * self.bucket_size
+        batches = []
+        for st in range(0, len(indices), n_per_bucket):
+            batches.extend(self._split_batches(self._sort_by_length(indices[st:st + n_per_bucket])))
+        return [batches[i] for i in torch.randperm(len(batches)).tolist()]
+
+    def __iter__(self):
+        for batch in self.get_batches():
+            yield batch.tolist()
+
+    def __len__(self):
+        if self.drop_last:
+            n_full_batches = 0
+            for st in range(0, len(self.lengths), self.batch_size * self.bucket_size):
+                n_full_batches += min(self.batch_size * self.bucket_size, len(self.lengths) - st) // self.batch_size
+            return n_full_batches if self.shuffle else len(self.lengths) // self.batch_size
+        return (len(self.lengths) + self.batch_size - 1) // self.batch_size
+
+
+def compute_padding_efficiency(lengths, batches):
+    """ #valid tokens / #tokens after padding each batch to its longest example, for each length column.
+    Args:
+        lengths: np.ndarray, (N, K)
+        batches: list(list(int)), indices of each batch
+    Returns:
+        np.ndarray, (K, )
+    """
+    lengths = np.asarray(lengths).reshape(len(lengths), -1)
+    n_valid = np.zeros(lengths.shape[1])
+    n_padded = np.zeros(lengths.shape[1])
+    for batch in batches:
+        batch_lengths = lengths[batch]
+        n_valid += batch_lengths.sum(0)
+        n_padded += batch_lengths.max(0) * len(batch)
+    return n_valid / np.maximum(n_padded, 1)
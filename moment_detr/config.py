@@ -77,6 +77,24 @@ class BaseOptions(object):
         parser.add_argument("--v_feat_dim", type=int, help="video feature dim")
         parser.add_argument("--t_feat_dim", type=int, help="text/query feature dim")
         parser.add_argument("--ctx_mode", type=str, default="video_tef")
+        parser.add_argument("--feat_backend", type=str, default="npz", choices=["npz", "packed"],
+                            help="npz: load one {vid}.npz/qid{qid}.npz per example. "
+                                 "packed: read from memory-mapped stores built by moment_detr/feature_store.py")
+        parser.add_argument("--feat_cache_gb", type=float, default=0,
+                            help="size of the in-RAM feature cache shared by all dataloader workers of the train "
+                                 "and eval datasets, in GB, 0: disable. "
+                                 "Entries live in /dev/shm, make sure it is large enough.")
+        parser.add_argument("--prefetch", action="store_true",
+                            help="load the next batch and move it to device in a background thread "
+                                 "(on a side CUDA stream), while the current batch is computed")
+        parser.add_argument("--length_bucket_size", type=int, default=0,
+                            help="batch examples with similar (video, query) lengths to reduce padding. "
+                                 "Training batches are drawn from shuffled buckets of this many batches, "
+                                 "eval examples are sorted by length. 0: disable, i.e., plain shuffling.")
+        parser.add_argument("--amp_dtype", type=str, default=None, choices=["float16", "bfloat16"],
+                            help="run the model forward in mixed precision (autocast) with this dtype, "
+                                 "losses and matching are computed in float32, float16 uses loss scaling. "
+                                 "float16 falls back to bfloat16 on CPU. None: disable, i.e., float32.")
 
         # Model config
         parser.add_argument('--position_embedding', default='sine', type=str, choices=('sine', 'learned'),
@@ -102,6 +120,10 @@ class BaseOptions(object):
         parser.add_argument('--num_queries', default=10, type=int,
                             help="Number of query slots")
         parser.add_argument('--pre_norm', action='store_true')
+        parser.add_argument("--attn_backend", type=str, default="mha", choices=["mha", "sdpa"],
+                            help="attention in the transformer, mha: nn.MultiheadAttention, "
+                                 "sdpa: F.scaled_dot_product_attention on batch-first tensors. "
+                                 "Both use the same parameters, checkpoints can be loaded with either one.")
         # other model configs
         parser.add_argument("--n_input_proj", type=int, default=2, help="#layers to encoder input")
         parser.add_argument("--contrastive_hdim", type=int, default=64, help="dim for contrastive embeddings")
@@ -170,7 +192,7 @@ class BaseOptions(object):
             for arg in saved_options:  # use saved options to overwrite all BaseOptions args.
                 if arg not in ["results_root", "num_workers", "nms_thd", "debug",  # "max_before_nms", "max_after_nms"
                                "max_pred_l", "min_pred_l",
-                               "resume", "resume_all", "no_sort_results"]:
+                               "resume", "resume_all", "no_sort_results", "amp_dtype", "attn_backend"]:
                     setattr(opt, arg, saved_options[arg])
             # opt.no_core_driver = True
             if opt.eval_results_dir is not None:
@@ -0,0 +1,164 @@
+"""
+In-RAM feature cache shared across DataLoader workers.
+
+Each cached array is stored in its own `multiprocessing.shared_memory` block, so that a feature
+loaded by one worker is served to all other workers (and all later epochs) without touching the disk.
+The bookkeeping (key -> block, LRU order, byte budget) lives in a manager process, which every worker
+talks to through a proxy, so eviction is global instead of per-worker.
+"""
+import os
+import atexit
+import threading
+import uuid
+import logging
+import numpy as np
+from collections import OrderedDict
+from multiprocessing import resource_tracker
+from multiprocessing.managers import SyncManager
+from multiprocessing.shared_memory import SharedMemory
+
+logger = logging.getLogger(__name__)
+
+
+def _untrack(shm):
+    """Python < 3.13 registers every attached block in the resource tracker, which unlinks it when the
+    attaching process exits. Blocks are owned by the cache instead, so we opt out of the tracking."""
+    try:
+        resource_tracker.unregister(shm._name, "shared_memory")
+    except Exception:
+        pass
+
+
+def _unlink(shm_name):
+    try:
+        shm = SharedMemory(name=shm_name)
+    except FileNotFoundError:
+        return
+    shm.close()
+    shm.unlink()  # also drops the tracker registration made when attaching
+
+
+class LRUIndex(object):
+    """key -> (shm_name, shape, dtype, n_bytes) with a byte budget, lives in the manager process."""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.n_bytes = 0
+        self.n_hits = 0
+        self.n_misses = 0
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()  # the manager serves each client in its own thread
+
+    def get(self, key):
+        with self.lock:
+            meta = self.entries.get(key)
+            if meta is None:
+                self.n_misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.n_hits += 1
+            return meta
+
+    def put(self, key, meta):
+        """returns True if the block is now owned by the cache, False if the caller should unlink it"""
+        n_bytes = meta[3]
+        with self.lock:
+            if key in self.entries or n_bytes > self.max_bytes:
+                return False
+            while self.n_bytes + n_bytes > self.max_bytes:
+                _, evicted_meta = self.entries.popitem(last=False)
+                self.n_bytes -= evicted_meta[3]
+                _unlink(evicted_meta[0])
+            self.entries[key] = meta
+            self.n_bytes += n_bytes
+            return True
+
+    def stats(self):
+        with self.lock:
+            return dict(n_entries=len(self.entries), n_bytes=self.n_bytes, max_bytes=self.max_bytes,
+                        n_hits=self.n_hits, n_misses=self.n_misses)
+
+    def clear(self):
+        with self.lock:
+            for meta in self.entries.values():
+                _unlink(meta[0])
+            self.entries.clear()
+            self.n_bytes = 0
+
+
+class _CacheManager(SyncManager):
+    pass
+
+
+_CacheManager.register("LRUIndex", LRUIndex)
+
+
+class SharedFeatureCache(object):
+    """Process-shared LRU cache of np.ndarray features with a byte budget.
+    Create it in the main process before the DataLoader workers are started, the workers inherit a
+    proxy to the shared index. Arrays returned by `get` are private copies, so callers may modify them.
+
+    Args:
+        max_bytes: int, total size budget of the cached arrays, least recently used ones are evicted first.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = int(max_bytes)
+        self._owner_pid = os.getpid()
+        self._manager = _CacheManager()
+        self._manager.start()
+        self._index = self._manager.LRUIndex(self.max_bytes)
+        atexit.register(self.close)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_manager"] = None  # only the creating process owns the manager
+        return state
+
+    def get(self, key, load_func):
+        """returns the cached array of `key`, calls `load_func()` and caches its result on a miss"""
+        meta = self._index.get(key)
+        if meta is not None:
+            try:
+                shm = SharedMemory(name=meta[0])
+            except FileNotFoundError:  # evicted by another worker in the meantime
+                shm = None
+            if shm is not None:
+                _untrack(shm)
+                array = np.array(np.ndarray(meta[1], dtype=meta[2], buffer=shm.buf))  # copy out
+                shm.close()
+                return array
+
+        array = load_func()
+        self._put(key, array)
+        return array
+
+    def _put(self, key, array):
+        n_bytes = array.nbytes
+        if n_bytes == 0 or n_bytes > self.max_bytes:
+            return
+        try:
+            shm = SharedMemory(name=f"mdetr_{uuid.uuid4().hex[:20]}", create=True, size=n_bytes)
+        except OSError as e:  # e.g., /dev/shm is full
+            logger.warning(f"Failed to allocate shared memory for {key}: {e}")
+            return
+        _untrack(shm)
+        np.ndarray(array.shape, dtype=array.dtype, buffer=shm.buf)[:] = array
+        accepted = self._index.put(key, (shm.name, array.shape, array.dtype.str, n_bytes))
+        shm.close()
+        if not accepted:
+            _unlink(shm.name)
+
+    def stats(self):
+        return self._index.stats()
+
+    def close(self):
+        """release all shared memory blocks, called automatically at exit of the creating process"""
+        if self._manager is None or os.getpid() != self._owner_pid:
+            return
+        try:
+            self._index.clear()
+            self._manager.shutdown()
+        except Exception:
+            pass
+        self._manager = None
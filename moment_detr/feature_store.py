@@ -0,0 +1,191 @@
+"""
+Packed, memory-mapped feature storage.
+
+All `{name}.npz` files inside a feature dir are concatenated along the first (length) axis into a
+single contiguous raw file, together with a small json index that maps each name to its row range:
+    {feat_dir}/packed_{feat_key}.dat   (total_rows, D) raw array
+    {feat_dir}/packed_{feat_key}.json  {"dtype": .., "dim": .., "ndim": .., "normalized": .., "index": {name: [st, l]}}
+Features are optionally l2-normalized at packing time, so that the dataloader only needs to slice
+the memory map instead of opening, inflating and normalizing one npz file per example.
+
+Usage:
+    PYTHONPATH=$PYTHONPATH:. python moment_detr/feature_store.py \
+    --feat_dir features/clip_features --feat_key features --dtype float16
+"""
+import os
+import json
+import numpy as np
+from os.path import join, exists
+from tqdm import tqdm
+from utils.basic_utils import l2_normalize_np_array, get_basename_no_ext, save_json, load_json
+
+
+def get_packed_paths(feat_dir, feat_key):
+    """returns (data_path, index_path) of the packed store of `feat_key` inside `feat_dir`"""
+    return join(feat_dir, f"packed_{feat_key}.dat"), join(feat_dir, f"packed_{feat_key}.json")
+
+
+def pack_features(feat_dir, feat_key, save_dir=None, dtype="float32", normalize=True):
+    """Pack all `{name}.npz` files in feat_dir into one contiguous file plus an offset index.
+    Args:
+        feat_dir: str, dir containing `{name}.npz` files
+        feat_key: str, the array to pack from each npz file, e.g., `features`, `last_hidden_state`
+        save_dir: str, where to write the packed store, default to feat_dir
+        dtype: str, one of [float16, float32], storage dtype
+        normalize: bool, l2-normalize the last dim before storing
+    Returns:
+        data_path, index_path
+    """
+    assert dtype in ["float16", "float32"]
+    save_dir = feat_dir if save_dir is None else save_dir
+    data_path, index_path = get_packed_paths(save_dir, feat_key)
+    npz_filenames = sorted([e for e in os.listdir(feat_dir) if e.endswith(".npz")])
+
+    if exists(index_path):  # pack from scratch
+        os.remove(index_path)
+    writer = PackedFeatureWriter(save_dir, feat_key, dtype=dtype, normalize=normalize, flush_every=0)
+    for filename in tqdm(npz_filenames, desc=f"Packing {feat_key} from {feat_dir}"):
+        writer.add(get_basename_no_ext(filename), np.load(join(feat_dir, filename))[feat_key])
+    writer.close()
+    return data_path, index_path
+
+
+class PackedFeatureWriter(object):
+    """Appends features to a packed store, in the layout written by `pack_features`.
+    An existing store is extended, so an interrupted extraction can be resumed: the rows written after the
+    last saved index (i.e., by an interrupted run) are dropped, and `name in writer` tells which entries exist.
+
+    Args:
+        feat_dir: str
+        feat_key: str
+        dtype: str, one of [float16, float32], storage dtype
+        normalize: bool, l2-normalize the last dim before storing
+        flush_every: int, save the index every flush_every added entries, 0: only in `flush` and `close`
+    """
+
+    def __init__(self, feat_dir, feat_key, dtype="float32", normalize=True, flush_every=100):
+        assert dtype in ["float16", "float32"]
+        os.makedirs(feat_dir, exist_ok=True)
+        self.data_path, self.index_path = get_packed_paths(feat_dir, feat_key)
+        if exists(self.index_path):
+            self.meta = load_json(self.index_path)
+            assert self.meta["dtype"] == dtype and self.meta["normalized"] == normalize, \
+                f"{self.index_path} has dtype {self.meta['dtype']} and normalized {self.meta['normalized']}"
+        else:
+            self.meta = dict(dtype=dtype, dim=None, ndim=None, n_rows=0, feat_key=feat_key,
+                             normalized=normalize, index={})
+        self.dtype = np.dtype(dtype)
+        self.normalize = normalize
+        self.flush_every = flush_every
+        self.n_unsaved = 0
+        n_bytes = self.meta["n_rows"] * (self.meta["dim"] or 0) * self.dtype.itemsize
+        self.f = open(self.data_path, "r+b" if exists(self.data_path) and n_bytes > 0 else "wb")
+        self.f.truncate(n_bytes)
+        self.f.seek(n_bytes)
+
+    def __contains__(self, name):
+        return name in self.meta["index"]
+
+    def __len__(self):
+        return len(self.meta["index"])
+
+    def add(self, name, feat):
+        """ Args:
+            name: str
+            feat: np.ndarray, (L, D) or (D, )
+        """
+        feat = np.asarray(feat, dtype=np.float32)
+        if self.meta["ndim"] is None:
+            self.meta["ndim"], self.meta["dim"] = feat.ndim, feat.shape[-1]
+        assert feat.ndim == self.meta["ndim"] and feat.shape[-1] == self.meta["dim"], \
+            f"inconsistent feature shape {feat.shape} of {name}"
+        if self.normalize:
+            feat = l2_normalize_np_array(feat)
+        feat = feat.reshape(-1, self.meta["dim"]).astype(self.dtype)
+        self.f.write(feat.tobytes())
+        self.meta["index"][name] = [self.meta["n_rows"], len(feat)]
+        self.meta["n_rows"] += len(feat)
+        self.n_unsaved += 1
+        if self.flush_every > 0 and self.n_unsaved >= self.flush_every:
+            self.flush()
+
+    def flush(self):
+        """write the rows to disk before the index that refers to them"""
+        self.f.flush()
+        os.fsync(self.f.fileno())
+        tmp_index_path = self.index_path + ".tmp"
+        save_json(self.meta, tmp_index_path)
+        os.replace(tmp_index_path, self.index_path)
+        self.n_unsaved = 0
+
+    def close(self):
+        self.flush()
+        self.f.close()
+
+
+class PackedFeatureStore(object):
+    """Read-only access to a store written by `pack_features`.
+    The memory map is opened lazily, so each DataLoader worker maps the file on its first read
+    instead of inheriting (or pickling) the parent's handle. Slicing the map is zero-copy,
+    pages are loaded by the OS on demand and shared across workers through the page cache.
+    """
+
+    def __init__(self, feat_dir, feat_key):
+        self.data_path, self.index_path = get_packed_paths(feat_dir, feat_key)
+        meta = load_json(self.index_path)
+        self.dtype = np.dtype(meta["dtype"])
+        self.dim = meta["dim"]
+        self.ndim = meta["ndim"]
+        self.n_rows = meta["n_rows"]
+        self.normalized = meta["normalized"]
+        self.index = meta["index"]
+        self._data = None
+
+    @classmethod
+    def exists(cls, feat_dir, feat_key):
+        return all(exists(p) for p in get_packed_paths(feat_dir, feat_key))
+
+    @property
+    def data(self):
+        if self._data is None:
+            self._data = np.memmap(self.data_path, dtype=self.dtype, mode="r", shape=(self.n_rows, self.dim))
+        return self._data
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_data"] = None  # re-map in the receiving process
+        return state
+
+    def __contains__(self, name):
+        return name in self.index
+
+    def __len__(self):
+        return len(self.index)
+
+    def get(self, name, max_l=None):
+        """returns a read-only view of shape (L, D), or (D, ) for features packed from 1-d arrays"""
+        st, l = self.index[name]
+        if max_l is not None:
+            l = min(l, max_l)
+        feat = self.data[st:st + l]
+        return feat[0] if self.ndim == 1 else feat
+
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description="Pack npz features into a memory-mapped store")
+    parser.add_argument("--feat_dir", type=str, required=True, help="dir containing {name}.npz files")
+    parser.add_argument("--feat_key", type=str, default="features",
+                        help="array key in each npz file, `features` for video, `last_hidden_state` for query")
+    parser.add_argument("--save_dir", type=str, default=None, help="default to --feat_dir")
+    parser.add_argument("--dtype", type=str, default="float32", choices=["float16", "float32"])
+    parser.add_argument("--no_norm", action="store_true", help="do not l2-normalize features before packing")
+    args = parser.parse_args()
+
+    data_path, index_path = pack_features(
+        args.feat_dir, args.feat_key, save_dir=args.save_dir, dtype=args.dtype, normalize=not args.no_norm)
+    print(f"Packed features saved at {data_path}, index saved at {index_path}")
+
+
+if __name__ == '__main__':
+    main()
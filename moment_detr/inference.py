@@ -13,11 +13,14 @@ from torch.utils.data import DataLoader
 from moment_detr.config import TestOptions
 from moment_detr.model import build_model
 from moment_detr.span_utils import span_cxw_to_xx
-from moment_detr.start_end_dataset import StartEndDataset, start_end_collate, prepare_batch_inputs
-from moment_detr.postprocessing_moment_detr import PostProcessorDETR
+from moment_detr.bucket_sampler import LengthBucketBatchSampler, compute_padding_efficiency
+from moment_detr.start_end_dataset import StartEndDataset, build_collate_fn, prepare_batch_inputs, record_copy_event
+from moment_detr.prefetcher import DevicePrefetcher
+from moment_detr.postprocessing_moment_detr import PostProcessorDETR, round_to_decimals
 from standalone_eval.eval import eval_submission
 from utils.basic_utils import save_jsonl, save_json
-from utils.temporal_nms import temporal_nms
+from utils.model_utils import resolve_amp_dtype, amp_autocast, cast_to_float
+from utils.temporal_nms import batched_temporal_nms
 
 import logging
 
@@ -28,13 +31,14 @@ logging.basicConfig(format="%(asctime)s.%(msecs)03d:%(levelname)s:%(name)s - %(m
 
 
 def post_processing_mr_nms(mr_res, nms_thd, max_before_nms, max_after_nms):
+    windows_after_nms = batched_temporal_nms(
+        [e["pred_relevant_windows"][:max_before_nms] for e in mr_res],
+        nms_thd=nms_thd,
+        max_after_nms=max_after_nms
+    )  # the same as calling temporal_nms on each query
     mr_res_after_nms = []
-    for e in mr_res:
-        e["pred_relevant_windows"] = temporal_nms(
-            e["pred_relevant_windows"][:max_before_nms],
-            nms_thd=nms_thd,
-            max_after_nms=max_after_nms
-        )
+    for e, windows in zip(mr_res, windows_after_nms):
+        e["pred_relevant_windows"] = windows
         mr_res_after_nms.append(e)
     return mr_res_after_nms
 
@@ -83,6 +87,28 @@ def eval_epoch_post_processing(submission, opt, gt_data, save_submission_filenam
     return metrics, metrics_nms, latest_file_paths
 
 
+def decode_mr_predictions(windows, scores, post_processor=None, sort_results=True):
+    """ Batched decoding, gives the same results as ranking, formatting and post-processing the predictions
+    of each query separately, with a single conversion to python objects at the end.
+    Args:
+        windows: (bsz, #queries, 2) tensor, [st (seconds), ed (seconds)]
+        scores: (bsz, #queries) tensor
+        post_processor: PostProcessorDETR, applied to the windows after rounding them to 4 decimals
+        sort_results: bool, rank the windows of each video by decreasing score, ties keep their order
+    Returns:
+        list(list([st (float), ed (float), score (float)])), (bsz, #queries, 3)
+    """
+    if sort_results:
+        scores, order = torch.sort(scores, dim=1, descending=True, stable=True)
+        windows = torch.gather(windows, 1, order[..., None].expand_as(windows))
+    windows = round_to_decimals(windows.double())
+    scores = round_to_decimals(scores.double())
+    if post_processor is not None:  # the post processor works on float32 windows, and re-formats the scores
+        windows = post_processor.process_windows(windows.float()).double()
+        scores = round_to_decimals(scores.float().double())
+    return torch.cat([windows, scores[..., None]], dim=2).cpu().tolist()
+
+
 @torch.no_grad()
 def compute_mr_results(model, eval_loader, opt, epoch_i=None, criterion=None, tb_writer=None):
     model.eval()
@@ -93,20 +119,35 @@ def compute_mr_results(model, eval_loader, opt, epoch_i=None, criterion=None, tb
     loss_meters = defaultdict(AverageMeter)
     write_tb = tb_writer is not None and epoch_i is not None
 
+    amp_dtype = resolve_amp_dtype(opt.amp_dtype, opt.device)
+    post_processor = PostProcessorDETR(
+        clip_length=2, min_ts_val=0, max_ts_val=150,
+        min_w_l=2, max_w_l=150, move_window_method="left",
+        process_func_names=("clip_ts", "round_multiple")
+    )
     mr_res = []
+    if opt.prefetch:  # batch[2] holds the inputs already moved to device
+        eval_loader = DevicePrefetcher(eval_loader, opt.device, non_blocking=opt.pin_memory)
     for batch in tqdm(eval_loader, desc="compute st ed scores"):
         query_meta = batch[0]
-        model_inputs, targets = prepare_batch_inputs(batch[1], opt.device, non_blocking=opt.pin_memory)
-        outputs = model(**model_inputs)
+        if opt.prefetch:
+            model_inputs, targets = batch[2]
+        else:
+            model_inputs, targets = prepare_batch_inputs(batch[1], opt.device, non_blocking=opt.pin_memory)
+            record_copy_event(eval_loader)  # its pinned buffers are reused only after these copies
+        with amp_autocast(opt.device, amp_dtype):
+            outputs = model(**model_inputs)
+        outputs = cast_to_float(outputs)  # decode and compute losses in float32
         prob = F.softmax(outputs["pred_logits"], -1)  # (batch_size, #queries, #classes=2)
         if opt.span_loss_type == "l1":
             scores = prob[..., 0]  # * (batch_size, #queries)  foreground label is 0, we directly take it
             pred_spans = outputs["pred_spans"]  # (bsz, #queries, 2)
-            _saliency_scores = outputs["saliency_scores"].half()  # (bsz, L)
-            saliency_scores = []
+            durations = torch.tensor(
+                [meta["duration"] for meta in query_meta], dtype=pred_spans.dtype, device=pred_spans.device)
+            pred_spans = span_cxw_to_xx(pred_spans) * durations[:, None, None]
+            _saliency_scores = outputs["saliency_scores"].half().cpu().tolist()  # (bsz, L)
             valid_vid_lengths = model_inputs["src_vid_mask"].sum(1).cpu().tolist()
-            for j in range(len(valid_vid_lengths)):
-                saliency_scores.append(_saliency_scores[j, :int(valid_vid_lengths[j])].tolist())
+            saliency_scores = [s[:int(l)] for s, l in zip(_saliency_scores, valid_vid_lengths)]
         else:
             bsz, n_queries = outputs["pred_spans"].shape[:2]  # # (bsz, #queries, max_v_l *2)
             pred_spans_logits = outputs["pred_spans"].view(bsz, n_queries, 2, opt.max_v_l)
@@ -116,15 +157,10 @@ def compute_mr_results(model, eval_loader, opt, epoch_i=None, criterion=None, tb
             pred_spans[:, 1] += 1
             pred_spans *= opt.clip_length
 
-        # compose predictions
-        for idx, (meta, spans, score) in enumerate(zip(query_meta, pred_spans.cpu(), scores.cpu())):
-            if opt.span_loss_type == "l1":
-                spans = span_cxw_to_xx(spans) * meta["duration"]
-            # # (#queries, 3), [st(float), ed(float), score(float)]
-            cur_ranked_preds = torch.cat([spans, score[:, None]], dim=1).tolist()
-            if not opt.no_sort_results:
-                cur_ranked_preds = sorted(cur_ranked_preds, key=lambda x: x[2], reverse=True)
-            cur_ranked_preds = [[float(f"{e:.4f}") for e in row] for row in cur_ranked_preds]
+        # compose predictions, (bsz, #queries, 3), [st(float), ed(float), score(float)]
+        ranked_preds = decode_mr_predictions(
+            pred_spans, scores, post_processor=post_processor, sort_results=not opt.no_sort_results)
+        for idx, (meta, cur_ranked_preds) in enumerate(zip(query_meta, ranked_preds)):
             cur_query_pred = dict(
                 qid=meta["qid"],
                 query=meta["query"],
@@ -149,12 +185,6 @@ def compute_mr_results(model, eval_loader, opt, epoch_i=None, criterion=None, tb
         for k, v in loss_meters.items():
             tb_writer.add_scalar("Eval/{}".format(k), v.avg, epoch_i + 1)
 
-    post_processor = PostProcessorDETR(
-        clip_length=2, min_ts_val=0, max_ts_val=150,
-        min_w_l=2, max_w_l=150, move_window_method="left",
-        process_func_names=("clip_ts", "round_multiple")
-    )
-    mr_res = post_processor(mr_res)
     return mr_res, loss_meters
 
 
@@ -172,16 +202,35 @@ def eval_epoch(model, eval_dataset, opt, save_submission_filename, epoch_i=None,
     else:
         criterion = None
 
-    eval_loader = DataLoader(
-        eval_dataset,
-        collate_fn=start_end_collate,
-        batch_size=opt.eval_bsz,
-        num_workers=opt.num_workers,
-        shuffle=False,
-        pin_memory=opt.pin_memory
-    )
+    collate_fn, loader_pin_memory = build_collate_fn(opt.pin_memory, opt.num_workers)
+    if opt.length_bucket_size > 0:  # examples are sorted by length, the submission is put back in order below
+        lengths = eval_dataset.get_example_lengths()
+        batch_sampler = LengthBucketBatchSampler(lengths, opt.eval_bsz, shuffle=False)
+        batches = batch_sampler.get_batches()
+        logger.info("Padding efficiency (#valid tokens / #tokens) [video, query]: {}".format(
+            compute_padding_efficiency(lengths, batches).round(4).tolist()))
+        eval_loader = DataLoader(
+            eval_dataset,
+            collate_fn=collate_fn,
+            batch_sampler=batch_sampler,
+            num_workers=opt.num_workers,
+            pin_memory=loader_pin_memory
+        )
+    else:
+        batches = None
+        eval_loader = DataLoader(
+            eval_dataset,
+            collate_fn=collate_fn,
+            batch_size=opt.eval_bsz,
+            num_workers=opt.num_workers,
+            shuffle=False,
+            pin_memory=loader_pin_memory
+        )
 
     submission, eval_loss_meters = get_eval_res(model, eval_loader, opt, epoch_i, criterion, tb_writer)
+    if batches is not None:
+        example_indices = np.concatenate(batches)[:len(submission)]
+        submission = [submission[i] for i in np.argsort(example_indices, kind="stable")]
     if opt.no_sort_results:
         save_submission_filename = save_submission_filename.replace(".jsonl", "_unsorted.jsonl")
     metrics, metrics_nms, latest_file_paths = eval_epoch_post_processing(
@@ -217,14 +266,9 @@ def setup_model(opt):
     return model, criterion, optimizer, lr_scheduler
 
 
-def start_inference():
-    logger.info("Setup config, data and model...")
-    opt = TestOptions().parse()
-    cudnn.benchmark = True
-    cudnn.deterministic = False
-
+def build_eval_dataset(opt):
     assert opt.eval_path is not None
-    eval_dataset = StartEndDataset(
+    return StartEndDataset(
         dset_name=opt.dset_name,
         data_path=opt.eval_path,
         v_feat_dirs=opt.v_feat_dirs,
@@ -240,9 +284,19 @@ def start_inference():
         max_windows=opt.max_windows,
         load_labels=True,  # opt.eval_split_name == "val",
         span_loss_type=opt.span_loss_type,
-        txt_drop_ratio=0
+        txt_drop_ratio=0,
+        feat_backend=opt.feat_backend,
+        feat_cache_bytes=int(opt.feat_cache_gb * 1024 ** 3)
     )
 
+
+def start_inference():
+    logger.info("Setup config, data and model...")
+    opt = TestOptions().parse()
+    cudnn.benchmark = True
+    cudnn.deterministic = False
+
+    eval_dataset = build_eval_dataset(opt)
     model, criterion, _, _ = setup_model(opt)
     save_submission_filename = "inference_{}_{}_{}_preds.jsonl".format(
         opt.dset_name, opt.eval_split_name, opt.eval_id)
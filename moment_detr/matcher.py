@@ -2,10 +2,12 @@
 """
 Modules to compute the matching cost and solve the corresponding LSAP.
 """
+import numpy as np
 import torch
 from scipy.optimize import linear_sum_assignment
 from torch import nn
 import torch.nn.functional as F
+from torch.nn.utils.rnn import pad_sequence
 from moment_detr.span_utils import generalized_temporal_iou, span_cxw_to_xx
 
 
@@ -54,50 +56,104 @@ class HungarianMatcher(nn.Module):
             For each batch element, it holds:
                 len(index_i) = len(index_j) = min(num_queries, num_target_spans)
         """
-        bs, num_queries = outputs["pred_spans"].shape[:2]
+        return self.match_layers([outputs], targets)[0]
+
+    @torch.no_grad()
+    def match_layers(self, outputs_list, targets):
+        """ Performs the matching for the outputs of several decoder layers at once, e.g., the last layer and
+        the `aux_outputs`. The cost matrices of all layers and samples are computed in a single batched op,
+        padded to the max #spans in the batch, and moved to CPU once. The assignment problems with 1 or 2
+        target spans are solved exactly with vectorized brute force, the others with linear_sum_assignment.
+
+        Params:
+            outputs_list: list(dict), each dict is in the format of `outputs` in `forward`
+            targets: see `forward`
+
+        Returns:
+            A list of size len(outputs_list), each element is the output of `forward` for the same layer
+        """
         targets = targets["span_labels"]
+        n_layers = len(outputs_list)
+        bs, num_queries = outputs_list[0]["pred_spans"].shape[:2]
+        sizes = [len(v["spans"]) for v in targets]
+        max_size = max(sizes, default=0)
+        if max_size == 0:
+            empty = torch.zeros(0, dtype=torch.int64)
+            return [[(empty, empty) for _ in range(bs)] for _ in range(n_layers)]
 
-        # Also concat the target labels and spans
-        out_prob = outputs["pred_logits"].flatten(0, 1).softmax(-1)  # [batch_size * num_queries, num_classes]
-        tgt_spans = torch.cat([v["spans"] for v in targets])  # [num_target_spans in batch, 2]
-        tgt_ids = torch.full([len(tgt_spans)], self.foreground_label)   # [total #spans in the batch]
+        # costs are computed in float32 also for half precision outputs
+        # (#layers, bsz, #queries, #classes) and (#layers, bsz, #queries, 2 or max_v_l * 2)
+        out_prob = torch.stack([o["pred_logits"] for o in outputs_list]).float().softmax(-1)
+        out_spans = torch.stack([o["pred_spans"] for o in outputs_list]).float()
+        tgt_spans = pad_sequence([v["spans"] for v in targets], batch_first=True)  # (bsz, max #spans, 2)
 
         # Compute the classification cost. Contrary to the loss, we don't use the NLL,
         # but approximate it in 1 - prob[target class].
         # The 1 is a constant that doesn't change the matching, it can be omitted.
-        cost_class = -out_prob[:, tgt_ids]  # [batch_size * num_queries, total #spans in the batch]
+        cost_class = -out_prob[..., self.foreground_label, None]  # (#layers, bsz, #queries, 1)
 
         if self.span_loss_type == "l1":
-            # We flatten to compute the cost matrices in a batch
-            out_spans = outputs["pred_spans"].flatten(0, 1)  # [batch_size * num_queries, 2]
-
-            # Compute the L1 cost between spans
-            cost_span = torch.cdist(out_spans, tgt_spans, p=1)  # [batch_size * num_queries, total #spans in the batch]
+            # Compute the L1 cost between spans, (#layers, bsz, #queries, max #spans)
+            cost_span = (out_spans[..., :, None, :] - tgt_spans[:, None]).abs().sum(-1)
 
-            # Compute the giou cost between spans
-            # [batch_size * num_queries, total #spans in the batch]
+            # Compute the giou cost between spans, (#layers, bsz, #queries, max #spans)
             cost_giou = - generalized_temporal_iou(span_cxw_to_xx(out_spans), span_cxw_to_xx(tgt_spans))
         else:
-            pred_spans = outputs["pred_spans"]  # (bsz, #queries, max_v_l * 2)
-            pred_spans = pred_spans.view(bs * num_queries, 2, self.max_v_l).softmax(-1)  # (bsz * #queries, 2, max_v_l)
-            cost_span = - pred_spans[:, 0][:, tgt_spans[:, 0]] - \
-                pred_spans[:, 1][:, tgt_spans[:, 1]]  # (bsz * #queries, #spans)
-            # pred_spans = pred_spans.repeat(1, n_spans, 1, 1).flatten(0, 1)  # (bsz * #queries * #spans, max_v_l, 2)
-            # tgt_spans = tgt_spans.view(1, n_spans, 2).repeat(bs * num_queries, 1, 1).flatten(0, 1)  # (bsz * #queries * #spans, 2)
-            # cost_span = pred_spans[tgt_spans]
-            # cost_span = cost_span.view(bs * num_queries, n_spans)
+            pred_spans = out_spans.view(n_layers, bs, num_queries, 2, self.max_v_l).softmax(-1)
+            st_idx = tgt_spans[:, None, :, 0].expand(n_layers, bs, num_queries, max_size)
+            ed_idx = tgt_spans[:, None, :, 1].expand(n_layers, bs, num_queries, max_size)
+            cost_span = - pred_spans[..., 0, :].gather(-1, st_idx) - \
+                pred_spans[..., 1, :].gather(-1, ed_idx)  # (#layers, bsz, #queries, max #spans)
 
             # giou
             cost_giou = 0
 
         # Final cost matrix
-        # import ipdb; ipdb.set_trace()
         C = self.cost_span * cost_span + self.cost_giou * cost_giou + self.cost_class * cost_class
-        C = C.view(bs, num_queries, -1).cpu()
-
-        sizes = [len(v["spans"]) for v in targets]
-        indices = [linear_sum_assignment(c[i]) for i, c in enumerate(C.split(sizes, -1))]
-        return [(torch.as_tensor(i, dtype=torch.int64), torch.as_tensor(j, dtype=torch.int64)) for i, j in indices]
+        # the padded spans may give nan costs, e.g., giou with an empty span, they are never read
+        is_pad = torch.arange(max_size, device=C.device) >= torch.as_tensor(sizes, device=C.device)[:, None]
+        C = C.masked_fill(is_pad[:, None], 0).cpu().numpy()  # (#layers, bsz, #queries, max #spans)
+        assert np.isfinite(C).all(), "the matching costs contain nan/inf, check the model outputs"
+
+        indices = [[None] * bs for _ in range(n_layers)]
+        sizes = np.array(sizes)
+        for size in np.unique(sizes):
+            sample_ids = np.nonzero(sizes == size)[0]
+            costs = C[:, sample_ids, :, :size].reshape(n_layers * len(sample_ids), num_queries, size)
+            if size <= 2 and num_queries >= size:
+                src_ids, tgt_ids = solve_small_assignments(costs)
+            else:
+                src_ids, tgt_ids = zip(*[linear_sum_assignment(c) for c in costs])
+            for k, (i, j) in enumerate(zip(src_ids, tgt_ids)):
+                layer_idx, sample_idx = divmod(k, len(sample_ids))
+                indices[layer_idx][sample_ids[sample_idx]] = \
+                    (torch.as_tensor(i, dtype=torch.int64), torch.as_tensor(j, dtype=torch.int64))
+        return indices
+
+
+def solve_small_assignments(costs):
+    """ exact minimum cost assignments of many (#queries, n_targets) cost matrices with n_targets 1 or 2,
+    the same optimal cost as linear_sum_assignment on each matrix, but exact ties may be broken differently,
+    here towards the lowest query indices.
+    Args:
+        costs: np.ndarray, (N, #queries, n_targets)
+    Returns:
+        src_ids: np.ndarray, (N, n_targets), the selected queries, in ascending order
+        tgt_ids: np.ndarray, (N, n_targets), the target assigned to each selected query
+    """
+    n, num_queries, n_targets = costs.shape
+    if n_targets == 0:
+        return np.zeros((n, 0), dtype=np.int64), np.zeros((n, 0), dtype=np.int64)
+    if n_targets == 1:
+        src_ids = costs[..., 0].argmin(1)[:, None]  # argmin returns the first minimum
+        return src_ids, np.zeros_like(src_ids)
+    # all ordered pairs of distinct queries (q0, q1), q0 takes target 0 and q1 takes target 1
+    pair_costs = costs[:, :, None, 0] + costs[:, None, :, 1]  # (N, #queries, #queries)
+    pair_costs[:, np.arange(num_queries), np.arange(num_queries)] = np.inf
+    q0, q1 = np.divmod(pair_costs.reshape(n, -1).argmin(1), num_queries)
+    src_ids = np.sort(np.stack([q0, q1], axis=1), axis=1)
+    tgt_ids = (q0 > q1).astype(np.int64)[:, None] ^ np.array([[0, 1]])
+    return src_ids, tgt_ids
 
 
 def build_matcher(args):
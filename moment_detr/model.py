@@ -12,6 +12,7 @@ from moment_detr.matcher import build_matcher
 from moment_detr.transformer import build_transformer
 from moment_detr.position_encoding import build_position_encoding
 from moment_detr.misc import accuracy
+from utils.model_utils import cast_to_float
 
 
 class MomentDETR(nn.Module):
@@ -85,6 +86,9 @@ class MomentDETR(nn.Module):
                - src_vid: [batch_size, L_vid, D_vid]
                - src_vid_mask: [batch_size, L_vid], containing 0 on padded pixels,
                     will convert to 1 as padding later for transformer
+            src_vid and src_vid_mask may also have batch_size 1 while src_txt has batch_size N, i.e., N queries
+            for the same video. The video input projection and position embedding are then computed once
+            and broadcast to all queries instead of being computed for N identical copies.
 
             It returns a dict with the following elements:
                - "pred_spans": The normalized boxes coordinates for all queries, represented as
@@ -96,10 +100,14 @@ class MomentDETR(nn.Module):
         """
         src_vid = self.input_vid_proj(src_vid)
         src_txt = self.input_txt_proj(src_txt)
-        src = torch.cat([src_vid, src_txt], dim=1)  # (bsz, L_vid+L_txt, d)
-        mask = torch.cat([src_vid_mask, src_txt_mask], dim=1).bool()  # (bsz, L_vid+L_txt)
         # TODO should we remove or use different positional embeddings to the src_txt?
         pos_vid = self.position_embed(src_vid, src_vid_mask)  # (bsz, L_vid, d)
+        bsz = src_txt.shape[0]
+        if src_vid.shape[0] != bsz:  # a single video shared by all queries, broadcast w/o copying
+            assert src_vid.shape[0] == 1, "src_vid must have the same batch_size as src_txt, or 1"
+            src_vid, src_vid_mask, pos_vid = [e.expand(bsz, *e.shape[1:]) for e in [src_vid, src_vid_mask, pos_vid]]
+        src = torch.cat([src_vid, src_txt], dim=1)  # (bsz, L_vid+L_txt, d)
+        mask = torch.cat([src_vid_mask, src_txt_mask], dim=1).bool()  # (bsz, L_vid+L_txt)
         pos_txt = self.txt_position_embed(src_txt) if self.use_txt_pos else torch.zeros_like(src_txt)  # (bsz, L_txt, d)
         # pos_txt = torch.zeros_like(src_txt)
         # pad zeros for txt positions
@@ -182,16 +190,16 @@ class SetCriterion(nn.Module):
         empty_weight[-1] = self.eos_coef  # lower weight for background (index 1, foreground index 0)
         self.register_buffer('empty_weight', empty_weight)
 
-    def loss_spans(self, outputs, targets, indices):
+    def loss_spans(self, outputs, targets, matched):
         """Compute the losses related to the bounding boxes, the L1 regression loss and the GIoU loss
            targets dicts must contain the key "spans" containing a tensor of dim [nb_tgt_spans, 2]
            The target spans are expected in format (center_x, w), normalized by the image size.
         """
         assert 'pred_spans' in outputs
-        targets = targets["span_labels"]
-        idx = self._get_src_permutation_idx(indices)
-        src_spans = outputs['pred_spans'][idx]  # (#spans, max_v_l * 2)
-        tgt_spans = torch.cat([t['spans'][i] for t, (_, i) in zip(targets, indices)], dim=0)  # (#spans, 2)
+        batch_idx, src_idx, tgt_idx = matched
+        src_spans = outputs['pred_spans'][batch_idx, src_idx]  # (#spans, max_v_l * 2)
+        # (#spans, 2), the target spans of all samples are flattened once per step, see `_flatten_targets`
+        tgt_spans = targets["span_labels_flat"][targets["span_labels_offsets"][batch_idx] + tgt_idx]
         if self.span_loss_type == "l1":
             loss_span = F.l1_loss(src_spans, tgt_spans, reduction='none')
             loss_giou = 1 - torch.diag(generalized_temporal_iou(span_cxw_to_xx(src_spans), span_cxw_to_xx(tgt_spans)))
@@ -214,7 +222,7 @@ class SetCriterion(nn.Module):
         losses['loss_giou'] = loss_giou.mean()
         return losses
 
-    def loss_labels(self, outputs, targets, indices, log=True):
+    def loss_labels(self, outputs, targets, matched, log=True):
         """Classification loss (NLL)
         targets dicts must contain the key "labels" containing a tensor of dim [nb_target_boxes]
         """
@@ -222,7 +230,7 @@ class SetCriterion(nn.Module):
         assert 'pred_logits' in outputs
         src_logits = outputs['pred_logits']  # (batch_size, #queries, #classes=2)
         # idx is a tuple of two 1D tensors (batch_idx, src_idx), of the same length == #objects in batch
-        idx = self._get_src_permutation_idx(indices)
+        idx = matched[:2]
         target_classes = torch.full(src_logits.shape[:2], self.background_label,
                                     dtype=torch.int64, device=src_logits.device)  # (batch_size, #queries)
         target_classes[idx] = self.foreground_label
@@ -235,7 +243,7 @@ class SetCriterion(nn.Module):
             losses['class_error'] = 100 - accuracy(src_logits[idx], self.foreground_label)[0]
         return losses
 
-    def loss_saliency(self, outputs, targets, indices, log=True):
+    def loss_saliency(self, outputs, targets, matched, log=True):
         """higher scores for positive clips"""
         if "saliency_pos_labels" not in targets:
             return {"loss_saliency": 0}
@@ -243,23 +251,20 @@ class SetCriterion(nn.Module):
         pos_indices = targets["saliency_pos_labels"]  # (N, #pairs)
         neg_indices = targets["saliency_neg_labels"]  # (N, #pairs)
         num_pairs = pos_indices.shape[1]  # typically 2 or 4
-        batch_indices = torch.arange(len(saliency_scores)).to(saliency_scores.device)
-        pos_scores = torch.stack(
-            [saliency_scores[batch_indices, pos_indices[:, col_idx]] for col_idx in range(num_pairs)], dim=1)
-        neg_scores = torch.stack(
-            [saliency_scores[batch_indices, neg_indices[:, col_idx]] for col_idx in range(num_pairs)], dim=1)
+        pos_scores = saliency_scores.gather(1, pos_indices)  # (N, #pairs)
+        neg_scores = saliency_scores.gather(1, neg_indices)  # (N, #pairs)
         loss_saliency = torch.clamp(self.saliency_margin + neg_scores - pos_scores, min=0).sum() \
             / (len(pos_scores) * num_pairs) * 2  # * 2 to keep the loss the same scale
         return {"loss_saliency": loss_saliency}
 
-    def loss_contrastive_align(self, outputs, targets, indices, log=True):
+    def loss_contrastive_align(self, outputs, targets, matched, log=True):
         """encourage higher scores between matched query span and input text"""
         normalized_text_embed = outputs["proj_txt_mem"]  # (bsz, #tokens, d)  text tokens
         normalized_img_embed = outputs["proj_queries"]  # (bsz, #queries, d)
         logits = torch.einsum(
             "bmd,bnd->bmn", normalized_img_embed, normalized_text_embed)  # (bsz, #queries, #tokens)
         logits = logits.sum(2) / self.temperature  # (bsz, #queries)
-        idx = self._get_src_permutation_idx(indices)
+        idx = matched[:2]
         positive_map = torch.zeros_like(logits, dtype=torch.bool)
         positive_map[idx] = True
         positive_logits = logits.masked_fill(~positive_map, 0)
@@ -271,7 +276,7 @@ class SetCriterion(nn.Module):
         losses = {"loss_contrastive_align": loss_nce.mean()}
         return losses
 
-    def loss_contrastive_align_vid_txt(self, outputs, targets, indices, log=True):
+    def loss_contrastive_align_vid_txt(self, outputs, targets, matched, log=True):
         """encourage higher scores between matched query span and input text"""
         # TODO (1)  align vid_mem and txt_mem;
         # TODO (2) change L1 loss as CE loss on 75 labels, similar to soft token prediction in MDETR
@@ -280,7 +285,7 @@ class SetCriterion(nn.Module):
         logits = torch.einsum(
             "bmd,bnd->bmn", normalized_img_embed, normalized_text_embed)  # (bsz, #queries, #tokens)
         logits = logits.sum(2) / self.temperature  # (bsz, #queries)
-        idx = self._get_src_permutation_idx(indices)
+        idx = matched[:2]
         positive_map = torch.zeros_like(logits, dtype=torch.bool)
         positive_map[idx] = True
         positive_logits = logits.masked_fill(~positive_map, 0)
@@ -292,19 +297,33 @@ class SetCriterion(nn.Module):
         losses = {"loss_contrastive_align": loss_nce.mean()}
         return losses
 
-    def _get_src_permutation_idx(self, indices):
-        # permute predictions following indices
-        batch_idx = torch.cat([torch.full_like(src, i) for i, (src, _) in enumerate(indices)])
-        src_idx = torch.cat([src for (src, _) in indices])
-        return batch_idx, src_idx  # two 1D tensors of the same length
-
-    def _get_tgt_permutation_idx(self, indices):
-        # permute targets following indices
-        batch_idx = torch.cat([torch.full_like(tgt, i) for i, (_, tgt) in enumerate(indices)])
-        tgt_idx = torch.cat([tgt for (_, tgt) in indices])
-        return batch_idx, tgt_idx
-
-    def get_loss(self, loss, outputs, targets, indices, **kwargs):
+    @staticmethod
+    def _get_permutation_idx(layer_indices, device):
+        """ permute predictions and targets following the matcher outputs of all layers, computed at once
+        Args:
+            layer_indices: list(list(tuple)), the output of `matcher.match_layers`
+        Returns:
+            list(tuple(batch_idx, src_idx, tgt_idx)) for each layer, three 1D tensors of the same
+            length == #matched spans in batch, which is the same for all layers
+        """
+        # each sample matches min(#queries, #spans) predictions in every layer
+        sizes = torch.as_tensor([len(src) for (src, _) in layer_indices[0]])
+        batch_idx = torch.repeat_interleave(torch.arange(len(sizes)), sizes).to(device)
+        shape = (len(layer_indices), len(batch_idx))
+        src_idx = torch.cat([src for indices in layer_indices for (src, _) in indices]).view(shape).to(device)
+        tgt_idx = torch.cat([tgt for indices in layer_indices for (_, tgt) in indices]).view(shape).to(device)
+        return [(batch_idx, src, tgt) for src, tgt in zip(src_idx, tgt_idx)]
+
+    @staticmethod
+    def _flatten_targets(targets):
+        """adds the spans of all samples flattened into one tensor, and the offset of each sample in it"""
+        spans = [t["spans"] for t in targets["span_labels"]]
+        span_labels_flat = torch.cat(spans)  # (#spans in batch, 2)
+        n_spans = torch.as_tensor([len(e) for e in spans], device=span_labels_flat.device)
+        span_labels_offsets = torch.cumsum(n_spans, 0) - n_spans  # (bsz, )
+        return dict(targets, span_labels_flat=span_labels_flat, span_labels_offsets=span_labels_offsets)
+
+    def get_loss(self, loss, outputs, targets, matched, **kwargs):
         loss_map = {
             "spans": self.loss_spans,
             "labels": self.loss_labels,
@@ -312,7 +331,7 @@ class SetCriterion(nn.Module):
             "saliency": self.loss_saliency,
         }
         assert loss in loss_map, f'do you really want to compute {loss} loss?'
-        return loss_map[loss](outputs, targets, indices, **kwargs)
+        return loss_map[loss](outputs, targets, matched, **kwargs)
 
     def forward(self, outputs, targets):
         """ This performs the loss computation.
@@ -320,27 +339,36 @@ class SetCriterion(nn.Module):
              outputs: dict of tensors, see the output specification of the model for the format
              targets: list of dicts, such that len(targets) == batch_size.
                       The expected keys in each dict depends on the losses applied, see each loss' doc
+        The losses are always computed in float32, also for outputs produced under autocast.
         """
+        with torch.autocast(device_type=outputs["pred_logits"].device.type, enabled=False):
+            return self._forward(cast_to_float(outputs), targets)
+
+    def _forward(self, outputs, targets):
         outputs_without_aux = {k: v for k, v in outputs.items() if k != 'aux_outputs'}
 
-        # Retrieve the matching between the outputs of the last layer and the targets
-        # list(tuples), each tuple is (pred_span_indices, tgt_span_indices)
-        indices = self.matcher(outputs_without_aux, targets)
+        # Retrieve the matching between the outputs of the last layer (and of each intermediate layer) and the
+        # targets, in one batched call. list(list(tuples)), each tuple is (pred_span_indices, tgt_span_indices)
+        layer_indices = self.matcher.match_layers([outputs_without_aux] + outputs.get('aux_outputs', []), targets)
+        device = outputs["pred_logits"].device
+        layer_matched = self._get_permutation_idx(layer_indices, device)
+        matched = layer_matched[0]
+        targets = self._flatten_targets(targets)
 
         # Compute all the requested losses
         losses = {}
         for loss in self.losses:
-            losses.update(self.get_loss(loss, outputs, targets, indices))
+            losses.update(self.get_loss(loss, outputs, targets, matched))
 
         # In case of auxiliary losses, we repeat this process with the output of each intermediate layer.
         if 'aux_outputs' in outputs:
             for i, aux_outputs in enumerate(outputs['aux_outputs']):
-                indices = self.matcher(aux_outputs, targets)
+                matched = layer_matched[i + 1]
                 for loss in self.losses:
                     if "saliency" == loss:  # skip as it is only in the top layer
                         continue
                     kwargs = {}
-                    l_dict = self.get_loss(loss, aux_outputs, targets, indices, **kwargs)
+                    l_dict = self.get_loss(loss, aux_outputs, targets, matched, **kwargs)
                     l_dict = {k + f'_{i}': v for k, v in l_dict.items()}
                     losses.update(l_dict)
 
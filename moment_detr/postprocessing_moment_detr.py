@@ -6,6 +6,13 @@ from standalone_eval.eval import eval_submission
 from tqdm import tqdm
 
 
+def round_to_decimals(x, n_decimals=4):
+    """ x: float64 torch.Tensor. Vectorized `float(f"{e:.4f}")`, exact for float32 inputs, as their
+    products with 10 ** n_decimals (n_decimals <= 4) are exactly representable in float64."""
+    scale = 10 ** n_decimals
+    return torch.round(x * scale) / scale
+
+
 class PostProcessorDETR:
     def __init__(self, clip_length=2, min_ts_val=0, max_ts_val=150,
                  min_w_l=2, max_w_l=70, move_window_method="center",
@@ -23,7 +30,13 @@ class PostProcessorDETR:
             clip_window_l=self.clip_window_lengths
         )
 
-    def __call__(self, lines):
+    def __call__(self, lines, batch_mode=True):
+        """
+        lines: list(dict), each dict has `pred_relevant_windows`, list([st, ed, score]), processed in place.
+        batch_mode: bool, process all lines at once with `process_batch`, otherwise line by line.
+        """
+        if batch_mode:
+            return self.process_batch(lines)
         processed_lines = []
         for line in tqdm(lines, desc=f"convert to multiples of clip_length={self.clip_length}"):
             windows_and_scores = torch.tensor(line["pred_relevant_windows"])
@@ -36,6 +49,45 @@ class PostProcessorDETR:
             processed_lines.append(line)
         return processed_lines
 
+    def process_batch(self, lines, return_arrays=False):
+        """ The same as processing each line separately, but the windows of all lines are stacked into
+        a single zero-padded (N, max(#windows), 3) tensor and processed in a single pass.
+        Args:
+            lines: list(dict), each dict has `pred_relevant_windows`, list([st, ed, score])
+            return_arrays: bool, return the arrays instead of updating the lines
+        Returns:
+            lines, with `pred_relevant_windows` replaced by the processed windows, or
+            (windows_and_scores, mask) if return_arrays, np.ndarray of shape (N, max(#windows), 3) and
+                bool np.ndarray (N, max(#windows)), True for the windows that are not paddings.
+        """
+        n_windows = np.array([len(line["pred_relevant_windows"]) for line in lines], dtype=np.int64)
+        max_n_windows = int(n_windows.max(initial=0))
+        if np.all(n_windows == max_n_windows):
+            windows_and_scores = np.array([line["pred_relevant_windows"] for line in lines], dtype=np.float32)
+        else:
+            windows_and_scores = np.zeros((len(lines), max_n_windows, 3), dtype=np.float32)
+            for idx, line in enumerate(lines):
+                windows_and_scores[idx, :n_windows[idx]] = line["pred_relevant_windows"]
+        windows_and_scores = torch.from_numpy(windows_and_scores.reshape(len(lines), max_n_windows, 3))
+        windows = self.process_windows(windows_and_scores[..., :2].clone())
+        scores = round_to_decimals(windows_and_scores[..., 2].double())
+        windows_and_scores = torch.cat([windows.double(), scores[..., None]], dim=2)
+        mask = np.arange(max_n_windows)[None] < n_windows[:, None]
+        if return_arrays:
+            return windows_and_scores.numpy(), mask
+
+        for line, cur_windows_and_scores, cur_n_windows in zip(lines, windows_and_scores.tolist(), n_windows):
+            line["pred_relevant_windows"] = cur_windows_and_scores[:cur_n_windows]
+        return lines
+
+    def process_windows(self, windows):
+        """
+        windows: (..., 2)  torch.Tensor, e.g., (bsz, #queries, 2), all process funcs are applied at once
+        """
+        for func_name in self.process_func_names:
+            windows = self.name2func[func_name](windows)
+        return windows
+
     def clip_min_max_timestamps(self, windows):
         """
         windows: (#windows, 2)  torch.Tensor
@@ -52,10 +104,10 @@ class PostProcessorDETR:
 
     def clip_window_lengths(self, windows):
         """
-        windows: (#windows, 2)  np.ndarray
+        windows: (#windows, 2) or (..., 2)  torch.Tensor
         ensure the final window duration are within [self.min_w_l, self.max_w_l]
         """
-        window_lengths = windows[:, 1] - windows[:, 0]
+        window_lengths = windows[..., 1] - windows[..., 0]
         small_rows = window_lengths < self.min_w_l
         if torch.sum(small_rows) > 0:
             windows = self.move_windows(
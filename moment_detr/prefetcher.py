@@ -0,0 +1,96 @@
+"""
+Asynchronous host-to-device prefetching.
+
+`DevicePrefetcher` wraps a DataLoader built with a start_end collate function. A background thread
+fetches batch N+1 from the loader and calls `prepare_batch_inputs` on it while batch N is computed.
+On CUDA the copies are issued on a side stream, the main stream waits for them only when the batch is used.
+The event recorded after the copies is also handed to the collator, see `StartEndCollator.record_copy_event`,
+so that its pinned buffers are not overwritten by a later batch while the copies are in flight.
+Each yielded batch is `(batch_meta, batched_model_inputs, (model_inputs, targets))`, where the last element
+holds the inputs already moved to the device.
+"""
+import time
+from contextlib import nullcontext
+
+import torch
+
+from moment_detr.start_end_dataset import StartEndCollator, prepare_batch_inputs, record_copy_event
+from utils.thread_utils import iter_in_background
+
+
+def _record_stream(obj, stream):
+    """mark device tensors in (nested) dict/list as used by `stream`, so their memory is not reused early"""
+    if isinstance(obj, torch.Tensor):
+        if obj.is_cuda:
+            obj.record_stream(stream)
+    elif isinstance(obj, dict):
+        for v in obj.values():
+            _record_stream(v, stream)
+    elif isinstance(obj, (list, tuple)):
+        for v in obj:
+            _record_stream(v, stream)
+
+
+class DevicePrefetcher(object):
+    """
+    Args:
+        loader: DataLoader
+        device: torch.device
+        non_blocking: bool, use non_blocking copies, effective with pinned memory
+        time_meters: defaultdict(AverageMeter), if given, the time spent by the background thread is
+            recorded as `prefetch_dataloading_time` and `prefetch_prepare_inputs_time`, this is the time
+            that is overlapped with the computation of the previous batch.
+        n_prefetch: int, max #batches that are prepared ahead.
+    """
+
+    def __init__(self, loader, device, non_blocking=True, time_meters=None, n_prefetch=1):
+        self.loader = loader
+        self.device = device
+        self.non_blocking = non_blocking
+        self.time_meters = time_meters
+        self.n_prefetch = n_prefetch
+        self.use_cuda = device.type == "cuda"
+        # the yielded batch, the n_prefetch queued ones and the one being collated all hold pinned buffers
+        collate_fn = getattr(loader, "collate_fn", None)
+        if isinstance(collate_fn, StartEndCollator) and collate_fn.pin_memory:
+            assert n_prefetch + 2 <= collate_fn.n_buffers, \
+                f"n_prefetch={n_prefetch} needs a collator with at least {n_prefetch + 2} buffers"
+
+    def __len__(self):
+        return len(self.loader)
+
+    @property
+    def dataset(self):
+        return self.loader.dataset
+
+    def _update_meter(self, name, value):
+        if self.time_meters is not None:
+            self.time_meters[name].update(value)
+
+    def _prepare_batches(self):
+        """runs in the background thread, see `iter_in_background`"""
+        stream = torch.cuda.Stream(self.device) if self.use_cuda else None
+        timer_dataloading = time.time()
+        for batch in self.loader:
+            self._update_meter("prefetch_dataloading_time", time.time() - timer_dataloading)
+            timer_start = time.time()
+            with torch.cuda.stream(stream) if stream is not None else nullcontext():
+                model_inputs, targets = prepare_batch_inputs(
+                    batch[1], self.device, non_blocking=self.non_blocking)
+                event = torch.cuda.Event() if stream is not None else None
+                if event is not None:
+                    event.record(stream)
+                    # the collator reuses the pinned buffers of this batch only after these copies are done
+                    record_copy_event(self.loader, event)
+            self._update_meter("prefetch_prepare_inputs_time", time.time() - timer_start)
+            yield batch, model_inputs, targets, event
+            timer_dataloading = time.time()
+
+    def __iter__(self):
+        for batch, model_inputs, targets, event in iter_in_background(
+                self._prepare_batches(), max_prefetch=self.n_prefetch):
+            if event is not None:  # wait for the copies only now, on the compute stream
+                current_stream = torch.cuda.current_stream(self.device)
+                current_stream.wait_event(event)
+                _record_stream((model_inputs, targets), current_stream)
+            yield batch[0], batch[1], (model_inputs, targets)
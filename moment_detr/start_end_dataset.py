@@ -4,10 +4,13 @@ import numpy as np
 from tqdm import tqdm
 import random
 import logging
+from functools import partial
 from os.path import join, exists
 from utils.basic_utils import load_jsonl, l2_normalize_np_array
 from utils.tensor_utils import pad_sequences_1d
 from moment_detr.span_utils import span_xx_to_cxw
+from moment_detr.feature_store import PackedFeatureStore
+from moment_detr.feature_cache import SharedFeatureCache
 
 logger = logging.getLogger(__name__)
 
@@ -29,7 +32,8 @@ class StartEndDataset(Dataset):
                  q_feat_type="last_hidden_state",
                  max_q_l=32, max_v_l=75, data_ratio=1.0, ctx_mode="video",
                  normalize_v=True, normalize_t=True, load_labels=True,
-                 clip_len=2, max_windows=5, span_loss_type="l1", txt_drop_ratio=0):
+                 clip_len=2, max_windows=5, span_loss_type="l1", txt_drop_ratio=0,
+                 feat_backend="npz", feat_cache_bytes=0, feat_cache=None):
         self.dset_name = dset_name
         self.data_path = data_path
         self.data_ratio = data_ratio
@@ -49,15 +53,34 @@ class StartEndDataset(Dataset):
         self.max_windows = max_windows  # maximum number of windows to use as labels
         self.span_loss_type = span_loss_type
         self.txt_drop_ratio = txt_drop_ratio
+        self.feat_backend = feat_backend
         if "val" in data_path or "test" in data_path:
             assert txt_drop_ratio == 0
 
         # checks
         assert q_feat_type in self.Q_FEAT_TYPES
+        assert feat_backend in ["npz", "packed"]
 
         # data
         self.data = self.load_data()
 
+        # packed features, see moment_detr/feature_store.py
+        if feat_backend == "packed":
+            self.q_feat_store = PackedFeatureStore(q_feat_dir, q_feat_type)
+            self.v_feat_stores = [PackedFeatureStore(e, "features") for e in self.v_feat_dirs]
+            assert all(normalize_v or not e.normalized for e in self.v_feat_stores) \
+                and (normalize_t or not self.q_feat_store.normalized), \
+                "packed features are l2-normalized, re-pack them with --no_norm to disable normalization"
+
+        # shared in-RAM cache of the loaded (and normalized) features, 0 to disable.
+        # pass `feat_cache` to share one cache (and its byte budget) between several datasets
+        if feat_cache is None and feat_cache_bytes > 0:
+            feat_cache = SharedFeatureCache(feat_cache_bytes)
+        self.feat_cache = feat_cache
+        # the cache keys include every setting that changes the loaded arrays, as the cache may be shared
+        self.q_cache_prefix = f"q/{q_feat_dir}/{q_feat_type}/{max_q_l}/{normalize_t}/{feat_backend}"
+        self.v_cache_prefix = f"v/{'|'.join(self.v_feat_dirs)}/{max_v_l}/{normalize_v}/{feat_backend}"
+
     def load_data(self):
         datalist = load_jsonl(self.data_path)
         if self.data_ratio != 1:
@@ -70,6 +93,30 @@ class StartEndDataset(Dataset):
     def __len__(self):
         return len(self.data)
 
+    def get_example_lengths(self):
+        """(ctx_l, query_len) of each example, used to bucket examples of similar lengths.
+        Exact for packed features, otherwise estimated from the meta data without loading the features,
+        i.e., #clips in the video, and #words in the query plus the start and end tokens.
+        Returns:
+            np.ndarray, (N, 2)
+        """
+        lengths = np.zeros((len(self.data), 2), dtype=np.int64)
+        for idx, meta in enumerate(self.data):
+            if not self.use_video:
+                ctx_l = self.max_v_l
+            elif self.feat_backend == "packed":
+                ctx_l = min(_store.index[meta["vid"]][1] for _store in self.v_feat_stores)
+            else:
+                ctx_l = int(meta["duration"] / self.clip_len)
+            if self.q_feat_type == "pooler_output":
+                query_len = 1
+            elif self.feat_backend == "packed":
+                query_len = self.q_feat_store.index[f"qid{meta['qid']}"][1]
+            else:
+                query_len = len(meta["query"].split()) + 2
+            lengths[idx] = min(ctx_l, self.max_v_l), min(query_len, self.max_q_l)
+        return lengths
+
     def __getitem__(self, index):
         meta = self.data[index]
 
@@ -172,15 +219,28 @@ class StartEndDataset(Dataset):
         return windows
 
     def _get_query_feat_by_qid(self, qid):
+        if self.feat_cache is not None:
+            q_feat = self.feat_cache.get(f"{self.q_cache_prefix}/{qid}", partial(self._load_query_feat_by_qid, qid))
+        else:
+            q_feat = self._load_query_feat_by_qid(qid)
+        if self.txt_drop_ratio > 0:
+            q_feat = self.random_drop_rows(q_feat)
+        return torch.from_numpy(q_feat)  # (D, ) or (Lq, D)
+
+    def _load_query_feat_by_qid(self, qid):
+        max_q_l = self.max_q_l if self.q_feat_type == "last_hidden_state" else None
+        if self.feat_backend == "packed":
+            q_feat = np.array(self.q_feat_store.get(f"qid{qid}", max_l=max_q_l), dtype=np.float32)  # copy
+            if self.normalize_t and not self.q_feat_store.normalized:
+                q_feat = l2_normalize_np_array(q_feat)
+            return q_feat
         q_feat_path = join(self.q_feat_dir, f"qid{qid}.npz")
         q_feat = np.load(q_feat_path)[self.q_feat_type].astype(np.float32)
-        if self.q_feat_type == "last_hidden_state":
-            q_feat = q_feat[:self.max_q_l]
+        if max_q_l is not None:
+            q_feat = q_feat[:max_q_l]
         if self.normalize_t:
             q_feat = l2_normalize_np_array(q_feat)
-        if self.txt_drop_ratio > 0:
-            q_feat = self.random_drop_rows(q_feat)
-        return torch.from_numpy(q_feat)  # (D, ) or (Lq, D)
+        return q_feat
 
     def random_drop_rows(self, embeddings):
         """randomly mask num_drop rows in embeddings to be zero.
@@ -195,18 +255,31 @@ class StartEndDataset(Dataset):
         return embeddings
 
     def _get_video_feat_by_vid(self, vid):
+        if self.feat_cache is not None:  # queries of the same video share one entry
+            v_feat = self.feat_cache.get(f"{self.v_cache_prefix}/{vid}", partial(self._load_video_feat_by_vid, vid))
+        else:
+            v_feat = self._load_video_feat_by_vid(vid)
+        return torch.from_numpy(v_feat)  # (Lv, D)
+
+    def _load_video_feat_by_vid(self, vid):
         v_feat_list = []
-        for _feat_dir in self.v_feat_dirs:
-            _feat_path = join(_feat_dir, f"{vid}.npz")
-            _feat = np.load(_feat_path)["features"][:self.max_v_l].astype(np.float32)
-            if self.normalize_v:
-                _feat = l2_normalize_np_array(_feat)
-            v_feat_list.append(_feat)
+        if self.feat_backend == "packed":
+            for _store in self.v_feat_stores:
+                _feat = _store.get(vid, max_l=self.max_v_l)  # zero-copy view
+                if self.normalize_v and not _store.normalized:
+                    _feat = l2_normalize_np_array(_feat.astype(np.float32))
+                v_feat_list.append(_feat)
+        else:
+            for _feat_dir in self.v_feat_dirs:
+                _feat_path = join(_feat_dir, f"{vid}.npz")
+                _feat = np.load(_feat_path)["features"][:self.max_v_l].astype(np.float32)
+                if self.normalize_v:
+                    _feat = l2_normalize_np_array(_feat)
+                v_feat_list.append(_feat)
         # some features are slightly longer than the others
         min_len = min([len(e) for e in v_feat_list])
         v_feat_list = [e[:min_len] for e in v_feat_list]
-        v_feat = np.concatenate(v_feat_list, axis=1)
-        return torch.from_numpy(v_feat)  # (Lv, D)
+        return np.concatenate(v_feat_list, axis=1).astype(np.float32, copy=False)  # (Lv, D)
 
 
 def start_end_collate(batch):
@@ -226,6 +299,104 @@ def start_end_collate(batch):
     return batch_meta, batched_data
 
 
+class StartEndCollator(object):
+    """Same outputs as start_end_collate, but each padded batch is written directly into a buffer, and the
+    masks are built from the lengths with a single broadcasted comparison.
+    With pin_memory=True the buffers are page-locked and reused, in a ring of `n_buffers` batches, so that
+    batches are neither allocated nor copied again by the DataLoader for pinning. This is only valid when
+    collating in the main process, i.e., DataLoader(num_workers=0, pin_memory=False), and when at most
+    `n_buffers` - 1 earlier batches are still in use on the host.
+    Async host-to-device copies from the buffers are tracked with `record_copy_event`, which must be called
+    once the copies of a batch are issued: a buffer is only overwritten after the copies from it are done.
+    Otherwise, use pin_memory=False, which allocates new (un-pinned) tensors for each batch.
+
+    Args:
+        pin_memory: bool
+        n_buffers: int, #batches after which a buffer is reused
+    """
+
+    def __init__(self, pin_memory=False, n_buffers=3):
+        self.pin_memory = pin_memory
+        self.n_buffers = n_buffers
+        self.n_batches = 0
+        self.slot = 0  # ring slot of the batch being collated
+        self.buffers = {}  # (name, slot) -> flat tensor, grown when a larger batch comes
+        self.copy_events = {}  # slot -> torch.cuda.Event, recorded after the copies from the slot were issued
+
+    def record_copy_event(self, event=None):
+        """ mark the buffers of the last collated batch as in use until `event` completes
+        Args:
+            event: torch.cuda.Event, recorded after the host-to-device copies of the batch were issued,
+                by default an event is recorded on the current stream
+        """
+        if not self.pin_memory or self.n_batches == 0:
+            return
+        if event is None:
+            event = torch.cuda.Event()
+            event.record()
+        self.copy_events[(self.n_batches - 1) % self.n_buffers] = event
+
+    def _get_buffer(self, name, shape, dtype):
+        if not self.pin_memory:
+            return torch.empty(shape, dtype=dtype)
+        key = (name, self.slot)
+        numel = int(np.prod(shape))
+        buffer = self.buffers.get(key)
+        if buffer is None or buffer.numel() < numel or buffer.dtype != dtype:
+            buffer = torch.empty(numel, dtype=dtype, pin_memory=True)
+            self.buffers[key] = buffer
+        return buffer[:numel].view(shape)
+
+    def pad_sequences(self, name, sequences):
+        """ sequences: list(torch.Tensor), each of shape (L_i, ...), returns (padded_seqs, mask)"""
+        lengths = torch.tensor([len(seq) for seq in sequences], dtype=torch.long)
+        max_length = int(lengths.max())
+        padded_seqs = self._get_buffer(name, (len(sequences), max_length) + sequences[0].shape[1:], torch.float32)
+        for idx, seq in enumerate(sequences):
+            padded_seqs[idx, :len(seq)] = seq
+            padded_seqs[idx, len(seq):] = 0
+        mask = self._get_buffer(name + "_mask", (len(sequences), max_length), torch.float32)
+        mask.copy_(torch.arange(max_length)[None] < lengths[:, None])
+        return padded_seqs, mask
+
+    def __call__(self, batch):
+        self.slot = self.n_batches % self.n_buffers
+        event = self.copy_events.pop(self.slot, None)
+        if event is not None:  # the copies from this slot, n_buffers batches ago, may still be in flight
+            event.synchronize()
+        batch_meta = [e["meta"] for e in batch]
+        model_inputs_keys = batch[0]["model_inputs"].keys()
+        batched_data = dict()
+        for k in model_inputs_keys:
+            if k == "span_labels":
+                batched_data[k] = [dict(spans=e["model_inputs"]["span_labels"]) for e in batch]
+                continue
+            if k in ["saliency_pos_labels", "saliency_neg_labels"]:
+                labels = torch.from_numpy(np.array([e["model_inputs"][k] for e in batch], dtype=np.int64))
+                batched_data[k] = self._get_buffer(k, labels.shape, torch.long).copy_(labels)
+                continue
+            batched_data[k] = self.pad_sequences(k, [e["model_inputs"][k] for e in batch])
+        self.n_batches += 1
+        return batch_meta, batched_data
+
+
+def build_collate_fn(pin_memory, num_workers):
+    """ Returns (collate_fn, pin_memory for the DataLoader).
+    When collating in the main process, batches are written into reusable pinned buffers directly,
+    so that the DataLoader does not need to copy them again for pinning.
+    """
+    pinned_collate = pin_memory and num_workers == 0 and torch.cuda.is_available()
+    return StartEndCollator(pin_memory=pinned_collate), pin_memory and not pinned_collate
+
+
+def record_copy_event(loader, event=None):
+    """call once the host-to-device copies of the last batch of `loader` are issued, so that the pinned
+    buffers of a StartEndCollator are not overwritten before these copies are done, see StartEndCollator"""
+    collate_fn = getattr(loader, "collate_fn", None)
+    if isinstance(collate_fn, StartEndCollator):
+        collate_fn.record_copy_event(event)
+
+
 def prepare_batch_inputs(batched_model_inputs, device, non_blocking=False):
     model_inputs = dict(
         src_txt=batched_model_inputs["query_feat"][0].to(device, non_blocking=non_blocking),
@@ -15,10 +15,13 @@ from torch.utils.tensorboard import SummaryWriter
 
 from moment_detr.config import BaseOptions
 from moment_detr.start_end_dataset import \
-    StartEndDataset, start_end_collate, prepare_batch_inputs
+    StartEndDataset, build_collate_fn, prepare_batch_inputs, record_copy_event
+from moment_detr.bucket_sampler import LengthBucketBatchSampler
+from moment_detr.prefetcher import DevicePrefetcher
+from moment_detr.feature_cache import SharedFeatureCache
 from moment_detr.inference import eval_epoch, start_inference, setup_model
 from utils.basic_utils import AverageMeter, dict_to_markdown
-from utils.model_utils import count_parameters
+from utils.model_utils import count_parameters, resolve_amp_dtype, amp_autocast
 
 
 import logging
@@ -36,7 +39,8 @@ def set_seed(seed, use_cuda=True):
         torch.cuda.manual_seed_all(seed)
 
 
-def train_epoch(model, criterion, train_loader, optimizer, opt, epoch_i, tb_writer):
+def train_epoch(model, criterion, train_loader, optimizer, opt, epoch_i, tb_writer, scaler=None):
+    """scaler: torch.amp.GradScaler, scales the loss for float16 mixed precision training"""
     logger.info(f"[Epoch {epoch_i+1}]")
     model.train()
     criterion.train()
@@ -44,31 +48,52 @@ def train_epoch(model, criterion, train_loader, optimizer, opt, epoch_i, tb_writ
     # init meters
     time_meters = defaultdict(AverageMeter)
     loss_meters = defaultdict(AverageMeter)
+    padding_meters = defaultdict(AverageMeter)  # #valid tokens / #tokens after padding
 
+    amp_dtype = resolve_amp_dtype(opt.amp_dtype, opt.device)
     num_training_examples = len(train_loader)
+    if opt.prefetch:  # batch[2] holds the inputs already moved to device
+        train_loader = DevicePrefetcher(
+            train_loader, opt.device, non_blocking=opt.pin_memory, time_meters=time_meters)
     timer_dataloading = time.time()
     for batch_idx, batch in tqdm(enumerate(train_loader),
                                  desc="Training Iteration",
                                  total=num_training_examples):
         time_meters["dataloading_time"].update(time.time() - timer_dataloading)
+        for name, k in [("video", "video_feat"), ("query", "query_feat")]:
+            mask = batch[1][k][1]
+            padding_meters[name].update(float(mask.sum()) / mask.numel(), n=mask.numel())
 
         timer_start = time.time()
-        model_inputs, targets = prepare_batch_inputs(batch[1], opt.device, non_blocking=opt.pin_memory)
+        if opt.prefetch:
+            model_inputs, targets = batch[2]
+        else:
+            model_inputs, targets = prepare_batch_inputs(batch[1], opt.device, non_blocking=opt.pin_memory)
+            record_copy_event(train_loader)  # its pinned buffers are reused only after these copies
         time_meters["prepare_inputs_time"].update(time.time() - timer_start)
 
         timer_start = time.time()
-        outputs = model(**model_inputs)
-        loss_dict = criterion(outputs, targets)
+        with amp_autocast(opt.device, amp_dtype):
+            outputs = model(**model_inputs)
+        loss_dict = criterion(outputs, targets)  # in float32
         weight_dict = criterion.weight_dict
         losses = sum(loss_dict[k] * weight_dict[k] for k in loss_dict.keys() if k in weight_dict)
         time_meters["model_forward_time"].update(time.time() - timer_start)
 
         timer_start = time.time()
         optimizer.zero_grad()
-        losses.backward()
-        if opt.grad_clip > 0:
-            nn.utils.clip_grad_norm_(model.parameters(), opt.grad_clip)
-        optimizer.step()
+        if scaler is not None and scaler.is_enabled():
+            scaler.scale(losses).backward()
+            if opt.grad_clip > 0:
+                scaler.unscale_(optimizer)  # clip the true gradients
+                nn.utils.clip_grad_norm_(model.parameters(), opt.grad_clip)
+            scaler.step(optimizer)  # skipped if the gradients overflowed
+            scaler.update()
+        else:
+            losses.backward()
+            if opt.grad_clip > 0:
+                nn.utils.clip_grad_norm_(model.parameters(), opt.grad_clip)
+            optimizer.step()
         time_meters["model_backward_time"].update(time.time() - timer_start)
 
         loss_dict["loss_overall"] = float(losses)  # for logging only
@@ -83,6 +108,8 @@ def train_epoch(model, criterion, train_loader, optimizer, opt, epoch_i, tb_writ
     tb_writer.add_scalar("Train/lr", float(optimizer.param_groups[0]["lr"]), epoch_i+1)
     for k, v in loss_meters.items():
         tb_writer.add_scalar("Train/{}".format(k), v.avg, epoch_i+1)
+    for k, v in padding_meters.items():
+        tb_writer.add_scalar("Train/{}_padding_efficiency".format(k), v.avg, epoch_i+1)
 
     to_write = opt.train_log_txt_formatter.format(
         time_str=time.strftime("%Y_%m_%d_%H_%M_%S"),
@@ -95,6 +122,10 @@ def train_epoch(model, criterion, train_loader, optimizer, opt, epoch_i, tb_writ
     for name, meter in time_meters.items():
         d = {k: f"{getattr(meter, k):.4f}" for k in ["max", "min", "avg"]}
         logger.info(f"{name} ==> {d}")
+    logger.info("Padding efficiency (#valid tokens / #tokens): {}".format(
+        {k: f"{v.avg:.4f}" for k, v in padding_meters.items()}))
+    if train_loader.dataset.feat_cache is not None:
+        logger.info(f"Feature cache stats: {train_loader.dataset.feat_cache.stats()}")
 
 
 def train(model, criterion, optimizer, lr_scheduler, train_dataset, val_dataset, opt):
@@ -107,14 +138,36 @@ def train(model, criterion, optimizer, lr_scheduler, train_dataset, val_dataset,
     opt.train_log_txt_formatter = "{time_str} [Epoch] {epoch:03d} [Loss] {loss_str}\n"
     opt.eval_log_txt_formatter = "{time_str} [Epoch] {epoch:03d} [Loss] {loss_str} [Metrics] {eval_metrics_str}\n"
 
-    train_loader = DataLoader(
-        train_dataset,
-        collate_fn=start_end_collate,
-        batch_size=opt.bsz,
-        num_workers=opt.num_workers,
-        shuffle=True,
-        pin_memory=opt.pin_memory
-    )
+    collate_fn, loader_pin_memory = build_collate_fn(opt.pin_memory, opt.num_workers)
+    if opt.length_bucket_size > 0:
+        train_loader = DataLoader(
+            train_dataset,
+            collate_fn=collate_fn,
+            batch_sampler=LengthBucketBatchSampler(
+                train_dataset.get_example_lengths(), opt.bsz, bucket_size=opt.length_bucket_size, shuffle=True),
+            num_workers=opt.num_workers,
+            pin_memory=loader_pin_memory
+        )
+    else:
+        train_loader = DataLoader(
+            train_dataset,
+            collate_fn=collate_fn,
+            batch_size=opt.bsz,
+            num_workers=opt.num_workers,
+            shuffle=True,
+            pin_memory=loader_pin_memory
+        )
+
+    # bfloat16 has the range of float32, only float16 needs loss scaling
+    amp_dtype = resolve_amp_dtype(opt.amp_dtype, opt.device)
+    if amp_dtype is not None:
+        logger.info(f"Mixed precision training with {amp_dtype}")
+    scaler = torch.amp.GradScaler(opt.device.type, enabled=amp_dtype == torch.float16)
+    if opt.resume is not None and opt.resume_all and scaler.is_enabled():
+        scaler_state = torch.load(opt.resume, map_location="cpu").get("scaler")
+        if scaler_state:  # empty or missing for checkpoints trained without float16
+            scaler.load_state_dict(scaler_state)
+            logger.info(f"Loaded the loss scale {scaler.get_scale()} from checkpoint: {opt.resume}")
 
     prev_best_score = 0.
     es_cnt = 0
@@ -126,7 +179,7 @@ def train(model, criterion, optimizer, lr_scheduler, train_dataset, val_dataset,
     save_submission_filename = "latest_{}_{}_preds.jsonl".format(opt.dset_name, opt.eval_split_name)
     for epoch_i in trange(start_epoch, opt.n_epoch, desc="Epoch"):
         if epoch_i > -1:
-            train_epoch(model, criterion, train_loader, optimizer, opt, epoch_i, tb_writer)
+            train_epoch(model, criterion, train_loader, optimizer, opt, epoch_i, tb_writer, scaler=scaler)
             lr_scheduler.step()
         eval_epoch_interval = 5
         if opt.eval_path is not None and (epoch_i + 1) % eval_epoch_interval == 0:
@@ -160,6 +213,7 @@ def train(model, criterion, optimizer, lr_scheduler, train_dataset, val_dataset,
                     "model": model.state_dict(),
                     "optimizer": optimizer.state_dict(),
                     "lr_scheduler": lr_scheduler.state_dict(),
+                    "scaler": scaler.state_dict(),
                     "epoch": epoch_i,
                     "opt": opt
                 }
@@ -182,6 +236,7 @@ def train(model, criterion, optimizer, lr_scheduler, train_dataset, val_dataset,
                 "model": model.state_dict(),
                 "optimizer": optimizer.state_dict(),
                 "lr_scheduler": lr_scheduler.state_dict(),
+                "scaler": scaler.state_dict(),
                 "epoch": epoch_i,
                 "opt": opt
             }
@@ -192,6 +247,7 @@ def train(model, criterion, optimizer, lr_scheduler, train_dataset, val_dataset,
             checkpoint = {
                 "model": model.state_dict(),
                 "optimizer": optimizer.state_dict(),
+                "scaler": scaler.state_dict(),
                 "epoch": epoch_i,
                 "opt": opt
             }
@@ -213,6 +269,8 @@ def start_training():
         cudnn.benchmark = False
         cudnn.deterministic = True
 
+    # one feature cache for the train and eval datasets, so they share the --feat_cache_gb budget
+    feat_cache = SharedFeatureCache(int(opt.feat_cache_gb * 1024 ** 3)) if opt.feat_cache_gb > 0 else None
     dataset_config = dict(
         dset_name=opt.dset_name,
         data_path=opt.train_path,
@@ -228,7 +286,9 @@ def start_training():
         clip_len=opt.clip_length,
         max_windows=opt.max_windows,
         span_loss_type=opt.span_loss_type,
-        txt_drop_ratio=opt.txt_drop_ratio
+        txt_drop_ratio=opt.txt_drop_ratio,
+        feat_backend=opt.feat_backend,
+        feat_cache=feat_cache
     )
 
     dataset_config["data_path"] = opt.train_path
@@ -6,6 +6,7 @@ Copy-paste from torch.nn.Transformer with modifications:
     * positional encodings are passed in MHattention
     * extra LN at the end of encoder is removed
     * decoder returns a stack of activations from all decoding layers
+    * optional `F.scaled_dot_product_attention` backend on batch-first tensors, see `ScaledDotProductAttention`
 """
 import copy
 from typing import Optional
@@ -20,18 +21,18 @@ class Transformer(nn.Module):
     def __init__(self, d_model=512, nhead=8, num_encoder_layers=6,
                  num_decoder_layers=6, dim_feedforward=2048, dropout=0.1,
                  activation="relu", normalize_before=False,
-                 return_intermediate_dec=False):
+                 return_intermediate_dec=False, attn_backend="mha"):
         super().__init__()
 
         # TransformerEncoderLayerThin
         encoder_layer = TransformerEncoderLayer(d_model, nhead, dim_feedforward,
-                                                dropout, activation, normalize_before)
+                                                dropout, activation, normalize_before, attn_backend)
         encoder_norm = nn.LayerNorm(d_model) if normalize_before else None
         self.encoder = TransformerEncoder(encoder_layer, num_encoder_layers, encoder_norm)
 
         # TransformerDecoderLayerThin
         decoder_layer = TransformerDecoderLayer(d_model, nhead, dim_feedforward,
-                                                dropout, activation, normalize_before)
+                                                dropout, activation, normalize_before, attn_backend)
         decoder_norm = nn.LayerNorm(d_model)
         self.decoder = TransformerDecoder(decoder_layer, num_decoder_layers, decoder_norm,
                                           return_intermediate=return_intermediate_dec)
@@ -40,6 +41,7 @@ class Transformer(nn.Module):
 
         self.d_model = d_model
         self.nhead = nhead
+        self.batch_first = attn_backend == "sdpa"
 
     def _reset_parameters(self):
         for p in self.parameters():
@@ -57,19 +59,25 @@ class Transformer(nn.Module):
         Returns:
 
         """
-        # flatten NxCxHxW to HWxNxC
         bs, l, d = src.shape
-        src = src.permute(1, 0, 2)  # (L, batch_size, d)
-        pos_embed = pos_embed.permute(1, 0, 2)   # (L, batch_size, d)
-        query_embed = query_embed.unsqueeze(1).repeat(1, bs, 1)  # (#queries, batch_size, d)
+        if self.batch_first:
+            query_embed = query_embed.unsqueeze(0).repeat(bs, 1, 1)  # (batch_size, #queries, d)
+            mask = key_padding_mask_to_attn_mask(mask)  # converted once, shared by all layers
+        else:
+            # flatten NxCxHxW to HWxNxC
+            src = src.permute(1, 0, 2)  # (L, batch_size, d)
+            pos_embed = pos_embed.permute(1, 0, 2)   # (L, batch_size, d)
+            query_embed = query_embed.unsqueeze(1).repeat(1, bs, 1)  # (#queries, batch_size, d)
 
         tgt = torch.zeros_like(query_embed)
+        # below, the batch_size and length dims are swapped if batch_first
         memory = self.encoder(src, src_key_padding_mask=mask, pos=pos_embed)  # (L, batch_size, d)
         hs = self.decoder(tgt, memory, memory_key_padding_mask=mask,
                           pos=pos_embed, query_pos=query_embed)  # (#layers, #queries, batch_size, d)
-        hs = hs.transpose(1, 2)  # (#layers, batch_size, #qeries, d)
-        # memory = memory.permute(1, 2, 0)  # (batch_size, d, L)
-        memory = memory.transpose(0, 1)  # (batch_size, L, d)
+        if not self.batch_first:
+            hs = hs.transpose(1, 2)  # (#layers, batch_size, #qeries, d)
+            # memory = memory.permute(1, 2, 0)  # (batch_size, d, L)
+            memory = memory.transpose(0, 1)  # (batch_size, L, d)
         return hs, memory
 
 
@@ -211,9 +219,9 @@ class TransformerEncoderLayerThin(nn.Module):
 class TransformerEncoderLayer(nn.Module):
 
     def __init__(self, d_model, nhead, dim_feedforward=2048, dropout=0.1,
-                 activation="relu", normalize_before=False):
+                 activation="relu", normalize_before=False, attn_backend="mha"):
         super().__init__()
-        self.self_attn = nn.MultiheadAttention(d_model, nhead, dropout=dropout)
+        self.self_attn = _build_attention(d_model, nhead, dropout, attn_backend)
         # Implementation of Feedforward model
         self.linear1 = nn.Linear(d_model, dim_feedforward)
         self.dropout = nn.Dropout(dropout)
@@ -271,10 +279,10 @@ class TransformerEncoderLayer(nn.Module):
 class TransformerDecoderLayer(nn.Module):
 
     def __init__(self, d_model, nhead, dim_feedforward=2048, dropout=0.1,
-                 activation="relu", normalize_before=False):
+                 activation="relu", normalize_before=False, attn_backend="mha"):
         super().__init__()
-        self.self_attn = nn.MultiheadAttention(d_model, nhead, dropout=dropout)
-        self.multihead_attn = nn.MultiheadAttention(d_model, nhead, dropout=dropout)
+        self.self_attn = _build_attention(d_model, nhead, dropout, attn_backend)
+        self.multihead_attn = _build_attention(d_model, nhead, dropout, attn_backend)
         # Implementation of Feedforward model
         self.linear1 = nn.Linear(d_model, dim_feedforward)
         self.dropout = nn.Dropout(dropout)
@@ -442,6 +450,87 @@ class TransformerDecoderLayerThin(nn.Module):
                                  tgt_key_padding_mask, memory_key_padding_mask, pos, query_pos)
 
 
+class ScaledDotProductAttention(nn.Module):
+    """
+    Multi-head attention with `F.scaled_dot_product_attention` on batch-first tensors.
+    The parameters have the same names and shapes as those of `nn.MultiheadAttention`,
+    so checkpoints trained with either attention backend can be loaded with the other one.
+    The attention weights are not returned, which avoids materializing them.
+    """
+
+    def __init__(self, embed_dim, num_heads, dropout=0.):
+        super().__init__()
+        assert embed_dim % num_heads == 0, "embed_dim must be divisible by num_heads"
+        self.embed_dim = embed_dim
+        self.num_heads = num_heads
+        self.dropout = dropout
+        self.in_proj_weight = nn.Parameter(torch.empty(3 * embed_dim, embed_dim))
+        self.in_proj_bias = nn.Parameter(torch.empty(3 * embed_dim))
+        self.out_proj = nn.Linear(embed_dim, embed_dim)
+        self._reset_parameters()
+
+    def _reset_parameters(self):
+        # the same as nn.MultiheadAttention
+        nn.init.xavier_uniform_(self.in_proj_weight)
+        nn.init.constant_(self.in_proj_bias, 0.)
+        nn.init.constant_(self.out_proj.bias, 0.)
+
+    def _split_heads(self, x):
+        """(batch_size, L, d) -> (batch_size, #heads, L, d / #heads)"""
+        return x.unflatten(-1, (self.num_heads, -1)).transpose(1, 2)
+
+    def forward(self, query, key, value,
+                attn_mask: Optional[Tensor] = None,
+                key_padding_mask: Optional[Tensor] = None):
+        """
+        Args:
+            query: (batch_size, Lq, d)
+            key: (batch_size, Lk, d)
+            value: (batch_size, Lk, d)
+            attn_mask: bool, broadcastable to (batch_size, #heads, Lq, Lk), True at the allowed positions
+            key_padding_mask: (batch_size, 1, 1, Lk), bool, True at the valid keys,
+                see `key_padding_mask_to_attn_mask`
+
+        Returns:
+            output: (batch_size, Lq, d), and None in place of the attention weights of `nn.MultiheadAttention`
+        """
+        d = self.embed_dim
+        if key is query:  # self-attention, project q and k in one matmul
+            q, k = F.linear(query, self.in_proj_weight[:2 * d], self.in_proj_bias[:2 * d]).chunk(2, dim=-1)
+        else:
+            q = F.linear(query, self.in_proj_weight[:d], self.in_proj_bias[:d])
+            k = F.linear(key, self.in_proj_weight[d:2 * d], self.in_proj_bias[d:2 * d])
+        v = F.linear(value, self.in_proj_weight[2 * d:], self.in_proj_bias[2 * d:])
+
+        if attn_mask is None:
+            attn_mask = key_padding_mask
+        elif key_padding_mask is not None:
+            attn_mask = attn_mask & key_padding_mask
+        output = F.scaled_dot_product_attention(
+            self._split_heads(q), self._split_heads(k), self._split_heads(v),
+            attn_mask=attn_mask, dropout_p=self.dropout if self.training else 0.)  # (batch_size, #heads, Lq, d')
+        output = output.transpose(1, 2).flatten(2)  # (batch_size, Lq, d)
+        return self.out_proj(output), None
+
+
+def key_padding_mask_to_attn_mask(key_padding_mask):
+    """
+    Args:
+        key_padding_mask: (batch_size, L), bool, True at the padded positions, as in `nn.MultiheadAttention`
+
+    Returns:
+        (batch_size, 1, 1, L), bool, True at the valid positions, as in `F.scaled_dot_product_attention`
+    """
+    return ~key_padding_mask[:, None, None, :]
+
+
+def _build_attention(d_model, nhead, dropout, attn_backend="mha"):
+    if attn_backend == "mha":
+        return nn.MultiheadAttention(d_model, nhead, dropout=dropout)
+    if attn_backend == "sdpa":
+        return ScaledDotProductAttention(d_model, nhead, dropout=dropout)
+    raise ValueError(f"attn_backend should be mha/sdpa, not {attn_backend}.")
+
 
 def _get_clones(module, N):
     return nn.ModuleList([copy.deepcopy(module) for i in range(N)])
@@ -457,6 +546,7 @@ def build_transformer(args):
         num_decoder_layers=args.dec_layers,
         normalize_before=args.pre_norm,
         return_intermediate_dec=True,
+        attn_backend=getattr(args, "attn_backend", "mha"),  # not in the options of older checkpoints
     )
 
 
@@ -1,38 +1,93 @@
 import torch
 import os
+import time
+import subprocess
+import tempfile
+from collections import defaultdict
 import numpy as np
 import ffmpeg
 import math
 from run_on_video import clip
+from run_on_video.feature_cache import ClipFeatureCache, get_file_id
+from utils.basic_utils import AverageMeter
+from utils.model_utils import quantize_linear_int8, get_quantized_cache_path
+from utils.thread_utils import iter_in_background
 
 
 class ClipFeatureExtractor:
-    def __init__(self, framerate=1/2, size=224, centercrop=True, model_name_or_path="ViT-B/32", device="cuda"):
+    def __init__(self, framerate=1/2, size=224, centercrop=True, model_name_or_path="ViT-B/32", device="cuda",
+                 quantize=False, quantized_cache_dir="~/.cache/moment_detr",
+                 feature_cache_dir=None, feature_cache_max_gb=10):
+        """quantize: bool, dynamic int8 quantization of the Linear layers of the CLIP text and visual towers,
+        CPU only. The quantized weights are cached in quantized_cache_dir.
+        feature_cache_dir: str, if given, the video and text features are cached on disk, so a video or a query
+        that has been encoded before is not decoded and encoded again, see run_on_video/feature_cache.py"""
         self.video_loader = VideoLoader(framerate=framerate, size=size, centercrop=centercrop)
         print("Loading CLIP models")
         self.clip_extractor, _ = clip.load(model_name_or_path, device=device, jit=False)
+        if quantize:
+            assert str(device) == "cpu", "quantized CLIP only runs on CPU"
+            src_path = clip.clip._download(clip.clip._MODELS[model_name_or_path]) \
+                if model_name_or_path in clip.available_models() else model_name_or_path
+            cache_path = get_quantized_cache_path(quantized_cache_dir, "clip", src_path)
+            print(f"Quantizing CLIP models, cache: {cache_path}")
+            self.clip_extractor = quantize_linear_int8(self.clip_extractor, cache_path=cache_path)
         self.tokenizer = clip.tokenize
         self.video_preprocessor = Preprocessing()
         self.device = device
+        self.time_meters = defaultdict(AverageMeter)  # per-batch time of each stage of encode_video
+        self.feature_cache = None
+        if feature_cache_dir is not None:
+            model_id = get_file_id(model_name_or_path) if os.path.isfile(model_name_or_path) else model_name_or_path
+            model_id = f"{model_id}:{self.clip_extractor.dtype}:quantized={quantize}"
+            self.feature_cache = ClipFeatureCache(feature_cache_dir, model_id, max_gb=feature_cache_max_gb)
 
     @torch.no_grad()
-    def encode_video(self, video_path: str, bsz=60):
-        video_frames = self.video_loader.read_video_from_file(video_path)  # (T, H, W, 3)
-        video_frames = self.video_preprocessor(video_frames)
-        n_frames = len(video_frames)
-        n_batch = int(math.ceil(n_frames / bsz))
+    def encode_video(self, video_path: str, bsz=60, n_prefetch=2):
+        """the frames are decoded, normalized and encoded in batches of bsz frames as they are streamed from
+        ffmpeg, so the memory is bounded by bsz instead of the video length.
+        With n_prefetch > 0, a background thread decodes and normalizes up to n_prefetch batches ahead while
+        CLIP encodes the current one, see FramePrefetcher. The time of each stage is recorded in self.time_meters.
+        """
+        if self.feature_cache is not None:
+            cache_key = self.feature_cache.video_key(
+                video_path, framerate=self.video_loader.framerate, size=self.video_loader.size,
+                centercrop=self.video_loader.centercrop)
+            video_features = self.feature_cache.get(cache_key)
+            if video_features is not None:
+                return torch.from_numpy(video_features).to(self.device)
         video_features = []
-        for i in range(n_batch):
-            st_idx = i * bsz
-            ed_idx = (i+1) * bsz
-            _video_frames = video_frames[st_idx:ed_idx].to(self.device)
-            _video_features = self.clip_extractor.encode_image(_video_frames)
+        frame_batches = FramePrefetcher(self.video_loader, self.video_preprocessor, video_path, bsz=bsz,
+                                        n_prefetch=n_prefetch, time_meters=self.time_meters)
+        for _video_frames in frame_batches:  # (<=bsz, 3, H, W), normalized float
+            timer_start = time.time()
+            _video_features = self.clip_extractor.encode_image(_video_frames.to(self.device))
+            if str(self.device).startswith("cuda"):
+                torch.cuda.synchronize(self.device)
+            self.time_meters["encode_time"].update(time.time() - timer_start)
             video_features.append(_video_features)
         video_features = torch.cat(video_features, dim=0)
+        if self.feature_cache is not None:
+            self.feature_cache.put(cache_key, video_features.cpu().numpy())
         return video_features  # (T=#frames, d) torch tensor
 
     @torch.no_grad()
     def encode_text(self, text_list, bsz=60):
+        if self.feature_cache is None:
+            return self._encode_text(text_list, bsz=bsz)
+        cache_keys = [self.feature_cache.text_key(e) for e in text_list]
+        text_features = [self.feature_cache.get(k) for k in cache_keys]
+        text_features = [None if e is None else torch.from_numpy(e).to(self.device) for e in text_features]
+        missing_indices = [i for i, e in enumerate(text_features) if e is None]
+        if len(missing_indices) > 0:  # only the queries that are not cached are encoded
+            missing_features = self._encode_text([text_list[i] for i in missing_indices], bsz=bsz)
+            for i, e in zip(missing_indices, missing_features):
+                text_features[i] = e
+            self.feature_cache.put_many([(cache_keys[i], e.cpu().numpy())
+                                         for i, e in zip(missing_indices, missing_features)])
+        return text_features  # List([L_j, d]) torch tensor
+
+    def _encode_text(self, text_list, bsz=60):
         n_text = len(text_list)
         n_batch = int(math.ceil(n_text / bsz))
         text_features = []
@@ -130,15 +185,12 @@ class VideoLoader:
         else:
             return self.size, int(w * self.size / h)
 
-    def read_video_from_file(self, video_path):
-        try:
-            info = self._get_video_info(video_path)
-            h, w = info["height"], info["width"]
-        except Exception:
-            print('ffprobe failed at: {}'.format(video_path))
-            return {'video': torch.zeros(1), 'input': video_path,
-                    'info': {}}
-        height, width = self._get_output_dim(h, w)
+    def _get_ffmpeg_cmd(self, video_path, info):
+        """ Returns:
+            cmd: ffmpeg stream of the resampled, resized and cropped video, w/o output
+            height, width: int, the output frame size
+        """
+        height, width = self._get_output_dim(info["height"], info["width"])
         try:
             duration = info["duration"]
             fps = self.framerate
@@ -157,14 +209,128 @@ class VideoLoader:
             x = int((width - self.size) / 2.0)
             y = int((height - self.size) / 2.0)
             cmd = cmd.crop(x, y, self.size, self.size)
+        if self.centercrop and isinstance(self.size, int):
+            height, width = self.size, self.size
+        return cmd, height, width
+
+    def read_video_from_file(self, video_path):
+        try:
+            info = self._get_video_info(video_path)
+        except Exception:
+            print('ffprobe failed at: {}'.format(video_path))
+            return {'video': torch.zeros(1), 'input': video_path,
+                    'info': {}}
+        cmd, height, width = self._get_ffmpeg_cmd(video_path, info)
         out, _ = (
             cmd.output('pipe:', format='rawvideo', pix_fmt='rgb24')
             .run(capture_stdout=True, quiet=True)
         )
-        if self.centercrop and isinstance(self.size, int):
-            height, width = self.size, self.size
         video = np.frombuffer(out, np.uint8).reshape(
             [-1, height, width, 3])
         video = torch.from_numpy(video.astype('float32'))
         video = video.permute(0, 3, 1, 2)
         return video
+
+    def iter_video_frames(self, video_path, chunk_size=60):
+        """ the same frames as read_video_from_file, streamed from the ffmpeg pipe in chunks of chunk_size frames,
+        so the memory is bounded by chunk_size instead of the video length.
+        Yields:
+            uint8 torch tensor, (<=chunk_size, 3, H, W)
+        """
+        try:
+            info = self._get_video_info(video_path)
+        except Exception as e:
+            raise RuntimeError('ffprobe failed at: {}'.format(video_path)) from e
+        cmd, height, width = self._get_ffmpeg_cmd(video_path, info)
+        frame_n_bytes = height * width * 3
+        # stderr goes to a file, as a full stderr pipe would block ffmpeg
+        with tempfile.TemporaryFile() as stderr:
+            process = subprocess.Popen(cmd.output('pipe:', format='rawvideo', pix_fmt='rgb24').compile(),
+                                       stdout=subprocess.PIPE, stderr=stderr)
+            try:
+                while True:
+                    buffer = bytearray(chunk_size * frame_n_bytes)  # a new buffer, the yielded frames are views
+                    n_bytes = _read_into(process.stdout, buffer)
+                    n_frames = n_bytes // frame_n_bytes
+                    if n_frames > 0:
+                        frames = torch.frombuffer(buffer, dtype=torch.uint8)[:n_frames * frame_n_bytes]
+                        yield frames.view(n_frames, height, width, 3).permute(0, 3, 1, 2)
+                    if n_bytes < len(buffer):  # EOF
+                        break
+            except BaseException:  # including GeneratorExit, i.e., the consumer stopped early
+                process.kill()
+                raise
+            finally:
+                process.stdout.close()
+                process.wait()
+            if process.returncode != 0:
+                stderr.seek(0)
+                raise ffmpeg.Error('ffmpeg', b'', stderr.read())
+
+
+def _read_into(stream, buffer):
+    """read from stream until buffer is full or EOF, returns the #bytes read"""
+    view = memoryview(buffer)
+    n_bytes = 0
+    while n_bytes < len(buffer):
+        n_read = stream.readinto(view[n_bytes:])
+        if not n_read:
+            break
+        n_bytes += n_read
+    return n_bytes
+
+
+class FramePrefetcher(object):
+    """
+    Iterates over the normalized frame batches of a video, like moment_detr/prefetcher.py for DataLoaders
+    (both are built on utils/thread_utils.py).
+    A background thread reads the frames streamed by ffmpeg (which decodes in its own process) and normalizes
+    them into a bounded queue, while the consumer runs CLIP on the previous batch. Both the pipe reads and the
+    torch ops release the GIL, so decoding and encoding overlap.
+
+    Args:
+        video_loader: VideoLoader
+        preprocessor: Preprocessing
+        video_path: str
+        bsz: int, #frames per batch
+        n_prefetch: int, max #batches prepared ahead, bounds the memory. 0: decode in the consumer thread.
+        time_meters: defaultdict(AverageMeter), if given, the time per batch is recorded as `decode_time`
+            (reading the ffmpeg pipe), `preprocess_time` and `wait_time`, i.e., the time the consumer waits
+            for the next batch, which is ~0 when decoding is faster than encoding.
+    """
+
+    def __init__(self, video_loader, preprocessor, video_path, bsz=60, n_prefetch=2, time_meters=None):
+        self.video_loader = video_loader
+        self.preprocessor = preprocessor
+        self.video_path = video_path
+        self.bsz = bsz
+        self.n_prefetch = n_prefetch
+        self.time_meters = time_meters
+
+    def _update_meter(self, name, value):
+        if self.time_meters is not None:
+            self.time_meters[name].update(value)
+
+    def _iter_batches(self):
+        frame_chunks = self.video_loader.iter_video_frames(self.video_path, chunk_size=self.bsz)
+        try:
+            while True:
+                timer_start = time.time()
+                frames = next(frame_chunks, None)  # (<=bsz, 3, H, W), uint8
+                if frames is None:
+                    return
+                self._update_meter("decode_time", time.time() - timer_start)
+                timer_start = time.time()
+                frames = self.preprocessor(frames)  # uint8 -> float
+                self._update_meter("preprocess_time", time.time() - timer_start)
+                yield frames
+        finally:
+            frame_chunks.close()  # stops ffmpeg if the consumer stopped early
+
+    def __iter__(self):
+        if self.n_prefetch == 0:
+            yield from self._iter_batches()
+            return
+        yield from iter_in_background(
+            self._iter_batches(), max_prefetch=self.n_prefetch,
+            wait_callback=lambda t: self._update_meter("wait_time", t))
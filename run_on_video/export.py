@@ -0,0 +1,260 @@
+"""
+Export a trained Moment-DETR checkpoint to an inference-only graph.
+
+`MomentDETRInference` runs the same computation as `MomentDETR.forward` in eval mode, restricted to the outputs
+used at inference. It returns a tuple (pred_logits, pred_spans, saliency_scores) instead of a dict with optional
+`aux_outputs` and `proj_*` entries, and has no data dependent python branches, so it can be traced.
+
+Supported formats:
+    torchscript: torch.jit.trace + torch.jit.freeze, runs without the python model code via `torch.jit.load`.
+    onnx: torch.onnx.export, for graph runtimes such as onnxruntime (requires `pip install onnx onnxruntime`).
+    export: torch.export, saved as an ExportedProgram, output_path should end with .pt2.
+With --dynamic, the #queries (batch), video length and query length are dynamic axes. Otherwise, the lengths are
+fixed to max_v_l and max_q_l, and `ExportedMomentDETR` pads the inputs to these lengths. A sidecar
+`<output_path>.json` records these settings, and the exported graph is checked against the eager model.
+
+Usage:
+PYTHONPATH=$PYTHONPATH:. python run_on_video/export.py \
+--ckpt_path run_on_video/moment_detr_ckpt/model_best.ckpt --output_path moment_detr.ts --format torchscript
+"""
+import argparse
+import warnings
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+from torch import nn
+
+from run_on_video.model_utils import build_inference_model
+from utils.basic_utils import save_json, load_json
+
+OUTPUT_NAMES = ("pred_logits", "pred_spans", "saliency_scores")
+INPUT_NAMES = ("src_txt", "src_txt_mask", "src_vid", "src_vid_mask")
+
+
+class MomentDETRInference(nn.Module):
+    """Inference-only view of a MomentDETR model, it shares the parameters of `model`.
+    The video inputs may have batch_size 1 while the text inputs have batch_size N, i.e., N queries for the same
+    video, the video is then broadcast to all queries as in `MomentDETR.forward`.
+    """
+
+    def __init__(self, model):
+        super().__init__()
+        self.model = model.eval()
+
+    def forward(self, src_txt, src_txt_mask, src_vid, src_vid_mask):
+        """
+        Args:
+            src_txt: (N, L_txt, D_txt)
+            src_txt_mask: (N, L_txt), 1 for valid tokens
+            src_vid: (N or 1, L_vid, D_vid)
+            src_vid_mask: (N or 1, L_vid), 1 for valid clips
+        Returns:
+            pred_logits: (N, #moment_queries, 2)
+            pred_spans: (N, #moment_queries, 2) normalized (center_x, width) for span_loss_type l1,
+                or (N, #moment_queries, max_v_l * 2) logits for ce
+            saliency_scores: (N, L_vid)
+        """
+        model = self.model
+        bsz, l_txt = src_txt.shape[:2]
+        src_vid = model.input_vid_proj(src_vid)
+        src_txt = model.input_txt_proj(src_txt)
+        pos_vid = model.position_embed(src_vid, src_vid_mask)  # (N or 1, L_vid, d)
+        # expanding to the same batch_size is a no-op, so there is no branch on the input shapes
+        src_vid = src_vid.expand(bsz, -1, -1)
+        src_vid_mask = src_vid_mask.expand(bsz, -1)
+        pos_vid = pos_vid.expand(bsz, -1, -1)
+        src = torch.cat([src_vid, src_txt], dim=1)  # (N, L_vid+L_txt, d)
+        mask = torch.cat([src_vid_mask, src_txt_mask], dim=1).bool()  # (N, L_vid+L_txt)
+        if model.use_txt_pos:
+            pos = torch.cat([pos_vid, model.txt_position_embed(src_txt)], dim=1)
+        else:  # zero positions for the text tokens
+            pos = F.pad(pos_vid, (0, 0, 0, l_txt))
+        hs, memory = model.transformer(src, ~mask, model.query_embed.weight, pos)
+        hs = hs[-1]  # (N, #moment_queries, d), the last decoder layer
+        pred_logits = model.class_embed(hs)
+        pred_spans = model.span_embed(hs)
+        if model.span_loss_type == "l1":
+            pred_spans = pred_spans.sigmoid()
+        saliency_scores = model.saliency_proj(memory[:, :src_vid.shape[1]]).squeeze(-1)  # (N, L_vid)
+        return pred_logits, pred_spans, saliency_scores
+
+
+def get_example_inputs(v_feat_dim, t_feat_dim, n_queries=2, l_vid=75, l_txt=32, shared_video=True, seed=None):
+    """random normalized inputs with random valid lengths, in the input order of MomentDETRInference"""
+    generator = torch.Generator().manual_seed(seed) if seed is not None else None
+    src_txt = F.normalize(torch.randn(n_queries, l_txt, t_feat_dim, generator=generator), dim=-1)
+    txt_lengths = torch.randint(1, l_txt + 1, (n_queries,), generator=generator)
+    txt_lengths[0] = l_txt
+    src_txt_mask = (torch.arange(l_txt)[None] < txt_lengths[:, None]).float()
+    n_videos = 1 if shared_video else n_queries
+    src_vid = F.normalize(torch.randn(n_videos, l_vid, v_feat_dim, generator=generator), dim=-1)
+    vid_lengths = torch.randint(1, l_vid + 1, (n_videos,), generator=generator)
+    vid_lengths[0] = l_vid
+    src_vid_mask = (torch.arange(l_vid)[None] < vid_lengths[:, None]).float()
+    return src_txt, src_txt_mask, src_vid, src_vid_mask
+
+
+def export_model(model, output_path, export_format="torchscript", dynamic=False, max_v_l=75, max_q_l=32,
+                 opset_version=18):
+    """ export MomentDETR `model` on CPU, and save the export settings to `output_path`.json
+    Args:
+        model: MomentDETR
+        output_path: str
+        export_format: str, one of [torchscript, onnx, export]
+        dynamic: bool, export the #queries, video and query lengths as dynamic axes,
+            otherwise the lengths are fixed to max_v_l and max_q_l, the #queries is dynamic in both cases.
+        max_v_l: int, max #clips
+        max_q_l: int, max #tokens
+        opset_version: int, onnx only
+    Returns:
+        dict, the export settings
+    """
+    wrapper = MomentDETRInference(model.cpu()).eval()
+    v_feat_dim = model.input_vid_proj[0].net[1].in_features
+    t_feat_dim = model.input_txt_proj[0].net[1].in_features
+    example_inputs = get_example_inputs(v_feat_dim, t_feat_dim, n_queries=2, l_vid=max_v_l, l_txt=max_q_l,
+                                        shared_video=False, seed=0)
+    with torch.no_grad():
+        if export_format == "torchscript":
+            with warnings.catch_warnings():
+                warnings.simplefilter("ignore")  # the shape-dependent ops are recorded as ops on the traced shapes
+                traced = torch.jit.trace(wrapper, example_inputs)
+            torch.jit.save(torch.jit.freeze(traced), output_path)
+        elif export_format == "onnx":  # the video batch_size is #queries, ExportedMomentDETR expands shared videos
+            dynamic_axes = {"src_txt": {0: "n_queries"}, "src_txt_mask": {0: "n_queries"},
+                            "src_vid": {0: "n_queries"}, "src_vid_mask": {0: "n_queries"},
+                            "pred_logits": {0: "n_queries"}, "pred_spans": {0: "n_queries"},
+                            "saliency_scores": {0: "n_queries"}}
+            if dynamic:
+                for name in ["src_txt", "src_txt_mask"]:
+                    dynamic_axes[name][1] = "l_txt"
+                for name in ["src_vid", "src_vid_mask", "saliency_scores"]:
+                    dynamic_axes[name][1] = "l_vid"
+            torch.onnx.export(wrapper, example_inputs, output_path, input_names=list(INPUT_NAMES),
+                              output_names=list(OUTPUT_NAMES), dynamic_axes=dynamic_axes,
+                              opset_version=opset_version)
+        elif export_format == "export":  # the same as onnx, the video batch_size is #queries
+            n_queries = torch.export.Dim("n_queries", min=1)
+            txt_shape, vid_shape = {0: n_queries}, {0: n_queries}
+            if dynamic:
+                txt_shape[1] = torch.export.Dim("l_txt", min=2, max=max_q_l)
+                vid_shape[1] = torch.export.Dim("l_vid", min=2, max=max_v_l)
+            dynamic_shapes = (txt_shape, txt_shape, vid_shape, vid_shape)
+            exported_program = torch.export.export(wrapper, example_inputs, dynamic_shapes=dynamic_shapes)
+            torch.export.save(exported_program, output_path)
+        else:
+            raise ValueError(f"export_format {export_format} not supported")
+
+    export_config = dict(
+        format=export_format, dynamic=dynamic, max_v_l=max_v_l, max_q_l=max_q_l,
+        v_feat_dim=v_feat_dim, t_feat_dim=t_feat_dim, span_loss_type=model.span_loss_type,
+        input_names=list(INPUT_NAMES), output_names=list(OUTPUT_NAMES))
+    save_json(export_config, output_path + ".json", save_pretty=True)
+    return export_config
+
+
+class ExportedMomentDETR(object):
+    """Run an exported graph with the same inputs and outputs as MomentDETR.forward at inference, i.e.,
+    a dict with pred_logits, pred_spans and saliency_scores. For graphs exported without dynamic axes,
+    the inputs are padded to the exported lengths and the saliency scores are cut back to the input length.
+    The graph runs on CPU.
+
+    Args:
+        path: str, output_path of export_model
+    """
+
+    def __init__(self, path):
+        self.config = load_json(path + ".json")
+        self.format = self.config["format"]
+        self.max_v_l = self.config["max_v_l"]
+        if self.format == "torchscript":
+            self.graph = torch.jit.load(path, map_location="cpu")
+        elif self.format == "onnx":
+            import onnxruntime  # optional dependency, only needed to run onnx graphs
+            self.graph = onnxruntime.InferenceSession(path, providers=["CPUExecutionProvider"])
+        elif self.format == "export":
+            self.graph = torch.export.load(path).module()
+        else:
+            raise ValueError(f"export format {self.format} not supported")
+
+    def _pad(self, src, mask, length):
+        if self.config["dynamic"]:
+            return src, mask
+        assert src.shape[1] <= length, f"the input length {src.shape[1]} exceeds the exported length {length}"
+        n_pad = length - src.shape[1]
+        return F.pad(src, (0, 0, 0, n_pad)), F.pad(mask, (0, n_pad))
+
+    @torch.no_grad()
+    def __call__(self, src_txt, src_txt_mask, src_vid, src_vid_mask):
+        device = src_txt.device
+        l_vid = src_vid.shape[1]
+        src_txt, src_txt_mask = self._pad(src_txt.cpu().float(), src_txt_mask.cpu().float(), self.config["max_q_l"])
+        src_vid, src_vid_mask = self._pad(src_vid.cpu().float(), src_vid_mask.cpu().float(), self.config["max_v_l"])
+        if self.format != "torchscript":  # onnx and torch.export graphs take one video per query
+            src_vid = src_vid.expand(len(src_txt), -1, -1)
+            src_vid_mask = src_vid_mask.expand(len(src_txt), -1)
+        inputs = (src_txt, src_txt_mask, src_vid, src_vid_mask)
+        if self.format == "onnx":
+            outputs = self.graph.run(list(OUTPUT_NAMES), {k: v.numpy() for k, v in zip(INPUT_NAMES, inputs)})
+            outputs = [torch.from_numpy(e) for e in outputs]
+        else:
+            outputs = self.graph(*inputs)
+        outputs = dict(zip(OUTPUT_NAMES, outputs))
+        outputs["saliency_scores"] = outputs["saliency_scores"][:, :l_vid]
+        return {k: v.to(device) for k, v in outputs.items()}
+
+
+def check_export_parity(model, exported_model, n_trials=5, atol=1e-4, seed=0):
+    """ compare the exported graph with the eager model on random inputs of different shapes
+    Args:
+        model: MomentDETR
+        exported_model: ExportedMomentDETR
+        n_trials: int
+        atol: float, max allowed absolute difference of each output
+    Returns:
+        dict, output name -> max absolute difference
+    """
+    config = exported_model.config
+    model = model.cpu().eval()
+    rng = np.random.RandomState(seed)
+    max_diffs = {k: 0. for k in OUTPUT_NAMES}
+    for trial_idx in range(n_trials):
+        inputs = get_example_inputs(
+            config["v_feat_dim"], config["t_feat_dim"], n_queries=int(rng.randint(1, 8)),
+            l_vid=int(rng.randint(2, config["max_v_l"] + 1)), l_txt=int(rng.randint(2, config["max_q_l"] + 1)),
+            shared_video=trial_idx % 2 == 0, seed=seed + trial_idx)
+        with torch.no_grad():
+            ref_outputs = model(*inputs)
+        outputs = exported_model(*inputs)
+        for k in OUTPUT_NAMES:
+            max_diffs[k] = max(max_diffs[k], float((outputs[k] - ref_outputs[k]).abs().max()))
+    failed = {k: v for k, v in max_diffs.items() if v > atol}
+    if len(failed) > 0:
+        raise AssertionError(f"exported graph differs from the eager model, max abs diff {failed} > {atol}")
+    return max_diffs
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export a Moment-DETR checkpoint to an inference-only graph")
+    parser.add_argument("--ckpt_path", type=str, default="run_on_video/moment_detr_ckpt/model_best.ckpt")
+    parser.add_argument("--output_path", type=str, required=True)
+    parser.add_argument("--format", type=str, default="torchscript", choices=["torchscript", "onnx", "export"])
+    parser.add_argument("--dynamic", action="store_true",
+                        help="export the #queries, video and query lengths as dynamic axes, "
+                             "otherwise the inputs are padded to max_v_l and max_q_l")
+    parser.add_argument("--opset_version", type=int, default=18, help="onnx opset")
+    parser.add_argument("--atol", type=float, default=1e-4, help="max abs diff allowed in the parity check")
+    args = parser.parse_args()
+
+    model = build_inference_model(args.ckpt_path).eval()
+    max_q_l = model.txt_position_embed.position_embeddings.num_embeddings
+    export_config = export_model(model, args.output_path, export_format=args.format, dynamic=args.dynamic,
+                                 max_v_l=model.max_v_l, max_q_l=max_q_l, opset_version=args.opset_version)
+    print(f"Exported to {args.output_path} with {export_config}")
+    max_diffs = check_export_parity(model, ExportedMomentDETR(args.output_path), atol=args.atol)
+    print(f"Parity check passed, max abs diff vs. eager: {max_diffs}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,320 @@
+"""
+Extract the CLIP video and query features used by training (moment_detr/scripts/train.sh) for a whole video
+library, in the layout read by StartEndDataset:
+    {save_dir}/clip_features/{vid}.npz               `features`, (#clips, 512), one frame every 2 secs
+    {save_dir}/clip_text_features/qid{qid}.npz       `last_hidden_state`, (#tokens, 512)
+or, with --feat_backend packed, the packed stores of moment_detr/feature_store.py in the same dirs.
+
+Videos are decoded by a pool of --num_workers processes, and the frames of consecutive videos are encoded
+together in CLIP batches of --bsz frames. Queries are encoded in batches of --text_bsz. Vids and qids that
+already exist in the output are skipped, so an interrupted run can simply be restarted.
+
+Usage:
+    PYTHONPATH=$PYTHONPATH:. python run_on_video/extract_features.py --video_dir videos \
+    --query_paths data/highlight_train_release.jsonl data/highlight_val_release.jsonl --save_dir features
+"""
+import os
+import time
+import queue
+import argparse
+import multiprocessing
+from collections import deque, defaultdict
+from os.path import join, exists
+
+import numpy as np
+import torch
+from tqdm import tqdm
+
+from run_on_video.data_utils import ClipFeatureExtractor, VideoLoader
+from moment_detr.feature_store import PackedFeatureWriter
+from utils.basic_utils import load_jsonl, get_basename_no_ext
+
+import logging
+logger = logging.getLogger(__name__)
+logging.basicConfig(format="%(asctime)s.%(msecs)03d:%(levelname)s:%(name)s - %(message)s",
+                    datefmt="%Y-%m-%d %H:%M:%S",
+                    level=logging.INFO)
+
+VIDEO_EXTENSIONS = (".mp4", ".mkv", ".webm", ".avi", ".mov", ".flv")
+
+
+class NpzFeatureWriter(object):
+    """writes each feature to `{feat_dir}/{name}.npz`, the same interface as PackedFeatureWriter"""
+
+    def __init__(self, feat_dir, feat_key):
+        os.makedirs(feat_dir, exist_ok=True)
+        self.feat_dir = feat_dir
+        self.feat_key = feat_key
+        for filename in os.listdir(feat_dir):  # left by an interrupted run
+            if filename.endswith(".npz.tmp"):
+                os.remove(join(feat_dir, filename))
+
+    def __contains__(self, name):
+        return exists(join(self.feat_dir, f"{name}.npz"))
+
+    def add(self, name, feat):
+        # the temp file does not end with .npz, so that it is never taken for a feature file
+        tmp_path = join(self.feat_dir, f".{name}.npz.tmp")
+        with open(tmp_path, "wb") as f:
+            np.savez(f, **{self.feat_key: np.asarray(feat, dtype=np.float32)})
+        os.replace(tmp_path, join(self.feat_dir, f"{name}.npz"))  # atomic, no partial files after a crash
+
+    def close(self):
+        pass
+
+
+def build_feature_writer(feat_backend, feat_dir, feat_key, dtype="float32"):
+    if feat_backend == "npz":
+        return NpzFeatureWriter(feat_dir, feat_key)
+    if feat_backend == "packed":
+        return PackedFeatureWriter(feat_dir, feat_key, dtype=dtype, normalize=True)
+    raise ValueError(f"feat_backend should be npz/packed, not {feat_backend}.")
+
+
+def list_videos(video_dir=None, video_manifest=None):
+    """ Returns:
+        list(tuple(vid, video_path)), the vid defaults to the file name w/o extension.
+        Raises ValueError if two videos have the same vid, as their features would be written to the same entry.
+    """
+    if video_manifest is not None:  # jsonl, each line has `video_path` and optionally `vid`
+        videos = [(e.get("vid", get_basename_no_ext(e["video_path"])), e["video_path"])
+                  for e in load_jsonl(video_manifest)]
+    else:
+        videos = []
+        for root, _, filenames in os.walk(video_dir):
+            for filename in sorted(filenames):
+                if filename.lower().endswith(VIDEO_EXTENSIONS):
+                    videos.append((get_basename_no_ext(filename), join(root, filename)))
+        videos = sorted(videos)
+    paths_by_vid = defaultdict(list)
+    for vid, video_path in videos:
+        paths_by_vid[vid].append(video_path)
+    duplicates = {k: v for k, v in paths_by_vid.items() if len(v) > 1}
+    if len(duplicates) > 0:
+        raise ValueError(f"{len(duplicates)} vids are used by several videos, rename the files or set unique "
+                         f"vids with --video_manifest: {duplicates}")
+    return videos
+
+
+def _decode_worker(job_queue, result_queue, framerate, size, centercrop, chunk_size):
+    """ runs in a decoding process, decodes the videos of job_queue until it gets None, and puts
+    (vid, uint8 frames (<=chunk_size, 3, H, W), None) for each chunk of frames, then (vid, None, error message)
+    when a video is done, error message is None on success. Puts None once all jobs are done.
+    """
+    torch.set_num_threads(1)
+    video_loader = VideoLoader(framerate=framerate, size=size, centercrop=centercrop)
+    for vid, video_path in iter(job_queue.get, None):
+        n_frames = 0
+        try:
+            for frames in video_loader.iter_video_frames(video_path, chunk_size=chunk_size):
+                result_queue.put((vid, frames.numpy(), None))
+                n_frames += len(frames)
+            result_queue.put((vid, None, None if n_frames > 0 else "no frames decoded"))
+        except Exception as e:
+            result_queue.put((vid, None, repr(e)))
+    result_queue.put(None)
+
+
+class CrossVideoEncoder(object):
+    """Encodes the frames of several videos, received in chunks, in shared CLIP batches of bsz frames,
+    and writes the features of each video once it is decoded and all of its frames are encoded."""
+
+    def __init__(self, feature_extractor, writer, bsz=256):
+        self.feature_extractor = feature_extractor
+        self.writer = writer
+        self.bsz = bsz
+        self.frame_queue = deque()  # [vid, uint8 frames], frames not yet encoded, in order
+        self.n_queued_frames = 0
+        self.features = {}  # vid -> list of encoded feature chunks
+        self.n_remaining = {}  # vid -> #frames not yet encoded
+        self.decoded = set()  # vids whose frames were all added
+        self.encode_time = 0.
+
+    def start(self, vid):
+        assert vid not in self.features, f"{vid} is already being encoded"
+        self.features[vid] = []
+        self.n_remaining[vid] = 0
+
+    def add(self, vid, frames):
+        self.frame_queue.append([vid, frames])
+        self.n_remaining[vid] += len(frames)
+        self.n_queued_frames += len(frames)
+        while self.n_queued_frames >= self.bsz:
+            self._encode_batch()
+
+    def finish(self, vid):
+        """all frames of vid were added"""
+        self.decoded.add(vid)
+        self._write_if_done(vid)
+
+    def discard(self, vid):
+        """drop the frames and features of vid, e.g., when decoding failed in the middle of the video"""
+        self.frame_queue = deque(e for e in self.frame_queue if e[0] != vid)
+        self.n_queued_frames -= self.n_remaining.pop(vid)
+        del self.features[vid]
+
+    def flush(self):
+        while self.n_queued_frames > 0:
+            self._encode_batch()
+
+    def _write_if_done(self, vid):
+        if vid in self.decoded and self.n_remaining[vid] == 0:
+            self.writer.add(vid, np.concatenate(self.features.pop(vid)))
+            del self.n_remaining[vid]
+            self.decoded.remove(vid)
+
+    @torch.no_grad()
+    def _encode_batch(self):
+        owners, frame_chunks, n_frames = [], [], 0
+        while n_frames < self.bsz and len(self.frame_queue) > 0:
+            vid, frames = self.frame_queue[0]
+            chunk = frames[:self.bsz - n_frames]
+            if len(chunk) == len(frames):
+                self.frame_queue.popleft()
+            else:
+                self.frame_queue[0][1] = frames[len(chunk):]
+            owners.append((vid, len(chunk)))
+            frame_chunks.append(torch.from_numpy(chunk))
+            n_frames += len(chunk)
+        self.n_queued_frames -= n_frames
+
+        timer_start = time.time()
+        fe = self.feature_extractor
+        frames = fe.video_preprocessor(torch.cat(frame_chunks)).to(fe.device)  # uint8 -> float
+        feats = fe.clip_extractor.encode_image(frames).float().cpu().numpy()  # (n_frames, d)
+        self.encode_time += time.time() - timer_start
+
+        st = 0
+        for vid, n in owners:
+            self.features[vid].append(feats[st:st + n])
+            st += n
+            self.n_remaining[vid] -= n
+            self._write_if_done(vid)
+
+
+def extract_video_features(feature_extractor, videos, writer, bsz=256, num_workers=4, max_pending=None):
+    """ decode `videos` in num_workers processes, and encode their frames with CLIP across videos.
+    The frames are sent from the decoding processes in chunks of bsz frames, so the memory does not grow
+    with the video length.
+    Args:
+        feature_extractor: ClipFeatureExtractor
+        videos: list(tuple(vid, video_path)), without the vids that are already extracted
+        writer: NpzFeatureWriter or PackedFeatureWriter
+        bsz: int, #frames per CLIP batch
+        num_workers: int, #decoding processes
+        max_pending: int, max #decoded chunks waiting for CLIP, bounds the memory, default 2 * num_workers
+    Returns:
+        list(tuple(vid, error message)), the videos that failed to decode
+    """
+    if len(videos) == 0:
+        return []
+    video_loader = feature_extractor.video_loader
+    encoder = CrossVideoEncoder(feature_extractor, writer, bsz=bsz)
+    failed = []
+    max_pending = 2 * num_workers if max_pending is None else max_pending
+    # spawn, as the parent may have initialized CUDA
+    ctx = multiprocessing.get_context("spawn")
+    job_queue = ctx.Queue()
+    for job in videos:
+        job_queue.put(job)
+    for _ in range(num_workers):
+        job_queue.put(None)
+    result_queue = ctx.Queue(maxsize=max_pending)
+    workers = [ctx.Process(target=_decode_worker, daemon=True, args=(
+        job_queue, result_queue, video_loader.framerate, video_loader.size, video_loader.centercrop, bsz))
+        for _ in range(num_workers)]
+    for w in workers:
+        w.start()
+    try:
+        n_running = num_workers
+        while n_running > 0:
+            try:
+                result = result_queue.get(timeout=5)
+            except queue.Empty:
+                if any(w.exitcode not in (None, 0) for w in workers):
+                    raise RuntimeError("a video decoding process died unexpectedly")
+                continue
+            if result is None:
+                n_running -= 1
+                continue
+            vid, frames, error = result
+            if vid not in encoder.features:
+                encoder.start(vid)
+            if frames is not None:
+                encoder.add(vid, frames)
+            elif error is None:
+                encoder.finish(vid)
+            else:
+                logger.warning(f"Skip {vid}, decoding failed: {error}")
+                encoder.discard(vid)
+                failed.append((vid, error))
+        encoder.flush()
+    finally:
+        for w in workers:
+            if w.is_alive():
+                w.terminate()
+            w.join()
+    logger.info(f"CLIP encoding time {encoder.encode_time:.2f}s")
+    return failed
+
+
+def extract_query_features(feature_extractor, queries, writer, text_bsz=512):
+    """
+    Args:
+        feature_extractor: ClipFeatureExtractor
+        queries: list(dict), each dict has `qid` and `query`, without the qids that are already extracted
+        writer: NpzFeatureWriter or PackedFeatureWriter
+        text_bsz: int
+    """
+    for st in tqdm(range(0, len(queries), text_bsz), desc="Encoding queries"):
+        batch = queries[st:st + text_bsz]
+        text_features = feature_extractor.encode_text([e["query"] for e in batch], bsz=text_bsz)
+        for e, feat in zip(batch, text_features):
+            writer.add(f"qid{e['qid']}", feat.float().cpu().numpy())
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Extract CLIP video and query features for training")
+    parser.add_argument("--video_dir", type=str, default=None, help="dir of videos, searched recursively")
+    parser.add_argument("--video_manifest", type=str, default=None,
+                        help="jsonl, each line has `video_path` and optionally `vid`, used instead of --video_dir")
+    parser.add_argument("--query_paths", type=str, nargs="*", default=[],
+                        help="jsonl annotation files, each line has `qid` and `query`")
+    parser.add_argument("--save_dir", type=str, default="features")
+    parser.add_argument("--feat_backend", type=str, default="npz", choices=["npz", "packed"],
+                        help="npz: one file per vid/qid, packed: see moment_detr/feature_store.py")
+    parser.add_argument("--dtype", type=str, default="float32", choices=["float16", "float32"],
+                        help="storage dtype of packed features")
+    parser.add_argument("--clip_model_name_or_path", type=str, default="ViT-B/32")
+    parser.add_argument("--device", type=str, default="cuda" if torch.cuda.is_available() else "cpu")
+    parser.add_argument("--bsz", type=int, default=256, help="#frames per CLIP batch, across videos")
+    parser.add_argument("--text_bsz", type=int, default=512, help="#queries per CLIP batch")
+    parser.add_argument("--num_workers", type=int, default=4, help="#video decoding processes")
+    args = parser.parse_args()
+
+    feature_extractor = ClipFeatureExtractor(
+        framerate=1/2, size=224, centercrop=True,
+        model_name_or_path=args.clip_model_name_or_path, device=args.device)
+
+    if args.video_dir is not None or args.video_manifest is not None:
+        writer = build_feature_writer(args.feat_backend, join(args.save_dir, "clip_features"), "features", args.dtype)
+        videos = list_videos(args.video_dir, args.video_manifest)
+        todo = [e for e in videos if e[0] not in writer]
+        logger.info(f"Extracting {len(todo)} videos, {len(videos) - len(todo)} already extracted")
+        failed = extract_video_features(feature_extractor, todo, writer, bsz=args.bsz, num_workers=args.num_workers)
+        writer.close()
+        if len(failed) > 0:
+            logger.warning(f"{len(failed)} videos failed: {[e[0] for e in failed]}")
+
+    if len(args.query_paths) > 0:
+        writer = build_feature_writer(
+            args.feat_backend, join(args.save_dir, "clip_text_features"), "last_hidden_state", args.dtype)
+        queries = {e["qid"]: e for path in args.query_paths for e in load_jsonl(path)}  # unique qids
+        todo = [e for e in queries.values() if f"qid{e['qid']}" not in writer]
+        logger.info(f"Extracting {len(todo)} queries, {len(queries) - len(todo)} already extracted")
+        extract_query_features(feature_extractor, todo, writer, text_bsz=args.text_bsz)
+        writer.close()
+
+
+if __name__ == "__main__":
+    main()
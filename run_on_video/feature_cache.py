@@ -0,0 +1,107 @@
+"""
+On-disk cache of the CLIP video and text features computed in run_on_video.
+
+Each entry is a .npy file named by the sha1 of its key. A video key covers the video file (its path, size
+and mtime, or its content), the CLIP model and the decoding settings (framerate, size, crop), a text key
+covers the query string and the CLIP model. Reading an entry updates its mtime, and the least recently
+used entries are removed once the cache exceeds max_gb.
+"""
+import os
+import hashlib
+import tempfile
+import numpy as np
+
+
+def get_file_id(path):
+    """path, size and mtime of a file, changes whenever the file is modified"""
+    path = os.path.abspath(path)
+    stat = os.stat(path)
+    return f"{path}:{stat.st_size}:{stat.st_mtime_ns}"
+
+
+def hash_file_content(path, chunk_n_bytes=1 << 20):
+    sha1 = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_n_bytes), b""):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+class ClipFeatureCache(object):
+    """
+    Args:
+        cache_dir: str
+        model_id: str, identifies the CLIP weights that produce the features
+        max_gb: float, the max total size of the cached features
+        hash_content: bool, key videos by the sha1 of their content instead of their path, size and mtime,
+            which reads the whole file, but still hits after the video is copied or moved
+    """
+
+    def __init__(self, cache_dir, model_id, max_gb=10, hash_content=False):
+        self.cache_dir = os.path.expanduser(cache_dir)
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self.model_id = model_id
+        self.max_bytes = int(max_gb * 1024 ** 3)
+        self.hash_content = hash_content
+        self.n_hits = 0
+        self.n_misses = 0
+
+    def video_key(self, video_path, **decode_settings):
+        file_id = hash_file_content(video_path) if self.hash_content else get_file_id(video_path)
+        settings = ":".join(f"{k}={v}" for k, v in sorted(decode_settings.items()))
+        return f"video:{file_id}:{self.model_id}:{settings}"
+
+    def text_key(self, text):
+        return f"text:{self.model_id}:{text}"
+
+    def _get_path(self, key):
+        return os.path.join(self.cache_dir, hashlib.sha1(key.encode()).hexdigest() + ".npy")
+
+    def get(self, key):
+        """ Returns:
+            np.ndarray, or None if `key` is not cached
+        """
+        path = self._get_path(key)
+        try:
+            feats = np.load(path)
+            os.utime(path)  # mark as recently used
+        except (OSError, ValueError):  # missing, or evicted by another process
+            self.n_misses += 1
+            return None
+        self.n_hits += 1
+        return feats
+
+    def put(self, key, feats):
+        self.put_many([(key, feats)])
+
+    def put_many(self, items):
+        """ Args:
+            items: list(tuple(key, np.ndarray))
+        """
+        for key, feats in items:
+            fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix=".tmp")
+            with os.fdopen(fd, "wb") as f:
+                np.save(f, feats)
+            os.replace(tmp_path, self._get_path(key))  # atomic, readers never see a partially written entry
+        self.evict()
+
+    def evict(self):
+        """remove the least recently used entries until the cache fits into max_gb"""
+        entries = []
+        for entry in os.scandir(self.cache_dir):
+            if not entry.name.endswith(".npy"):
+                continue
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:  # removed by another process
+                continue
+            entries.append((stat.st_mtime_ns, stat.st_size, entry.path))
+        n_bytes = sum(e[1] for e in entries)
+        for _, entry_n_bytes, path in sorted(entries):
+            if n_bytes <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            n_bytes -= entry_n_bytes
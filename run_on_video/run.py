@@ -1,25 +1,60 @@
+from collections import defaultdict
+
 import torch
 
 from run_on_video.data_utils import ClipFeatureExtractor
 from run_on_video.model_utils import build_inference_model
+from run_on_video.export import ExportedMomentDETR
+from run_on_video.sliding_window import (
+    get_window_starts, add_tef, tile_video_feats, merge_window_spans, merge_window_saliency)
+from utils.model_utils import quantize_linear_int8, get_quantized_cache_path
 from utils.tensor_utils import pad_sequences_1d
-from moment_detr.span_utils import span_cxw_to_xx
 from utils.basic_utils import l2_normalize_np_array
 import torch.nn.functional as F
 import numpy as np
 
 
 class MomentDETRPredictor:
-    def __init__(self, ckpt_path, clip_model_name_or_path="ViT-B/32", device="cuda"):
+    def __init__(self, ckpt_path, clip_model_name_or_path="ViT-B/32", device="cuda", exported_model_path=None,
+                 quantize=False, quantized_cache_dir="~/.cache/moment_detr",
+                 feature_cache_dir=None, feature_cache_max_gb=10, window_stride=50, nms_thd=0.7, max_after_nms=10,
+                 max_batch_size=256, max_batch_tokens=16384):
+        """
+        exported_model_path: str, a graph exported by run_on_video/export.py, used instead of the eager model
+        quantize: bool, dynamic int8 quantization of the Linear layers of Moment-DETR and CLIP, requires device cpu.
+            The quantized weights are cached in quantized_cache_dir.
+        feature_cache_dir: str, if given, the CLIP features of videos and queries are cached on disk, up to
+            feature_cache_max_gb, so querying the same video again skips the decoding and CLIP encoding.
+        window_stride: int, videos longer than max_v_l clips (150 secs) are split into windows of max_v_l clips,
+            starting every window_stride clips, see run_on_video/sliding_window.py
+        nms_thd, max_after_nms: temporal NMS to merge the moments predicted in overlapping windows
+        max_batch_size: int, max #windows x #queries in one forward of long videos
+        max_batch_tokens: int, max #padded video + query tokens in one forward of localize_many
+        """
         self.clip_len = 2  # seconds
         self.device = device
+        self.window_stride = window_stride
+        self.nms_thd = nms_thd
+        self.max_after_nms = max_after_nms
+        self.max_batch_size = max_batch_size
+        self.max_batch_tokens = max_batch_tokens
         print("Loading feature extractors...")
         self.feature_extractor = ClipFeatureExtractor(
             framerate=1/self.clip_len, size=224, centercrop=True,
-            model_name_or_path=clip_model_name_or_path, device=device
+            model_name_or_path=clip_model_name_or_path, device=device,
+            quantize=quantize, quantized_cache_dir=quantized_cache_dir,
+            feature_cache_dir=feature_cache_dir, feature_cache_max_gb=feature_cache_max_gb
         )
-        print("Loading trained Moment-DETR model...")
-        self.model = build_inference_model(ckpt_path).to(self.device)
+        if exported_model_path is not None:
+            print("Loading exported Moment-DETR graph...")
+            self.model = ExportedMomentDETR(exported_model_path)
+        else:
+            print("Loading trained Moment-DETR model...")
+            self.model = build_inference_model(ckpt_path).to(self.device)
+            if quantize:
+                cache_path = get_quantized_cache_path(quantized_cache_dir, "moment_detr", ckpt_path)
+                print(f"Quantizing Moment-DETR model, cache: {cache_path}")
+                self.model = quantize_linear_int8(self.model, cache_path=cache_path)
 
     @torch.no_grad()
     def localize_moment(self, video_path, query_list):
@@ -29,52 +64,145 @@ class MomentDETRPredictor:
             query_list: List[str], each str is a query for this video
         """
         # construct model inputs
-        n_query = len(query_list)
-        video_feats = self.feature_extractor.encode_video(video_path)
-        video_feats = F.normalize(video_feats, dim=-1, eps=1e-5)
-        n_frames = len(video_feats)
-        # add tef
-        tef_st = torch.arange(0, n_frames, 1.0) / n_frames
-        tef_ed = tef_st + 1.0 / n_frames
-        tef = torch.stack([tef_st, tef_ed], dim=1).to(self.device)  # (n_frames, 2)
-        video_feats = torch.cat([video_feats, tef], dim=1)
-        assert n_frames <= 75, "The positional embedding of this pretrained MomentDETR only support video up " \
-                               "to 150 secs (i.e., 75 2-sec clips) in length"
-        video_feats = video_feats.unsqueeze(0).repeat(n_query, 1, 1)  # (#text, T, d)
-        video_mask = torch.ones(n_query, n_frames).to(self.device)
+        window_feats, window_starts, n_frames = self._encode_video_windows(video_path)
         query_feats = self.feature_extractor.encode_text(query_list)  # #text * (L, d)
         query_feats, query_mask = pad_sequences_1d(
             query_feats, dtype=torch.float32, device=self.device, fixed_length=None)
         query_feats = F.normalize(query_feats, dim=-1, eps=1e-5)
-        model_inputs = dict(
-            src_vid=video_feats,
-            src_vid_mask=video_mask,
-            src_txt=query_feats,
-            src_txt_mask=query_mask
-        )
 
-        # decode outputs
-        outputs = self.model(**model_inputs)
+        # decode outputs, (#windows, #queries, ...)
+        outputs = self._forward_windows(window_feats, query_feats, query_mask)
+        return self._compose_predictions(video_path, query_list, outputs, window_starts, n_frames)
+
+    @torch.no_grad()
+    def localize_many(self, requests):
+        """ localize the queries of several videos, the (window, query) pairs of all videos are packed into
+        padded batches of similar lengths, with at most max_batch_size pairs and max_batch_tokens padded
+        video + query tokens per batch, which gives larger batches than calling localize_moment on each video.
+        Args:
+            requests: List[tuple(video_path (str), query_list (List[str]))]
+        Returns:
+            List[List[dict]], the predictions of each request in the same order, see localize_moment
+        """
+        videos = {}  # video_path -> (window_feats, window_starts, n_frames), each video is encoded once
+        for video_path, _ in requests:
+            if video_path not in videos:
+                videos[video_path] = self._encode_video_windows(video_path)
+        all_queries = [q for _, query_list in requests for q in query_list]
+        query_feats = self.feature_extractor.encode_text(all_queries) if len(all_queries) > 0 else []
+        query_feats = [F.normalize(e.float(), dim=-1, eps=1e-5) for e in query_feats]  # #text * (L, d)
+
+        # one item for each window x query of each request
+        items = []  # (request_idx, window_idx, query_idx, index into query_feats)
+        query_offset = 0
+        for request_idx, (video_path, query_list) in enumerate(requests):
+            n_windows = len(videos[video_path][1])
+            items += [(request_idx, window_idx, query_idx, query_offset + query_idx)
+                      for window_idx in range(n_windows) for query_idx in range(len(query_list))]
+            query_offset += len(query_list)
+
+        # run the items in batches of similar lengths, and write their outputs into the (#windows, #queries, ...)
+        # outputs of each request, allocated on the first batch that holds one of its items
+        outputs = [{} for _ in requests]  # output name -> (#windows, #queries, ...)
+        for batch in self._get_length_batches(
+                items, lambda e: (videos[requests[e[0]][0]][0].shape[1], len(query_feats[e[3]]))):
+            src_vid, src_vid_mask = pad_sequences_1d(
+                [videos[requests[e[0]][0]][0][e[1]] for e in batch], dtype=torch.float32, device=self.device)
+            src_txt, src_txt_mask = pad_sequences_1d(
+                [query_feats[e[3]] for e in batch], dtype=torch.float32, device=self.device)
+            batch_outputs = self.model(src_vid=src_vid, src_vid_mask=src_vid_mask,
+                                       src_txt=src_txt, src_txt_mask=src_txt_mask)
+            batch_indices = defaultdict(list)  # request_idx -> [(batch row, window_idx, query_idx)]
+            for i, (request_idx, window_idx, query_idx, _) in enumerate(batch):
+                batch_indices[request_idx].append((i, window_idx, query_idx))
+            for request_idx, indices in batch_indices.items():
+                video_path, query_list = requests[request_idx]
+                window_feats = videos[video_path][0]
+                rows, window_indices, query_indices = torch.tensor(indices, device=src_vid.device).unbind(1)
+                cur_outputs = outputs[request_idx]
+                for k in ["pred_logits", "pred_spans", "saliency_scores"]:
+                    v = batch_outputs[k][rows]
+                    if k == "saliency_scores":
+                        v = v[:, :window_feats.shape[1]]  # drop the padded clips
+                    if k not in cur_outputs:
+                        cur_outputs[k] = v.new_empty((len(window_feats), len(query_list)) + v.shape[1:])
+                    cur_outputs[k][window_indices, query_indices] = v
+
+        predictions = []
+        for (video_path, query_list), cur_outputs in zip(requests, outputs):
+            if len(query_list) == 0:
+                predictions.append([])
+                continue
+            _, window_starts, n_frames = videos[video_path]
+            predictions.append(
+                self._compose_predictions(video_path, query_list, cur_outputs, window_starts, n_frames))
+        return predictions
+
+    def _encode_video_windows(self, video_path):
+        """ Returns:
+            window_feats: (#windows, window_l, d+2), normalized clip features with tef
+            window_starts: list(int), start clip index of each window
+            n_frames: int, #clips of the video
+        """
+        video_feats = self.feature_extractor.encode_video(video_path)
+        video_feats = F.normalize(video_feats, dim=-1, eps=1e-5)
+        n_frames = len(video_feats)
+        # videos longer than the positional embedding of MomentDETR (150 secs, i.e., 75 2-sec clips)
+        # are split into overlapping windows, each window gets its own tef, as in training
+        window_starts = get_window_starts(n_frames, self.model.max_v_l, self.window_stride)
+        window_feats = add_tef(tile_video_feats(video_feats, window_starts, self.model.max_v_l))  # (#win, L, d+2)
+        return window_feats, window_starts, n_frames
+
+    def _get_length_batches(self, items, get_lengths):
+        """ group items of similar lengths into batches of at most max_batch_size items and
+        max_batch_tokens padded tokens, i.e., #items x (max video length + max query length)
+        Args:
+            items: list
+            get_lengths: function, item -> (video length, query length)
+        Returns:
+            list(list(item))
+        """
+        items = sorted(items, key=get_lengths, reverse=True)
+        batches = []
+        batch, max_l_vid, max_l_txt = [], 0, 0
+        for item in items:
+            l_vid, l_txt = get_lengths(item)
+            new_max_l_vid, new_max_l_txt = max(max_l_vid, l_vid), max(max_l_txt, l_txt)
+            n_tokens = (len(batch) + 1) * (new_max_l_vid + new_max_l_txt)
+            if len(batch) > 0 and (len(batch) == self.max_batch_size or n_tokens > self.max_batch_tokens):
+                batches.append(batch)
+                batch, new_max_l_vid, new_max_l_txt = [], l_vid, l_txt
+            batch.append(item)
+            max_l_vid, max_l_txt = new_max_l_vid, new_max_l_txt
+        if len(batch) > 0:
+            batches.append(batch)
+        return batches
+
+    def _compose_predictions(self, video_path, query_list, outputs, window_starts, n_frames):
+        """ Args:
+            outputs: dict, pred_logits, pred_spans and saliency_scores, each is (#windows, #queries, ...)
+        """
+        n_query = len(query_list)
+        window_l = outputs["saliency_scores"].shape[-1]
         # #moment_queries refers to the positional embeddings in MomentDETR's decoder, not the input text query
-        prob = F.softmax(outputs["pred_logits"], -1)  # (batch_size, #moment_queries=10, #classes=2)
-        scores = prob[..., 0]  # * (batch_size, #moment_queries)  foreground label is 0, we directly take it
-        pred_spans = outputs["pred_spans"]  # (bsz, #moment_queries, 2)
-        _saliency_scores = outputs["saliency_scores"].half()  # (bsz, L)
+        prob = F.softmax(outputs["pred_logits"], -1)  # (#windows, #queries, #moment_queries=10, #classes=2)
+        scores = prob[..., 0]  # * (#windows, #queries, #moment_queries)  foreground label is 0, we directly take it
+        pred_spans = outputs["pred_spans"]  # (#windows, #queries, #moment_queries, 2)
+        _saliency_scores = merge_window_saliency(
+            outputs["saliency_scores"], window_starts, n_frames).half()  # (#queries, n_frames)
         saliency_scores = []
-        valid_vid_lengths = model_inputs["src_vid_mask"].sum(1).cpu().tolist()
-        for j in range(len(valid_vid_lengths)):
-            _score = _saliency_scores[j, :int(valid_vid_lengths[j])].tolist()
+        for j in range(n_query):
+            _score = _saliency_scores[j, :n_frames].tolist()
             _score = [round(e, 4) for e in _score]
             saliency_scores.append(_score)
 
-        # compose predictions
+        # compose predictions, the spans of all windows in seconds, merged with temporal NMS
         predictions = []
-        video_duration = n_frames * self.clip_len
-        for idx, (spans, score) in enumerate(zip(pred_spans.cpu(), scores.cpu())):
-            spans = span_cxw_to_xx(spans) * video_duration
+        ranked_preds = merge_window_spans(
+            pred_spans.cpu(), scores.cpu(), window_starts, window_l, self.clip_len,
+            nms_thd=self.nms_thd, max_after_nms=self.max_after_nms)
+        for idx, cur_ranked_preds in enumerate(ranked_preds):
             # # (#queries, 3), [st(float), ed(float), score(float)]
-            cur_ranked_preds = torch.cat([spans, score[:, None]], dim=1).tolist()
-            cur_ranked_preds = sorted(cur_ranked_preds, key=lambda x: x[2], reverse=True)
             cur_ranked_preds = [[float(f"{e:.4f}") for e in row] for row in cur_ranked_preds]
             cur_query_pred = dict(
                 query=query_list[idx],  # str
@@ -86,6 +214,34 @@ class MomentDETRPredictor:
 
         return predictions
 
+    def _forward_windows(self, window_feats, query_feats, query_mask):
+        """ run all windows x queries through the model, in batches of max_batch_size
+        Args:
+            window_feats: (#windows, L, d), with tef
+            query_feats: (#queries, L_txt, d_txt)
+            query_mask: (#queries, L_txt)
+        Returns:
+            dict, pred_logits, pred_spans and saliency_scores, each is (#windows, #queries, ...)
+        """
+        n_windows, n_query = len(window_feats), len(query_feats)
+        window_mask = torch.ones(window_feats.shape[:2], device=window_feats.device)
+        if n_windows == 1:  # a single copy of the video is shared by all queries, see MomentDETR.forward
+            outputs = self.model(src_vid=window_feats, src_vid_mask=window_mask,
+                                 src_txt=query_feats, src_txt_mask=query_mask)
+            return {k: outputs[k].unsqueeze(0) for k in ["pred_logits", "pred_spans", "saliency_scores"]}
+
+        window_indices = torch.arange(n_windows).repeat_interleave(n_query)  # (#windows * #queries, )
+        query_indices = torch.arange(n_query).repeat(n_windows)
+        outputs = defaultdict(list)
+        for batch_st in range(0, len(window_indices), self.max_batch_size):
+            win_idx = window_indices[batch_st:batch_st + self.max_batch_size]
+            txt_idx = query_indices[batch_st:batch_st + self.max_batch_size]
+            batch_outputs = self.model(src_vid=window_feats[win_idx], src_vid_mask=window_mask[win_idx],
+                                       src_txt=query_feats[txt_idx], src_txt_mask=query_mask[txt_idx])
+            for k in ["pred_logits", "pred_spans", "saliency_scores"]:
+                outputs[k].append(batch_outputs[k])
+        return {k: torch.cat(v).view(n_windows, n_query, *v[0].shape[1:]) for k, v in outputs.items()}
+
 
 def run_example():
     # load example data
@@ -0,0 +1,95 @@
+"""
+Sliding-window inference for videos longer than the max #clips of Moment-DETR (max_v_l, 75 2-sec clips).
+
+The clip features are tiled into overlapping windows of max_v_l clips, each window gets its own tef as in
+training, and all windows x queries are run through the model in batches. The predicted spans are mapped
+back to absolute time and merged with temporal NMS, the saliency scores of clips covered by several
+windows are averaged.
+"""
+import torch
+
+from moment_detr.span_utils import span_cxw_to_xx
+from utils.temporal_nms import batched_temporal_nms
+
+
+def get_window_starts(n_clips, window_size, window_stride):
+    """ start clip index of each window, the last window is aligned to the end of the video
+    Args:
+        n_clips: int
+        window_size: int, #clips in each window
+        window_stride: int, #clips between the starts of two windows, <= window_size
+    Returns:
+        list(int), a single window [0] if the video fits into one window
+    """
+    assert 0 < window_stride <= window_size, "window_stride must be in (0, window_size]"
+    if n_clips <= window_size:
+        return [0]
+    window_starts = list(range(0, n_clips - window_size, window_stride))
+    window_starts.append(n_clips - window_size)
+    return window_starts
+
+
+def add_tef(video_feats):
+    """ append the temporal endpoint features (tef), i.e., normalized [st, ed] of each clip
+    Args:
+        video_feats: (..., L, d)
+    Returns:
+        (..., L, d+2)
+    """
+    n_clips = video_feats.shape[-2]
+    tef_st = torch.arange(0, n_clips, 1.0, device=video_feats.device) / n_clips
+    tef_ed = tef_st + 1.0 / n_clips
+    tef = torch.stack([tef_st, tef_ed], dim=1).to(video_feats.dtype)  # (L, 2)
+    return torch.cat([video_feats, tef.expand(*video_feats.shape[:-2], -1, -1)], dim=-1)
+
+
+def tile_video_feats(video_feats, window_starts, window_size):
+    """
+    Args:
+        video_feats: (n_clips, d)
+        window_starts: list(int), see `get_window_starts`
+        window_size: int
+    Returns:
+        (#windows, min(n_clips, window_size), d)
+    """
+    return torch.stack([video_feats[st:st + window_size] for st in window_starts])
+
+
+def merge_window_spans(pred_spans, scores, window_starts, window_l, clip_len, nms_thd=0.7, max_after_nms=10):
+    """ map the spans predicted in each window to absolute time, and merge the windows with temporal NMS
+    Args:
+        pred_spans: (#windows, #queries, #moment_queries, 2), normalized (center, width) in each window
+        scores: (#windows, #queries, #moment_queries)
+        window_starts: list(int)
+        window_l: int, #clips in each window
+        clip_len: float, seconds
+        nms_thd: float in [0, 1], only used with more than one window
+        max_after_nms: int, only used with more than one window
+    Returns:
+        list(list([st (float), ed (float), score (float)])) for each query, sorted by score, in seconds
+    """
+    window_st = torch.tensor(window_starts, dtype=pred_spans.dtype, device=pred_spans.device) * clip_len
+    spans = span_cxw_to_xx(pred_spans) * (window_l * clip_len) + window_st[:, None, None, None]
+    preds = torch.cat([spans, scores[..., None]], dim=-1)  # (#windows, #queries, #moment_queries, 3)
+    preds = preds.transpose(0, 1).flatten(1, 2).tolist()  # #queries * (#windows * #moment_queries, 3)
+    if len(window_starts) == 1:  # the spans of a single window do not need to be merged
+        return [sorted(e, key=lambda x: x[2], reverse=True) for e in preds]
+    return batched_temporal_nms(preds, nms_thd=nms_thd, max_after_nms=max_after_nms)
+
+
+def merge_window_saliency(saliency_scores, window_starts, n_clips):
+    """ average the saliency scores of each clip over the windows covering it
+    Args:
+        saliency_scores: (#windows, #queries, window_l)
+        window_starts: list(int)
+        n_clips: int
+    Returns:
+        (#queries, n_clips)
+    """
+    n_windows, n_query, window_l = saliency_scores.shape
+    clip_indices = (torch.tensor(window_starts, device=saliency_scores.device)[:, None] +
+                    torch.arange(window_l, device=saliency_scores.device)).flatten()  # (#windows * window_l, )
+    total = saliency_scores.new_zeros(n_query, n_clips).index_add_(
+        1, clip_indices, saliency_scores.transpose(0, 1).flatten(1))
+    counts = torch.bincount(clip_indices, minlength=n_clips)  # (n_clips, ), #windows covering each clip
+    return total / counts
@@ -2,10 +2,10 @@ import numpy as np
 from collections import OrderedDict, defaultdict
 import json
 import time
-import copy
 import multiprocessing as mp
 from standalone_eval.utils import compute_average_precision_detection, \
-    compute_temporal_iou_batch_cross, compute_temporal_iou_batch_paired, load_jsonl, get_ap
+    compute_average_precision_detection_batch, compute_temporal_iou_batch_cross, \
+    compute_temporal_iou_batch_paired, select_max_iou_gt_windows, iter_jsonl, load_jsonl, get_ap, get_ap_batch
 
 
 def compute_average_precision_detection_wrapper(
@@ -16,9 +16,123 @@ def compute_average_precision_detection_wrapper(
     return qid, scores
 
 
+def get_mr_columns(submission, ground_truth, max_pred_windows=10):
+    """ columnar moment retrieval data, built once and shared by all metrics and length ranges.
+    Queries are indexed in the order of their first appearance in submission,
+    ground truth of queries that are not in submission is dropped.
+    Returns:
+        dict(
+            qids: list, (Q, )
+            in_gt: np.ndarray of bool, (Q, ), whether the query exists in ground_truth
+            pred_windows: np.ndarray, (N_pred, 2), [st, ed], at most max_pred_windows for each query
+            pred_scores: np.ndarray, (N_pred, )
+            pred_query_idx: np.ndarray of int, (N_pred, )
+            gt_windows: np.ndarray, (N_gt, 2), [st, ed]
+            gt_query_idx: np.ndarray of int, (N_gt, )
+        )
+    """
+    qid2idx = {}
+    pred_windows, pred_query_idx = [], []
+    for d in submission:
+        pred_windows_and_scores = d["pred_relevant_windows"][:max_pred_windows] \
+            if max_pred_windows is not None else d["pred_relevant_windows"]
+        q_idx = qid2idx.setdefault(d["qid"], len(qid2idx))
+        pred_windows.extend(pred_windows_and_scores)
+        pred_query_idx.extend([q_idx] * len(pred_windows_and_scores))
+
+    in_gt = np.zeros(len(qid2idx), dtype=bool)
+    gt_windows, gt_query_idx = [], []
+    for d in ground_truth:
+        if d["qid"] not in qid2idx:
+            continue
+        in_gt[qid2idx[d["qid"]]] = True
+        gt_windows.extend(d["relevant_windows"])
+        gt_query_idx.extend([qid2idx[d["qid"]]] * len(d["relevant_windows"]))
+
+    pred_windows = np.array(pred_windows, dtype=float).reshape(-1, 3)
+    return dict(
+        qids=list(qid2idx.keys()),
+        in_gt=in_gt,
+        pred_windows=pred_windows[:, :2],
+        pred_scores=pred_windows[:, 2],
+        pred_query_idx=np.array(pred_query_idx, dtype=np.int64),
+        gt_windows=np.array(gt_windows, dtype=float).reshape(-1, 2),
+        gt_query_idx=np.array(gt_query_idx, dtype=np.int64),
+    )
+
+
+def filter_mr_columns(columns, query_mask, gt_mask=None):
+    """ keep the queries in query_mask (Q, ) and the ground truth windows in gt_mask (N_gt, ),
+    queries are re-indexed in their original order."""
+    gt_mask = np.ones(len(columns["gt_query_idx"]), dtype=bool) if gt_mask is None else gt_mask
+    new_query_idx = np.cumsum(query_mask) - 1
+    pred_mask = query_mask[columns["pred_query_idx"]]
+    gt_mask = gt_mask & query_mask[columns["gt_query_idx"]]
+    return dict(
+        qids=[qid for qid, keep in zip(columns["qids"], query_mask) if keep],
+        in_gt=columns["in_gt"][query_mask],
+        pred_windows=columns["pred_windows"][pred_mask],
+        pred_scores=columns["pred_scores"][pred_mask],
+        pred_query_idx=new_query_idx[columns["pred_query_idx"][pred_mask]],
+        gt_windows=columns["gt_windows"][gt_mask],
+        gt_query_idx=new_query_idx[columns["gt_query_idx"][gt_mask]],
+    )
+
+
 def compute_mr_ap(submission, ground_truth, iou_thds=np.linspace(0.5, 0.95, 10),
-                  max_gt_windows=None, max_pred_windows=10, num_workers=8, chunksize=50):
+                  max_gt_windows=None, max_pred_windows=10, num_workers=0, chunksize=50):
+    """ mAP over all queries in submission that have at least one predicted window.
+    By default, APs of all queries are computed together in a single process with
+    compute_average_precision_detection_batch. Set num_workers > 1 to use the original per-query
+    compute_average_precision_detection with a process pool instead, both give the same results.
+    """
+    if num_workers > 1:
+        iou_thds = [float(f"{e:.2f}") for e in iou_thds]
+        ap_array = compute_mr_ap_per_query(
+            submission, ground_truth, iou_thds, max_gt_windows=max_gt_windows,
+            max_pred_windows=max_pred_windows, num_workers=num_workers, chunksize=chunksize)
+        return format_mr_ap(ap_array, iou_thds)
+    columns = get_mr_columns(submission, ground_truth, max_pred_windows=max_pred_windows)
+    return compute_mr_ap_from_columns(columns, iou_thds, max_gt_windows=max_gt_windows)
+
+
+def compute_mr_ap_from_columns(columns, iou_thds=np.linspace(0.5, 0.95, 10), max_gt_windows=None):
+    """ compute_mr_ap on the output of get_mr_columns"""
     iou_thds = [float(f"{e:.2f}") for e in iou_thds]
+    ap_array = compute_mr_ap_batch(columns, iou_thds, max_gt_windows=max_gt_windows)
+    return format_mr_ap(ap_array, iou_thds)
+
+
+def format_mr_ap(ap_array, iou_thds):
+    ap_thds = ap_array.mean(0)  # mAP at different IoU thresholds.
+    iou_thd2ap = dict(zip([str(e) for e in iou_thds], ap_thds))
+    iou_thd2ap["average"] = np.mean(ap_thds)
+    # formatting
+    iou_thd2ap = {k: float(f"{100 * v:.2f}") for k, v in iou_thd2ap.items()}
+    return iou_thd2ap
+
+
+def compute_mr_ap_batch(columns, iou_thds, max_gt_windows=None):
+    """ returns np.ndarray (#queries, #thd), for the queries that have at least one predicted window,
+    in the order of columns["qids"]"""
+    has_pred = np.bincount(columns["pred_query_idx"], minlength=len(columns["qids"])) > 0
+    gt_mask = None
+    if max_gt_windows is not None:  # keep the first max_gt_windows windows of each query
+        gt_query_idx = columns["gt_query_idx"]
+        order = np.argsort(gt_query_idx, kind="stable")
+        starts = np.searchsorted(gt_query_idx[order], gt_query_idx[order])
+        rank = np.empty(len(order), dtype=np.int64)
+        rank[order] = np.arange(len(order)) - starts
+        gt_mask = rank < max_gt_windows
+    columns = filter_mr_columns(columns, has_pred, gt_mask=gt_mask)
+    return compute_average_precision_detection_batch(
+        columns["gt_windows"], columns["gt_query_idx"], columns["pred_windows"], columns["pred_scores"],
+        columns["pred_query_idx"], n_queries=len(columns["qids"]), tiou_thresholds=iou_thds)
+
+
+def compute_mr_ap_per_query(submission, ground_truth, iou_thds, max_gt_windows=None, max_pred_windows=10,
+                            num_workers=8, chunksize=50):
+    """ returns np.ndarray (#queries, #thd)"""
     pred_qid2data = defaultdict(list)
     for d in submission:
         pred_windows = d["pred_relevant_windows"][:max_pred_windows] \
@@ -60,35 +174,26 @@ def compute_mr_ap(submission, ground_truth, iou_thds=np.linspace(0.5, 0.95, 10),
             qid2ap_list[qid] = scores
 
     # print(f"compute_average_precision_detection {time.time() - start_time:.2f} seconds.")
-    ap_array = np.array(list(qid2ap_list.values()))  # (#queries, #thd)
-    ap_thds = ap_array.mean(0)  # mAP at different IoU thresholds.
-    iou_thd2ap = dict(zip([str(e) for e in iou_thds], ap_thds))
-    iou_thd2ap["average"] = np.mean(ap_thds)
-    # formatting
-    iou_thd2ap = {k: float(f"{100 * v:.2f}") for k, v in iou_thd2ap.items()}
-    return iou_thd2ap
+    return np.array(list(qid2ap_list.values()))  # (#queries, #thd)
 
 
 def compute_mr_r1(submission, ground_truth, iou_thds=np.linspace(0.5, 0.95, 10)):
     """If a predicted segment has IoU >= iou_thd with one of the 1st GT segment, we define it positive"""
+    return compute_mr_r1_from_columns(get_mr_columns(submission, ground_truth, max_pred_windows=1), iou_thds)
+
+
+def compute_mr_r1_from_columns(columns, iou_thds=np.linspace(0.5, 0.95, 10)):
+    """ compute_mr_r1 on the output of get_mr_columns"""
     iou_thds = [float(f"{e:.2f}") for e in iou_thds]
-    pred_qid2window = {d["qid"]: d["pred_relevant_windows"][0][:2] for d in submission}  # :2 rm scores
-    # gt_qid2window = {d["qid"]: d["relevant_windows"][0] for d in ground_truth}
-    gt_qid2window = {}
-    for d in ground_truth:
-        cur_gt_windows = d["relevant_windows"]
-        cur_qid = d["qid"]
-        cur_max_iou_idx = 0
-        if len(cur_gt_windows) > 0:  # select the GT window that has the highest IoU
-            cur_ious = compute_temporal_iou_batch_cross(
-                np.array([pred_qid2window[cur_qid]]), np.array(d["relevant_windows"])
-            )[0]
-            cur_max_iou_idx = np.argmax(cur_ious)
-        gt_qid2window[cur_qid] = cur_gt_windows[cur_max_iou_idx]
-
-    qids = list(pred_qid2window.keys())
-    pred_windows = np.array([pred_qid2window[k] for k in qids]).astype(float)
-    gt_windows = np.array([gt_qid2window[k] for k in qids]).astype(float)
+    # queries with a prediction and at least one GT window, the top-1 predicted window is the first one
+    n_queries = len(columns["qids"])
+    has_pred = np.bincount(columns["pred_query_idx"], minlength=n_queries) > 0
+    has_gt = np.bincount(columns["gt_query_idx"], minlength=n_queries) > 0
+    columns = filter_mr_columns(columns, has_pred & has_gt)
+    _, first_pred_idx = np.unique(columns["pred_query_idx"], return_index=True)
+    pred_windows = columns["pred_windows"][first_pred_idx]
+    # select the GT window that has the highest IoU
+    gt_windows = select_max_iou_gt_windows(pred_windows, columns["gt_windows"], columns["gt_query_idx"])
     pred_gt_iou = compute_temporal_iou_batch_paired(pred_windows, gt_windows)
     iou_thd2recall_at_one = {}
     for thd in iou_thds:
@@ -100,52 +205,40 @@ def get_window_len(window):
     return window[1] - window[0]
 
 
-def get_data_by_range(submission, ground_truth, len_range):
+def get_data_by_range(columns, len_range):
     """ keep queries with ground truth window length in the specified length range.
     Args:
-        submission:
-        ground_truth:
+        columns: dict, output of get_mr_columns
         len_range: [min_l (int), max_l (int)]. the range is (min_l, max_l], i.e., min_l < l <= max_l
     """
     min_l, max_l = len_range
     if min_l == 0 and max_l == 150:  # min and max l in dataset
-        return submission, ground_truth
+        return columns
 
     # only keep ground truth with windows in the specified length range
     # if multiple GT windows exists, we only keep the ones in the range
-    ground_truth_in_range = []
-    gt_qids_in_range = set()
-    for d in ground_truth:
-        rel_windows_in_range = [
-            w for w in d["relevant_windows"] if min_l < get_window_len(w) <= max_l]
-        if len(rel_windows_in_range) > 0:
-            d = copy.deepcopy(d)
-            d["relevant_windows"] = rel_windows_in_range
-            ground_truth_in_range.append(d)
-            gt_qids_in_range.add(d["qid"])
-
+    gt_window_len = get_window_len(columns["gt_windows"].T)
+    gt_mask = (min_l < gt_window_len) & (gt_window_len <= max_l)
+    query_mask = np.bincount(columns["gt_query_idx"][gt_mask], minlength=len(columns["qids"])) > 0
     # keep only submissions for ground_truth_in_range
-    submission_in_range = []
-    for d in submission:
-        if d["qid"] in gt_qids_in_range:
-            submission_in_range.append(copy.deepcopy(d))
-
-    return submission_in_range, ground_truth_in_range
+    return filter_mr_columns(columns, query_mask, gt_mask=gt_mask)
 
 
 def eval_moment_retrieval(submission, ground_truth, verbose=True):
     length_ranges = [[0, 10], [10, 30], [30, 150], [0, 150], ]  #
     range_names = ["short", "middle", "long", "full"]
 
+    columns = get_mr_columns(submission, ground_truth)
     ret_metrics = {}
     for l_range, name in zip(length_ranges, range_names):
         if verbose:
             start_time = time.time()
-        _submission, _ground_truth = get_data_by_range(submission, ground_truth, l_range)
-        print(f"{name}: {l_range}, {len(_ground_truth)}/{len(ground_truth)}="
-              f"{100*len(_ground_truth)/len(ground_truth):.2f} examples.")
-        iou_thd2average_precision = compute_mr_ap(_submission, _ground_truth, num_workers=8, chunksize=50)
-        iou_thd2recall_at_one = compute_mr_r1(_submission, _ground_truth)
+        _columns = get_data_by_range(columns, l_range)
+        n_gt_in_range = int(_columns["in_gt"].sum())
+        print(f"{name}: {l_range}, {n_gt_in_range}/{len(ground_truth)}="
+              f"{100*n_gt_in_range/len(ground_truth):.2f} examples.")
+        iou_thd2average_precision = compute_mr_ap_from_columns(_columns)
+        iou_thd2recall_at_one = compute_mr_r1_from_columns(_columns)
         ret_metrics[name] = {"MR-mAP": iou_thd2average_precision, "MR-R1": iou_thd2recall_at_one}
         if verbose:
             print(f"[eval_moment_retrieval] [{name}] {time.time() - start_time:.2f} seconds")
@@ -219,12 +312,58 @@ def mk_gt_scores(gt_data, clip_length=2):
     return saliency_scores_full_video  # (#clips_in_video, 3)  the scores are in range [0, 4]
 
 
-def eval_highlight(submission, ground_truth, verbose=True):
+def compute_hl_metrics_batch(qid2preds, qid2gt_scores_full_range, gt_saliency_score_min_list):
+    """ HL-mAP and HL-Hit1 for all minimum positive scores at once. The saliency scores of each query are
+    ranked only once, the ranking is shared by all (gt_saliency_score_min, annotator) pairs.
+    The results are the same as compute_hl_ap and compute_hl_hit1.
+    Returns:
+        mean_ap_list: list(float), one for each gt_saliency_score_min
+        hit_at_one_list: list(float), ...
+    """
+    qids = list(qid2preds.keys())
+    score_mins = np.array(gt_saliency_score_min_list)
+    n_mins = len(score_mins)
+    ap_scores = np.zeros((n_mins, len(qids), 3))  # (#mins, #preds, 3)
+    hit_scores = np.zeros((len(qids), 3))  # full range scores of the top ranked clip
+
+    len2q_indices = defaultdict(list)
+    for idx, qid in enumerate(qids):
+        pred_scores = qid2preds[qid]["pred_saliency_scores"]
+        gt_scores = qid2gt_scores_full_range[qid]  # (#clips, 3)
+        len2q_indices[len(gt_scores)].append(idx)
+        pred_clip_idx = np.argmax(pred_scores)
+        if pred_clip_idx < len(gt_scores):
+            hit_scores[idx] = gt_scores[pred_clip_idx]
+
+    # queries with the same #clips are evaluated together,
+    # predictions are truncated or zero-padded to #clips, as in compute_ap_from_tuple
+    for n_clips, q_indices in len2q_indices.items():
+        y_predict = np.zeros((len(q_indices), n_clips))
+        y_true = np.zeros((len(q_indices), n_clips, 3))
+        for row, idx in enumerate(q_indices):
+            pred_scores = qid2preds[qids[idx]]["pred_saliency_scores"][:n_clips]
+            y_predict[row, :len(pred_scores)] = pred_scores
+            y_true[row] = qid2gt_scores_full_range[qids[idx]]
+        y_true_binary = (y_true[..., None] >= score_mins).astype(float)  # (Qg, #clips, 3, #mins)
+        ap = get_ap_batch(y_true_binary.reshape(len(q_indices), n_clips, 3 * n_mins), y_predict)
+        ap_scores[:, q_indices] = ap.reshape(len(q_indices), 3, n_mins).transpose(2, 0, 1)
+
+    mean_ap_list, hit_at_one_list = [], []
+    for min_idx, gt_saliency_score_min in enumerate(score_mins):
+        mean_ap_list.append(float(f"{100 * np.mean(ap_scores[min_idx]):.2f}"))
+        hit_scores_binary = (hit_scores >= gt_saliency_score_min).astype(float)
+        hit_at_one_list.append(float(f"{100 * np.mean(np.max(hit_scores_binary, 1)):.2f}"))
+    return mean_ap_list, hit_at_one_list
+
+
+def eval_highlight(submission, ground_truth, verbose=True, num_workers=0):
     """
     Args:
         submission:
         ground_truth:
         verbose:
+        num_workers: int, by default all metrics are computed together with compute_hl_metrics_batch,
+            set num_workers > 1 to compute them for each min score separately with a process pool.
     """
     qid2preds = {d["qid"]: d for d in submission}
     qid2gt_scores_full_range = {d["qid"]: mk_gt_scores(d) for d in ground_truth}  # scores in range [0, 4]
@@ -232,13 +371,25 @@ def eval_highlight(submission, ground_truth, verbose=True):
     gt_saliency_score_min_list = [2, 3, 4]
     saliency_score_names = ["Fair", "Good", "VeryGood"]
     highlight_det_metrics = {}
+    if num_workers <= 1:
+        start_time = time.time()
+        mean_ap_list, hit_at_one_list = compute_hl_metrics_batch(
+            qid2preds, qid2gt_scores_full_range, gt_saliency_score_min_list)
+        for score_name, mean_ap, hit_at_one in zip(saliency_score_names, mean_ap_list, hit_at_one_list):
+            highlight_det_metrics[f"HL-min-{score_name}"] = {"HL-mAP": mean_ap, "HL-Hit1": hit_at_one}
+        if verbose:
+            print(f"Calculating highlight scores with min score {gt_saliency_score_min_list} "
+                  f"({saliency_score_names})")
+            print(f"Time cost {time.time() - start_time:.2f} seconds")
+        return highlight_det_metrics
+
     for gt_saliency_score_min, score_name in zip(gt_saliency_score_min_list, saliency_score_names):
         start_time = time.time()
         qid2gt_scores_binary = {
             k: (v >= gt_saliency_score_min).astype(float)
             for k, v in qid2gt_scores_full_range.items()}  # scores in [0, 1]
         hit_at_one = compute_hl_hit1(qid2preds, qid2gt_scores_binary)
-        mean_ap = compute_hl_ap(qid2preds, qid2gt_scores_binary)
+        mean_ap = compute_hl_ap(qid2preds, qid2gt_scores_binary, num_workers=num_workers)
         highlight_det_metrics[f"HL-min-{score_name}"] = {"HL-mAP": mean_ap, "HL-Hit1": hit_at_one}
         if verbose:
             print(f"Calculating highlight scores with min score {gt_saliency_score_min} ({score_name})")
@@ -246,10 +397,29 @@ def eval_highlight(submission, ground_truth, verbose=True):
     return highlight_det_metrics
 
 
+def compact_submission(submission, max_pred_windows=10):
+    """ keep only the fields used by the metrics, i.e., the top max_pred_windows predicted windows
+    and the saliency scores as a float array, so that a large submission can be streamed from disk.
+    Args:
+        submission: iterable of dict, e.g., a list or the generator returned by iter_jsonl
+    Returns:
+        list(dict)
+    """
+    compact = []
+    for d in submission:
+        e = {"qid": d["qid"]}
+        if "pred_relevant_windows" in d:
+            e["pred_relevant_windows"] = d["pred_relevant_windows"][:max_pred_windows]
+        if "pred_saliency_scores" in d:
+            e["pred_saliency_scores"] = np.array(d["pred_saliency_scores"], dtype=float)
+        compact.append(e)
+    return compact
+
+
 def eval_submission(submission, ground_truth, verbose=True, match_number=True):
     """
     Args:
-        submission: list(dict), each dict is {
+        submission: iterable of dict, each dict is {
             qid: str,
             query: str,
             vid: str,
@@ -257,6 +427,7 @@ def eval_submission(submission, ground_truth, verbose=True, match_number=True):
             pred_saliency_scores: list(float), len == #clips in video.
                 i.e., each clip in the video will have a saliency score.
         }
+            submission is read only once, it can be a generator, e.g., iter_jsonl(submission_path).
         ground_truth: list(dict), each dict is     {
           "qid": 7803,
           "query": "Man in gray top walks from outside to inside.",
@@ -274,6 +445,8 @@ def eval_submission(submission, ground_truth, verbose=True, match_number=True):
     Returns:
 
     """
+    submission = compact_submission(submission)
+    ground_truth = list(ground_truth)
     pred_qids = set([e["qid"] for e in submission])
     gt_qids = set([e["qid"] for e in ground_truth])
     if match_number:
@@ -330,7 +503,7 @@ def eval_main():
     args = parser.parse_args()
 
     verbose = not args.not_verbose
-    submission = load_jsonl(args.submission_path)
+    submission = iter_jsonl(args.submission_path)
     gt = load_jsonl(args.gt_path)
     results = eval_submission(submission, gt, verbose=verbose)
     if verbose:
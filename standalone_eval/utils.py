@@ -5,11 +5,23 @@ https://github.com/open-mmlab/mmaction2/blob/master/mmaction/core/evaluation/eva
 import json
 import numpy as np
 from sklearn.metrics import precision_recall_curve
+try:
+    import orjson  # optional, faster parsing of large submission files
+except ImportError:
+    orjson = None
 
 
-def load_jsonl(filename):
+def iter_jsonl(filename):
+    """yields one dict per line, without reading the whole file into memory"""
     with open(filename, "r") as f:
-        return [json.loads(l.strip("\n")) for l in f.readlines()]
+        for l in f:
+            l = l.strip("\n")
+            if l:
+                yield orjson.loads(l) if orjson is not None else json.loads(l)
+
+
+def load_jsonl(filename):
+    return list(iter_jsonl(filename))
 
 
 def compute_temporal_iou_batch_paired(pred_windows, gt_windows):
@@ -166,6 +178,158 @@ def compute_average_precision_detection(ground_truth,
     return ap
 
 
+def _pad_by_query(values, query_idx, n_queries, fill_value=0):
+    """ scatter a flat (N, ...) array into a (n_queries, max_count, ...) array, keeping the original order
+    of the items inside each query.
+    Returns:
+        padded: np.ndarray, (n_queries, max_count, ...)
+        valid: np.ndarray of bool, (n_queries, max_count)
+    """
+    counts = np.bincount(query_idx, minlength=n_queries)
+    max_count = int(counts.max(initial=0))
+    order = np.argsort(query_idx, kind="stable")
+    starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+    sorted_query_idx = query_idx[order]
+    positions = np.arange(len(order)) - starts[sorted_query_idx]
+    padded = np.full((n_queries, max_count) + values.shape[1:], fill_value, dtype=values.dtype)
+    padded[sorted_query_idx, positions] = values[order]
+    valid = np.arange(max_count)[None] < counts[:, None]
+    return padded, valid
+
+
+def select_max_iou_gt_windows(pred_windows, gt_windows, gt_query_idx):
+    """ for each query, select the ground truth window that has the highest IoU with its predicted window,
+    the first one is selected if there are ties, as np.argmax over compute_temporal_iou_batch_cross.
+    Args:
+        pred_windows: np.ndarray, (Q, 2), one [st, ed] for each query
+        gt_windows: np.ndarray, (N_gt, 2), [st, ed] of all ground truth windows
+        gt_query_idx: np.ndarray of int, (N_gt, ), each query must have at least one ground truth window
+    Returns:
+        np.ndarray, (Q, 2)
+    """
+    n_queries = len(pred_windows)
+    if n_queries == 0:  # e.g., no ground truth window in a length range
+        return np.zeros((0, 2), dtype=gt_windows.dtype)
+    gts, gt_valid = _pad_by_query(gt_windows, gt_query_idx, n_queries)  # (Q, G, 2)
+    # the same ops as compute_temporal_iou_batch_cross
+    areas1 = pred_windows[:, 1] - pred_windows[:, 0]  # (Q, )
+    areas2 = gts[..., 1] - gts[..., 0]  # (Q, G)
+    left = np.maximum(pred_windows[:, None, 0], gts[..., 0])  # (Q, G)
+    right = np.minimum(pred_windows[:, None, 1], gts[..., 1])  # (Q, G)
+    inter = np.clip(right - left, 0, None)
+    union = areas1[:, None] + areas2 - inter
+    with np.errstate(divide="ignore", invalid="ignore"):
+        iou = np.where(gt_valid, inter / union, -np.inf)
+    max_iou_idx = np.argmax(iou, axis=1)
+    return gts[np.arange(n_queries), max_iou_idx]
+
+
+def compute_average_precision_detection_batch(gt_windows, gt_query_idx, pred_windows, pred_scores,
+                                              pred_query_idx, n_queries,
+                                              tiou_thresholds=np.linspace(0.5, 0.95, 10)):
+    """Array-based compute_average_precision_detection for many queries at once, each query being one
+    `video-id`. The result for each query is exactly the same as calling compute_average_precision_detection
+    with the query's ground truth and predictions, i.e., the same sorting, tie breaking and floating point ops.
+
+    Args:
+        gt_windows: np.ndarray, (N_gt, 2), [st, ed] of all ground truth windows
+        gt_query_idx: np.ndarray of int, (N_gt, ), index of the query each ground truth window belongs to
+        pred_windows: np.ndarray, (N_pred, 2), [st, ed] of all predicted windows
+        pred_scores: np.ndarray, (N_pred, ), the score of each predicted window
+        pred_query_idx: np.ndarray of int, (N_pred, ), index of the query each predicted window belongs to
+        n_queries: int
+        tiou_thresholds (np.ndarray): (T, ) temporal intersection over union thresholds.
+
+    Returns:
+        ap: np.ndarray, (n_queries, T), queries without predictions get 0, as in the per-query function.
+    """
+    tiou_thresholds = np.asarray(tiou_thresholds, dtype=float)
+    num_thresholds = len(tiou_thresholds)
+    ap = np.zeros((n_queries, num_thresholds))
+    if len(pred_scores) == 0:
+        return ap
+
+    # (Q, P) predictions, sorted by decreasing score order, stable as `list.sort`, padding goes last.
+    preds, pred_valid = _pad_by_query(
+        np.concatenate([pred_windows, pred_scores[:, None]], axis=1).astype(float), pred_query_idx, n_queries)
+    pred_order = np.argsort(np.where(pred_valid, -preds[..., 2], np.inf), axis=1, kind="stable")
+    preds = np.take_along_axis(preds, pred_order[..., None], axis=1)
+    pred_valid = np.take_along_axis(pred_valid, pred_order, axis=1)
+    num_preds = preds.shape[1]
+
+    gts, _ = _pad_by_query(np.asarray(gt_windows, dtype=float).reshape(-1, 2), gt_query_idx, n_queries)
+    num_gts = np.bincount(gt_query_idx, minlength=n_queries)
+    tp = np.zeros((n_queries, num_thresholds, num_preds))
+    fp = np.zeros((n_queries, num_thresholds, num_preds))
+    # queries without ground truth, all predictions are false positives
+    fp[num_gts == 0] = pred_valid[num_gts == 0][:, None, :]
+
+    # queries with the same #gts are matched together, so that sorting the tious
+    # along the last axis is exactly the same as sorting them query by query
+    for n_gt in np.unique(num_gts[num_gts > 0]):
+        q_indices = np.nonzero(num_gts == n_gt)[0]
+        _preds = preds[q_indices]  # (Qg, P, 3)
+        _gts = gts[q_indices, :n_gt]  # (Qg, G, 2)
+        _valid = pred_valid[q_indices]  # (Qg, P)
+        # the same ops as compute_temporal_iou_batch_cross
+        areas1 = _preds[..., 1] - _preds[..., 0]  # (Qg, P)
+        areas2 = _gts[..., 1] - _gts[..., 0]  # (Qg, G)
+        left = np.maximum(_preds[:, :, None, 0], _gts[:, None, :, 0])  # (Qg, P, G)
+        right = np.minimum(_preds[:, :, None, 1], _gts[:, None, :, 1])  # (Qg, P, G)
+        inter = np.clip(right - left, 0, None)
+        union = areas1[:, :, None] + areas2[:, None, :] - inter
+        with np.errstate(divide="ignore", invalid="ignore"):
+            tiou = inter / union  # (Qg, P, G)
+        # We would like to retrieve the predictions with highest tiou score.
+        tiou_sorted_idx = tiou.argsort(axis=-1)[..., ::-1]  # (Qg, P, G)
+        tiou_sorted = np.take_along_axis(tiou, tiou_sorted_idx, axis=-1)
+
+        lock_gt = np.zeros((len(q_indices), num_thresholds, n_gt), dtype=bool)  # (Qg, T, G)
+        row_indices = np.arange(len(q_indices))[:, None]
+        thd_indices = np.arange(num_thresholds)[None]
+        for idx in range(num_preds):
+            _sorted_idx = np.broadcast_to(tiou_sorted_idx[:, None, idx], lock_gt.shape)  # (Qg, T, G)
+            # gts visited before the first one with tiou < threshold, that are not locked yet
+            reachable = np.cumsum(tiou_sorted[:, None, idx] < tiou_thresholds[None, :, None], axis=-1) == 0
+            candidates = reachable & ~np.take_along_axis(lock_gt, _sorted_idx, axis=-1)
+            is_tp = candidates.any(-1) & _valid[:, idx, None]  # (Qg, T)
+            is_fp = ~candidates.any(-1) & _valid[:, idx, None]
+            matched_gt_idx = np.take_along_axis(
+                _sorted_idx, candidates.argmax(-1)[..., None], axis=-1)[..., 0]  # (Qg, T)
+            lock_gt[row_indices, thd_indices, matched_gt_idx] |= is_tp
+            tp[q_indices, :, idx] = is_tp
+            fp[q_indices, :, idx] = is_fp
+
+    # padded predictions repeat the last cumsum values, they neither change the
+    # precision envelope nor add recall steps, so the same terms are summed.
+    tp_cumsum = np.cumsum(tp, axis=-1).astype(float)
+    fp_cumsum = np.cumsum(fp, axis=-1).astype(float)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        recall_cumsum = tp_cumsum / num_gts.astype(float)[:, None, None]
+        precision_cumsum = tp_cumsum / (tp_cumsum + fp_cumsum)
+
+    # the same ops as interpolated_precision_recall, for all queries and thresholds
+    shape = (n_queries, num_thresholds, 1)
+    mprecision = np.concatenate([np.zeros(shape), precision_cumsum, np.zeros(shape)], axis=-1)
+    mrecall = np.concatenate([np.zeros(shape), recall_cumsum, np.ones(shape)], axis=-1)
+    mprecision = np.maximum.accumulate(mprecision[..., ::-1], axis=-1)[..., ::-1]
+    is_step = mrecall[..., 1:] != mrecall[..., :-1]  # (Q, T, P+1)
+    terms = (mrecall[..., 1:] - mrecall[..., :-1]) * mprecision[..., 1:]
+    # np.sum over the selected terms, grouped by #terms to keep numpy's summation order
+    is_step, terms = is_step.reshape(-1, num_preds + 1), terms.reshape(-1, num_preds + 1)
+    num_steps = is_step.sum(-1)
+    step_first = np.argsort(~is_step, axis=-1, kind="stable")
+    terms = np.take_along_axis(terms, step_first, axis=-1)
+    flat_ap = np.zeros(len(terms))
+    for n_steps in np.unique(num_steps):
+        rows = num_steps == n_steps
+        flat_ap[rows] = np.sum(terms[rows, :n_steps], axis=-1)
+
+    has_pred = pred_valid.any(-1)
+    ap[has_pred] = flat_ap.reshape(n_queries, num_thresholds)[has_pred]
+    return ap
+
+
 def get_ap(y_true, y_predict, interpolate=True, point_11=False):
     """
     Average precision in different formats: (non-) interpolated and/or 11-point approximated
@@ -207,3 +371,66 @@ def get_ap(y_true, y_predict, interpolate=True, point_11=False):
     else:  # Compute the AP using precision at every additionally recalled sample
         indices = np.where(np.diff(recall))
         return np.mean(precision[indices])
+
+
+def get_ap_batch(y_true, y_predict):
+    """ Array-based get_ap (with the default interpolate=True, point_11=False) for many ranking problems
+    at once. Each row of y_predict is sorted only once, and the ranking is shared by the K label sets of
+    that row, e.g., different positive thresholds and annotators. The results are exactly the same as
+    calling get_ap on each (y_true[i, :, k], y_predict[i]) pair.
+
+    Args:
+        y_true: np.ndarray, (N, L, K), labels in {0, 1}
+        y_predict: np.ndarray, (N, L), predicted scores, shared by the K label sets of the same row.
+
+    Returns:
+        ap: np.ndarray, (N, K)
+    """
+    y_true = np.asarray(y_true, dtype=float)
+    y_predict = np.asarray(y_predict, dtype=float)
+    n_rows, length, n_labels = y_true.shape
+    ap = np.zeros((n_rows, n_labels))
+    if n_rows == 0 or length == 0:
+        return ap
+
+    # the same ranking as precision_recall_curve, tied scores share a single threshold,
+    # located at the last element of each group of tied scores.
+    order = np.argsort(y_predict, axis=1, kind="mergesort")[:, ::-1]
+    scores = np.take_along_axis(y_predict, order, axis=1)  # (N, L)
+    labels = np.take_along_axis(y_true, order[..., None], axis=1)  # (N, L, K)
+    is_threshold = np.concatenate([np.diff(scores, axis=1) != 0, np.ones((n_rows, 1), dtype=bool)], axis=1)
+
+    tps = np.cumsum(labels, axis=1)
+    fps = 1 + np.arange(length, dtype=float)[None, :, None] - tps
+    precision = tps / (tps + fps)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        recall = (tps / tps[:, -1:]).astype(np.float32)
+
+    # reverse to the order of precision_recall_curve, i.e., decreasing recall,
+    # non-threshold elements are kept as zeros, which never change the running max.
+    is_threshold = np.broadcast_to(is_threshold[:, ::-1, None], tps.shape)
+    precision = np.where(is_threshold, precision[:, ::-1], 0)
+    recall = np.where(is_threshold, recall[:, ::-1], 0)
+    precision = np.maximum.accumulate(precision, axis=1)  # interpolation
+    # recall of the next threshold, 0 after the last one, as appended by precision_recall_curve
+    next_recall = np.maximum.accumulate(recall[:, ::-1], axis=1)[:, ::-1]
+    next_recall = np.concatenate([next_recall[:, 1:], np.zeros((n_rows, 1, n_labels), np.float32)], axis=1)
+    is_step = is_threshold & (recall != next_recall)  # (N, L, K)
+
+    # np.mean over the selected elements, grouped by #elements to keep numpy's summation order
+    is_step = is_step.transpose(0, 2, 1).reshape(-1, length)
+    precision = precision.transpose(0, 2, 1).reshape(-1, length)
+    num_steps = is_step.sum(-1)
+    step_first = np.argsort(~is_step, axis=-1, kind="stable")
+    precision = np.take_along_axis(precision, step_first, axis=-1)
+    flat_ap = np.zeros(len(precision))
+    for n_steps in np.unique(num_steps[num_steps > 0]):
+        rows = num_steps == n_steps
+        flat_ap[rows] = np.sum(precision[rows, :n_steps], axis=-1) / n_steps
+    ap = flat_ap.reshape(n_rows, n_labels)
+
+    # rows with a single class, all zeros get 0 and all ones get 1
+    num_positives = labels.sum(1)  # (N, K)
+    ap[num_positives == 0] = 0
+    ap[num_positives == length] = 1
+    return ap
@@ -1,10 +1,15 @@
 import os
 import json
+import math
 import zipfile
 import numpy as np
 import pickle
 from collections import OrderedDict, Counter
 import pandas as pd
+try:
+    import orjson  # optional, faster json (de)serialization for large jsonl files
+except ImportError:
+    orjson = None
 
 
 def load_pickle(filename):
@@ -30,15 +35,64 @@ def save_json(data, filename, save_pretty=False, sort_keys=False):
             json.dump(data, f)
 
 
-def load_jsonl(filename):
+def json_loads(s):
+    return orjson.loads(s) if orjson is not None else json.loads(s)
+
+
+def _json_default(obj):
+    if isinstance(obj, (np.ndarray, np.generic)):
+        return obj.tolist()
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+
+def _nan_to_none(obj):
+    if isinstance(obj, (np.ndarray, np.generic)):
+        obj = obj.tolist()
+    if isinstance(obj, float):
+        return obj if math.isfinite(obj) else None
+    if isinstance(obj, dict):
+        return {k: _nan_to_none(v) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return [_nan_to_none(v) for v in obj]
+    return obj
+
+
+def json_dumps(data):
+    """compact json, with or without orjson: no spaces after separators, numpy values as lists/numbers,
+    nan/inf as null"""
+    if orjson is not None:
+        try:
+            return orjson.dumps(data, option=orjson.OPT_SERIALIZE_NUMPY).decode("utf-8")
+        except TypeError:  # e.g., non-str dict keys, which the json module converts to str
+            pass
+    try:
+        return json.dumps(data, separators=(",", ":"), ensure_ascii=False, allow_nan=False,
+                          default=_json_default)
+    except ValueError:  # nan/inf, rare, so only then walk the data
+        return json.dumps(_nan_to_none(data), separators=(",", ":"), ensure_ascii=False, allow_nan=False,
+                          default=_json_default)
+
+
+def iter_jsonl(filename):
+    """yields one dict per line, without reading the whole file into memory"""
     with open(filename, "r") as f:
-        return [json.loads(l.strip("\n")) for l in f.readlines()]
+        for l in f:
+            l = l.strip("\n")
+            if l:
+                yield json_loads(l)
+
+
+def load_jsonl(filename):
+    return list(iter_jsonl(filename))
 
 
 def save_jsonl(data, filename):
-    """data is a list"""
+    """data is an iterable, e.g., a list or a generator, written one line at a time"""
     with open(filename, "w") as f:
-        f.write("\n".join([json.dumps(e) for e in data]))
+        for idx, e in enumerate(data):
+            if idx > 0:
+                f.write("\n")
+            f.write(json_dumps(e))
 
 
 def save_lines(list_of_str, filepath):
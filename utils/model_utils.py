@@ -1,3 +1,12 @@
+import os
+import copy
+import hashlib
+import warnings
+
+import torch
+from torch import nn
+
+
 def count_parameters(model, verbose=True):
     """Count number of parameters in PyTorch model,
     References: https://discuss.pytorch.org/t/how-do-i-check-the-number-of-parameters-of-a-model/4325/7.
@@ -13,3 +22,98 @@ def count_parameters(model, verbose=True):
         print("Parameter Count: all {:,d}; trainable {:,d}".format(n_all, n_trainable))
     return n_all, n_trainable
 
+
+def count_int8_weights(model):
+    """#weights in the dynamic int8 Linear layers of `quantize_linear_int8` and #weights left in float,
+    e.g., the attention projections, the embeddings and the norms.
+    Returns:
+        n_int8, n_float: int
+    """
+    n_int8 = sum(m.weight().numel() for m in model.modules()
+                 if isinstance(m, torch.ao.nn.quantized.dynamic.Linear))
+    n_float = sum(p.numel() for p in model.parameters())  # the quantized layers hold no nn.Parameter
+    return n_int8, n_float
+
+
+def resolve_amp_dtype(amp_dtype, device):
+    """Returns the torch dtype used by autocast on `device`, or None when mixed precision is disabled.
+    float16 is replaced by bfloat16 on CPU, which is preferred there as it needs no loss scaling and is
+    faster on most CPUs, bfloat16 falls back to float16 on GPUs without native bfloat16 support.
+
+    Args:
+        amp_dtype: str or None, one of [float16, bfloat16]
+        device: torch.device
+    """
+    if amp_dtype is None:
+        return None
+    dtype = getattr(torch, amp_dtype)
+    if device.type == "cpu" and dtype == torch.float16:
+        warnings.warn("bfloat16 is preferred over float16 for autocast on CPU, use bfloat16 instead")
+        dtype = torch.bfloat16
+    elif device.type == "cuda" and dtype == torch.bfloat16 and not torch.cuda.is_bf16_supported():
+        warnings.warn("bfloat16 is not supported by this GPU, use float16 instead")
+        dtype = torch.float16
+    return dtype
+
+
+def amp_autocast(device, amp_dtype):
+    """autocast context for `device`, a no-op when `amp_dtype` (torch dtype) is None"""
+    return torch.autocast(device_type=device.type, dtype=amp_dtype, enabled=amp_dtype is not None)
+
+
+def cast_to_float(obj):
+    """cast the floating point tensors in (nested) dict/list to float32, other objects are kept as is"""
+    if isinstance(obj, torch.Tensor):
+        return obj.float() if obj.is_floating_point() else obj
+    elif isinstance(obj, dict):
+        return {k: cast_to_float(v) for k, v in obj.items()}
+    elif isinstance(obj, (list, tuple)):
+        return type(obj)(cast_to_float(v) for v in obj)
+    return obj
+
+
+def get_quantized_cache_path(cache_dir, name, src_path):
+    """path of the cached int8 weights of the model loaded from `src_path`, the file name changes whenever
+    the source file, or the torch version (which defines the packed weight format), changes"""
+    src_path = os.path.abspath(src_path)
+    stat = os.stat(src_path)
+    key = f"{src_path}:{stat.st_size}:{stat.st_mtime_ns}:{torch.__version__}"
+    return os.path.join(os.path.expanduser(cache_dir),
+                        f"{name}_{hashlib.sha1(key.encode()).hexdigest()[:16]}_int8.pt")
+
+
+def quantize_linear_int8(model, cache_path=None):
+    """Dynamic int8 quantization of the nn.Linear layers for CPU inference, the weights are stored in int8 and
+    the activations are quantized on the fly. Only the standalone nn.Linear layers are quantized, e.g., the
+    feed-forward layers, the input projections and the prediction heads. The attention projections stay in float32:
+    the in_proj and out_proj of nn.MultiheadAttention and the in_proj_weight of ScaledDotProductAttention,
+    see `count_int8_weights` for the share of the weights that is quantized.
+
+    Args:
+        model: nn.Module, float32 model, it is not modified
+        cache_path: str, the quantized weights are loaded from this file if it exists, otherwise saved to it
+    Returns:
+        nn.Module, the quantized copy of `model`, on CPU in eval mode
+    """
+    model = copy.deepcopy(model).cpu().eval()
+    if cache_path is not None and os.path.exists(cache_path):
+        # load the cached int8 weights into empty quantized layers, instead of quantizing the float weights
+        quantized_model = _replace_linear_with_dynamic_int8(model)
+        quantized_model.load_state_dict(torch.load(cache_path, map_location="cpu"))
+        return quantized_model
+    quantized_model = torch.ao.quantization.quantize_dynamic(model, {nn.Linear}, dtype=torch.qint8, inplace=True)
+    if cache_path is not None:
+        os.makedirs(os.path.dirname(os.path.abspath(cache_path)), exist_ok=True)
+        torch.save(quantized_model.state_dict(), cache_path)
+    return quantized_model
+
+
+def _replace_linear_with_dynamic_int8(model):
+    """replace (in place) the nn.Linear layers with dynamic int8 Linear layers whose weights are not set yet,
+    the same layers as `quantize_dynamic(model, {nn.Linear})`, i.e., subclasses of nn.Linear are kept"""
+    for module in list(model.modules()):
+        for child_name, child in list(module.named_children()):
+            if type(child) is nn.Linear:
+                setattr(module, child_name, torch.ao.nn.quantized.dynamic.Linear(
+                    child.in_features, child.out_features, bias_=child.bias is not None, dtype=torch.qint8))
+    return model
@@ -1,6 +1,7 @@
 """
 Non-Maximum Suppression for video proposals.
 """
+import numpy as np
 
 
 def compute_temporal_iou(pred, gt):
@@ -72,3 +73,82 @@ def temporal_nms(predictions, nms_thd, max_after_nms=100):
 
     predictions_after_nms = [[st, ed, s] for s, st, ed in zip(rscore, rstart, rend)]
     return predictions_after_nms
+
+
+def compute_temporal_iou_one_to_many(windows, col_idx):
+    """ the same (not the correct union) IoU as compute_temporal_iou, between one window and all windows.
+    Args:
+        windows: np.ndarray, (B, N, 2), [st (float), ed (float)] * N
+        col_idx: int, the IoU is computed between windows[:, col_idx] and all windows
+    Returns:
+        iou: np.ndarray, (B, N)
+    """
+    st, ed = windows[..., 0], windows[..., 1]
+    intersection = np.maximum(
+        0, np.minimum(ed[:, col_idx:col_idx+1], ed) - np.maximum(st[:, col_idx:col_idx+1], st))
+    union = np.maximum(ed[:, col_idx:col_idx+1], ed) - np.minimum(st[:, col_idx:col_idx+1], st)
+    return np.divide(intersection, union, out=np.zeros_like(intersection), where=union != 0)
+
+
+def batched_temporal_nms(batch_predictions, nms_thd, max_after_nms=100, chunk_size=256):
+    """ Array-based temporal_nms for many queries at once, the output is exactly the same as
+    [temporal_nms(e, nms_thd, max_after_nms) for e in batch_predictions].
+    Predictions of `chunk_size` queries are padded into one (B, N, 3) array, and the greedy suppression
+    runs over the N (sorted) candidates for all B queries in parallel. The IoU of each candidate against
+    the others is only computed when the candidate is kept by at least one query, and the loop stops once
+    every query has `max_after_nms` windows, which is much cheaper than the full (B, N, N) IoU matrix.
+    Args:
+        batch_predictions: list(list(sublist)), each sublist is [st (float), ed(float), score (float)]
+        nms_thd: float in [0, 1]
+        max_after_nms: int
+        chunk_size: int, #queries per array op, bounds the (B, N, N) IoU memory
+    Returns:
+        list(list(sublist)), predictions_after_nms for each query
+    """
+    results = []
+    for chunk_st in range(0, len(batch_predictions), chunk_size):
+        results.extend(_batched_temporal_nms_chunk(
+            batch_predictions[chunk_st:chunk_st + chunk_size], nms_thd, max_after_nms))
+    return results
+
+
+def _batched_temporal_nms_chunk(batch_predictions, nms_thd, max_after_nms):
+    lengths = np.array([len(e) for e in batch_predictions], dtype=np.int64)
+    bsz, max_len = len(batch_predictions), int(lengths.max(initial=0))
+    if max_len == 0:
+        return [[] for _ in batch_predictions]
+
+    preds = np.zeros((bsz, max_len, 3), dtype=np.float64)
+    for idx, e in enumerate(batch_predictions):
+        if len(e) > 0:
+            preds[idx, :len(e)] = np.asarray(e, dtype=np.float64)[:, :3]
+    valid = np.arange(max_len)[None] < lengths[:, None]  # (B, N)
+
+    # descending scores, stable for ties as `sorted(..., reverse=True)`, padding goes last
+    sort_keys = np.where(valid, -preds[..., 2], np.inf)
+    order = np.argsort(sort_keys, axis=1, kind="stable")  # (B, N)
+    sorted_windows = np.take_along_axis(preds[..., :2], order[..., None], axis=1)  # (B, N, 2)
+    sorted_valid = np.take_along_axis(valid, order, axis=1)
+
+    kept = np.zeros((bsz, max_len), dtype=bool)
+    suppressed = ~sorted_valid
+    n_kept = np.zeros(bsz, dtype=np.int64)
+    for col_idx in range(max_len):  # greedy: keep the next candidate that is not suppressed by the kept ones
+        keep_col = ~suppressed[:, col_idx] & (n_kept < max_after_nms)
+        if not keep_col.any():
+            if (n_kept >= max_after_nms).all():
+                break
+            continue
+        kept[:, col_idx] = keep_col
+        n_kept += keep_col
+        ious = compute_temporal_iou_one_to_many(sorted_windows, col_idx)  # (B, N)
+        suppressed |= keep_col[:, None] & (ious > nms_thd)
+
+    results = []
+    for idx, e in enumerate(batch_predictions):
+        if len(e) == 1:  # only has one prediction, no need for nms
+            results.append(e)
+            continue
+        kept_indices = order[idx][kept[idx]]
+        results.append([[e[i][0], e[i][1], e[i][2]] for i in kept_indices])
+    return results
@@ -0,0 +1,67 @@
+import time
+import queue
+import threading
+
+_END = object()
+
+
+class _ExceptionWrapper(object):
+    def __init__(self, exc):
+        self.exc = exc
+
+
+def _put(q, item, stop_event):
+    """put `item` into the bounded queue `q`, returns False if `stop_event` is set before there is room"""
+    while not stop_event.is_set():
+        try:
+            q.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+
+def _produce(iterable, q, stop_event):
+    iterator = iter(iterable)
+    try:
+        for item in iterator:
+            if not _put(q, item, stop_event):
+                return
+    except Exception as e:
+        _put(q, _ExceptionWrapper(e), stop_event)
+        return
+    finally:
+        if hasattr(iterator, "close"):  # run the cleanup of generators when the consumer stopped early
+            iterator.close()
+    _put(q, _END, stop_event)
+
+
+def iter_in_background(iterable, max_prefetch=1, wait_callback=None):
+    """ Iterates over `iterable` in a background thread, which runs up to `max_prefetch` items ahead of the
+    consumer. Exceptions raised by `iterable` are re-raised in the consumer. When the consumer stops early
+    (break, exception, or closing this generator), the thread stops at the next item, closes `iterable`
+    if it is a generator, and is joined.
+
+    Args:
+        iterable: iterable, e.g., a generator, it is only iterated by the background thread
+        max_prefetch: int, max #items prepared ahead, bounds the memory
+        wait_callback: function(float), if given, called with the time the consumer waited for each item
+    """
+    q = queue.Queue(maxsize=max_prefetch)
+    stop_event = threading.Event()
+    thread = threading.Thread(target=_produce, args=(iterable, q, stop_event), daemon=True)
+    thread.start()
+    try:
+        while True:
+            timer_start = time.time()
+            item = q.get()
+            if wait_callback is not None:
+                wait_callback(time.time() - timer_start)
+            if item is _END:
+                break
+            if isinstance(item, _ExceptionWrapper):
+                raise item.exc
+            yield item
+    finally:
+        stop_event.set()
+        thread.join()